@@ -1,25 +1,60 @@
 import os
 import sys
-import uuid
+import time
 import json
+import shutil
+import mimetypes
 import logging
-from datetime import datetime, timedelta
-from flask import Flask, render_template, redirect, url_for, flash, request, jsonify, send_from_directory
+from datetime import datetime, timedelta, timezone
+from flask import Flask, Response, render_template, redirect, url_for, flash, request, jsonify, abort, after_this_request
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
+from werkzeug.exceptions import RequestEntityTooLarge, ClientDisconnected
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
+from sqlalchemy.orm import aliased, selectinload
 
 # Относительные импорты для работы как пакета
 try:
     from .config import config
-    from .models import db, User, Task, ChatMessage, TaskFile, TypingStatus, PersonalChat, PersonalMessage, PersonalChatFile
+    from .models import db, User, Task, ChatMessage, TaskFile, PersonalChat, PersonalMessage, PersonalChatFile, TaskTombstone, TaskUnread, PersonalChatUnread, StorageUsage, UploadSession, DicomInstance
     from .forms.auth import LoginForm, RegistrationForm, PasswordChangeForm
     from .forms.task import TaskForm, TaskEditForm, CommentForm, MassActionForm
+    from .notifications import message_hub, event_bus
+    from .typing_store import create_typing_store
+    from .presence import presence_tracker
+    from .stats import stats_service
+    from .storage import subtract_directory, storage_reconciler, TASKS_DIRECTORY, PERSONAL_CHATS_DIRECTORY
+    from .uploads import (UploadRequest, UploadBusy, ingest_upload, read_file_type, create_resumable_file,
+                          write_chunk, finish_resumable, discard_resumable, resumable_path)
+    from .downloads import send_upload
+    from .dicom_headers import instance_filter, summarize_series, dicom_indexer
+    from .previews import preview_generator, preview_key, preview_path, generate_preview, remove_previews
+    from .blobstore import store_blob, release_blob, collect_blobs, stored_file_path, is_blob_name
+    from .migrations import run_migrations
+    from .sqlite_profile import configure_sqlite_engine
+    from .request_metrics import request_metrics
+    from .metrics import server_metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
 except ImportError:
     # Для прямого запуска (не как пакет)
     from config import config
-    from models import db, User, Task, ChatMessage, TaskFile, TypingStatus, PersonalChat, PersonalMessage, PersonalChatFile
+    from models import db, User, Task, ChatMessage, TaskFile, PersonalChat, PersonalMessage, PersonalChatFile, TaskTombstone, TaskUnread, PersonalChatUnread, StorageUsage, UploadSession, DicomInstance
     from forms.auth import LoginForm, RegistrationForm, PasswordChangeForm
     from forms.task import TaskForm, TaskEditForm, CommentForm, MassActionForm
+    from notifications import message_hub, event_bus
+    from typing_store import create_typing_store
+    from presence import presence_tracker
+    from stats import stats_service
+    from storage import subtract_directory, storage_reconciler, TASKS_DIRECTORY, PERSONAL_CHATS_DIRECTORY
+    from uploads import (UploadRequest, UploadBusy, ingest_upload, read_file_type, create_resumable_file,
+                         write_chunk, finish_resumable, discard_resumable, resumable_path)
+    from downloads import send_upload
+    from dicom_headers import instance_filter, summarize_series, dicom_indexer
+    from previews import preview_generator, preview_key, preview_path, generate_preview, remove_previews
+    from blobstore import store_blob, release_blob, collect_blobs, stored_file_path, is_blob_name
+    from migrations import run_migrations
+    from sqlite_profile import configure_sqlite_engine
+    from request_metrics import request_metrics
+    from metrics import server_metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
 
 
 def create_app(config_name='development'):
@@ -30,6 +65,8 @@ def create_app(config_name='development'):
     
     app = Flask(__name__, template_folder=templates_folder, static_folder=static_folder)
     app.config.from_object(config[config_name])
+    # Файлы multipart-запросов пишутся сразу в папку загрузок с подсчётом SHA-256 и лимитами (uploads.py)
+    app.request_class = UploadRequest
 
     # Маршрут для раздачи загруженных файлов из data/uploads/
     @app.route('/static/uploads/<path:filename>')
@@ -41,14 +78,22 @@ def create_app(config_name='development'):
         else:
             upload_base = Path(__file__).parent.parent / 'data' / 'uploads'
 
-        return send_from_directory(str(upload_base), filename)
+        path = safe_join(str(upload_base), filename)
+        if path is None:
+            abort(404)
+        return send_upload(path, str(upload_base), mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                           download_name=os.path.basename(filename))
 
     # Настройка логирования
     from logging_config import get_logger
     try:
-        logger = get_logger(log_dir=config.LOG_DIR if hasattr(config, 'LOG_DIR') else 'logs')
+        logger = get_logger(log_dir=config.LOG_DIR if hasattr(config, 'LOG_DIR') else 'logs',
+                            queue_size=app.config['LOG_QUEUE_SIZE'],
+                            queue_policy=app.config['LOG_QUEUE_POLICY'],
+                            queue_block_timeout=app.config['LOG_QUEUE_BLOCK_TIMEOUT'])
         app.logger.handlers = logger.logger.handlers
         app.logger.setLevel(logging.INFO)
+        server_metrics.log_queue_stats = logger.queue_stats
     except Exception as e:
         print(f"Logging setup error: {e}")
         # Fallback к стандартному логированию
@@ -58,6 +103,15 @@ def create_app(config_name='development'):
 
     # Инициализация расширений
     db.init_app(app)
+    with app.app_context():
+        configure_sqlite_engine(db.engine, app.config.get('SQLITE_PRAGMAS'))
+        if app.config['REQUEST_METRICS_ENABLED']:
+            request_metrics.instrument_engine(db.engine)
+        if app.config['METRICS_ENABLED']:
+            server_metrics.instrument_engine(db.engine)
+
+    # Статус "печатает" - в памяти (или Redis), без записи в БД
+    typing_store = create_typing_store(app.config, app.logger)
     
     login_manager = LoginManager()
     login_manager.init_app(app)
@@ -72,12 +126,23 @@ def create_app(config_name='development'):
     # Создание таблиц БД и пользователя admin по умолчанию
     with app.app_context():
         db.create_all()
+        run_migrations(db, app.logger)
         if not User.query.first():
             admin = User(username='admin', role='admin', first_name='Админ', last_name='Админов', department='ТП')
             admin.set_password('admin123')
             db.session.add(admin)
             db.session.commit()
             print("Создан пользователь admin / admin123")
+
+    # Фоновый сброс отметок присутствия в БД (в тестах - вручную через presence_tracker.flush)
+    # и пересчёт статистики (в тестах - при чтении, STATS_MAX_AGE = 0)
+    stats_service.max_age = app.config['STATS_MAX_AGE']
+    if not app.testing:
+        presence_tracker.start(app, db, User, app.config['PRESENCE_FLUSH_INTERVAL'])
+        preview_generator.start(app)
+        stats_service.start(app, db, app.config['STATS_REFRESH_INTERVAL'])
+        storage_reconciler.start(app, db, app.config['STORAGE_RECONCILE_INTERVAL'])
+        dicom_indexer.start(app, db, app.config['DICOM_INDEX_INTERVAL'])
     
     # ==================== УТИЛИТЫ ====================
     @app.context_processor
@@ -88,10 +153,41 @@ def create_app(config_name='development'):
             return dt + timedelta(hours=3)
         return dict(moscow_time=moscow_time)
     
+    # Замер запроса - первым before_request (загрузка пользователя тоже входит в замер)
+    if app.config['REQUEST_METRICS_ENABLED']:
+        @app.before_request
+        def start_request_timing():
+            request_metrics.start()
+
+        @app.after_request
+        def record_request_timing(response):
+            endpoint = f'{request.method} {request.endpoint or "<unmatched>"}'
+            slow = request_metrics.finish(endpoint, response.status_code, app.config['SLOW_REQUEST_THRESHOLD'])
+            if slow is not None:
+                app.logger.warning(f'Slow request: {endpoint} {slow["wall_ms"]} ms', extra={
+                    'category': 'api',
+                    'extra_data': {'endpoint': endpoint, 'path': request.path, 'status': response.status_code,
+                                   **slow},
+                })
+            return response
+
     @app.before_request
     def before_request():
         if current_user.is_authenticated:
+            # Только отметка в памяти - в БД пишет фоновый сброс трекера
             current_user.update_last_seen()
+
+    # Роли, которые видят все задачи (врач - только свои)
+    TASK_VIEWER_ROLES = ('physicist', 'admin')
+
+    def publish_task_event(event, task_id, doctor_id, exclude=None, **data):
+        """SSE-событие по задаче: врачу-создателю и всем физикам/админам"""
+        event_bus.publish(event, {'task_id': task_id, **data},
+                          user_ids=[int(doctor_id)], roles=TASK_VIEWER_ROLES, exclude=exclude)
+
+    def publish_unread(user_id, scope, **data):
+        """SSE-событие: у пользователя изменились непрочитанные (scope - 'task' или 'chat')"""
+        event_bus.publish('unread', {'scope': scope, **data}, user_ids=[user_id])
     
     # ==================== АВТОРИЗАЦИЯ ====================
     @app.route('/login', methods=['GET', 'POST'])
@@ -105,6 +201,7 @@ def create_app(config_name='development'):
             if user and user.check_password(form.password.data):
                 login_user(user, remember=True)
                 user.update_last_seen()
+                event_bus.broadcast('presence', {'user_id': user.id, 'is_online': True})
                 next_page = request.args.get('next')
                 app.logger.info(f'User {user.username} logged in', extra={'category': 'auth', 'user_id': user.id, 'username': user.username})
                 flash('Вы успешно вошли в систему', 'success')
@@ -119,7 +216,9 @@ def create_app(config_name='development'):
     @login_required
     def logout():
         username = current_user.username
+        user_id = current_user.id
         logout_user()
+        event_bus.broadcast('presence', {'user_id': user_id, 'is_online': False})
         app.logger.info(f'User {username} logged out', extra={'category': 'auth', 'username': username})
         flash('Вы вышли из системы', 'info')
         return redirect(url_for('login'))
@@ -184,6 +283,42 @@ def create_app(config_name='development'):
 
         return render_template('register.html', form=form)
     
+    # ==================== ПОТОК СОБЫТИЙ (SSE) ====================
+    @app.route('/api/events')
+    @login_required
+    def event_stream():
+        """Единый SSE-поток пользователя: unread, typing, task_updated, message, presence"""
+        subscription = event_bus.subscribe(current_user.id, current_user.role, app.config['SSE_MAX_STREAMS'],
+                                           app.config['SSE_MAX_STREAMS_PER_USER'])
+        if subscription is None:
+            # Потоки WSGI не должны уйти на SSE целиком: вкладка работает на опросах
+            # и переподключается через Retry-After (EventSource после 503 не переподключается сам)
+            return Response('Too many event streams', status=503, mimetype='text/plain',
+                            headers={'Retry-After': str(app.config['SSE_RETRY_AFTER'])})
+        heartbeat = app.config['SSE_HEARTBEAT']
+        max_duration = app.config['SSE_MAX_DURATION']
+
+        def generate():
+            try:
+                # Интервал переподключения EventSource (мс)
+                yield 'retry: 3000\n\n'
+                # Поток периодически закрываем - браузер переподключится сам, поток WSGI освободится
+                deadline = time.monotonic() + max_duration
+                while time.monotonic() < deadline:
+                    item = subscription.get(timeout=heartbeat)
+                    if item is None:
+                        yield ': ping\n\n'
+                        continue
+                    event, data = item
+                    yield f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+            finally:
+                event_bus.unsubscribe(subscription)
+
+        return Response(generate(), mimetype='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'  # nginx: не буферизовать поток
+        })
+
     # ==================== ГЛАВНАЯ СТРАНИЦА ====================
     @app.route('/')
     @login_required
@@ -210,48 +345,178 @@ def create_app(config_name='development'):
         return render_template('online_users.html')
 
     # ==================== API ЗАДАЧ ====================
+    def record_task_removal(task_id, doctor_id=None):
+        """
+        Оставляет tombstone для дельта-синхронизации; doctor_id - задача пропала только у этого врача.
+        Старые отметки удаляет фоновое обслуживание (StorageReconciler), не запрос
+        """
+        db.session.add(TaskTombstone(task_id=task_id, doctor_id=doctor_id))
+
+    def task_upload_dir(task_id):
+        """Каталог файлов задачи"""
+        return os.path.join(app.config['UPLOAD_FOLDER'], str(task_id))
+
+    def remove_task_upload_dirs(task_ids):
+        """Удалить файлы задач с диска (после commit - учёт места уже уменьшен)"""
+        for task_id in task_ids:
+            shutil.rmtree(task_upload_dir(task_id), ignore_errors=True)
+
+    def release_task_blobs(task_ids):
+        """Убрать ссылки файлов задач на блобы (до bulk delete TaskFile, без commit)"""
+        stored_filenames = [name for (name,) in db.session.query(TaskFile.stored_filename)
+                            .filter(TaskFile.task_id.in_(task_ids))]
+        for stored_filename in stored_filenames:
+            release_blob(stored_filename)
+        return stored_filenames
+
+    def delete_task_uploads(task_ids):
+        """Удалить незавершённые загрузки задач (без commit), вернуть их ID для discard_resumable"""
+        upload_ids = [upload_id for (upload_id,) in db.session.query(UploadSession.id)
+                      .filter(UploadSession.task_id.in_(task_ids))]
+        if upload_ids:
+            UploadSession.query.filter(UploadSession.id.in_(upload_ids)).delete(synchronize_session=False)
+        return upload_ids
+
+    def discard_uploads(upload_ids):
+        """Удалить временные файлы загрузок (после commit)"""
+        for upload_id in upload_ids:
+            discard_resumable(upload_id, app.config)
+
+    def collect_released_blobs(stored_filenames):
+        """Удалить блобы, на которые не осталось ссылок (после commit; остальное - фоновая сборка)"""
+        try:
+            collect_blobs(db, app.config['UPLOAD_FOLDER'], app.config['BLOB_GC_GRACE'], stored_filenames)
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f'Blob collection failed: {e}', extra={'category': 'files'})
+
+    def send_stored_file(directory, file, as_attachment=False):
+        """
+        Отдать файл (TaskFile / PersonalChatFile) из хранилища: ETag - SHA-256 содержимого,
+        у блоба нет расширения - MIME из записи или по исходному имени
+        """
+        return send_upload(
+            stored_file_path(app.config['UPLOAD_FOLDER'], directory, file.stored_filename),
+            app.config['UPLOAD_FOLDER'],
+            mimetype=file.mime_type or mimetypes.guess_type(file.original_filename)[0] or 'application/octet-stream',
+            download_name=file.original_filename,
+            etag=file.sha256,
+            as_attachment=as_attachment
+        )
+
+    def preview_file_type(file):
+        """Тип для превью: изображение или PDF (у PersonalChatFile нет is_pdf - по MIME)"""
+        if file.is_image:
+            return 'images'
+        if getattr(file, 'is_pdf', False) or file.mime_type == 'application/pdf':
+            return 'pdf'
+        return None
+
+    def queue_preview(directory, file):
+        """Создать превью нового файла в фоне (блоб уже на месте)"""
+        file_type = preview_file_type(file)
+        if file_type:
+            preview_generator.submit(stored_file_path(app.config['UPLOAD_FOLDER'], directory, file.stored_filename),
+                                     preview_key(directory, file.stored_filename, file.sha256), file_type)
+
+    def parse_cursor(value):
+        """
+        Курсор ?since= в наивное UTC-время, как datetime.utcnow() и столбцы БД.
+        Некорректный курсор - None (клиент получит полный список)
+        """
+        if not value:
+            return None
+        try:
+            since = datetime.fromisoformat(value)
+        except ValueError:
+            return None
+        if since.tzinfo is not None:
+            since = since.astimezone(timezone.utc).replace(tzinfo=None)
+        return since
+
+    def queue_dicom_index(task_files):
+        """Разбудить фоновую индексацию DICOM (после commit): заголовки читаются не в запросе"""
+        if any(f.is_dicom or f.is_archive for f in task_files):
+            dicom_indexer.notify()
+
+    def send_thumbnail(directory, file):
+        """Отдать превью файла; отсутствующее создаётся сейчас"""
+        file_type = preview_file_type(file)
+        if file_type is None:
+            abort(404)
+        upload_folder = app.config['UPLOAD_FOLDER']
+        key = preview_key(directory, file.stored_filename, file.sha256)
+        path = preview_path(upload_folder, key, app.config)
+        if not os.path.exists(path):
+            path = generate_preview(stored_file_path(upload_folder, directory, file.stored_filename),
+                                    key, file_type, upload_folder, app.config)
+        if path is None:
+            # Превью недоступно (нет Pillow, файл не читается) - изображение отдаётся как есть
+            if file_type == 'images':
+                return send_stored_file(directory, file)
+            abort(404)
+        name = os.path.basename(path)
+        return send_upload(path, upload_folder, mimetype=mimetypes.guess_type(name)[0] or 'image/jpeg',
+                           download_name=name, etag=name)
+
     @app.route('/api/tasks')
     @login_required
     def api_tasks():
-        if current_user.role == 'doctor':
-            # Врач видит только свои задачи
-            tasks = Task.query.filter_by(doctor_id=current_user.id).order_by(Task.created_at.desc()).all()
-        elif current_user.role == 'physicist':
-            # Физик видит все задачи
-            tasks = Task.query.order_by(Task.created_at.desc()).all()
-        else:
-            # Админ видит все задачи
-            tasks = Task.query.order_by(Task.created_at.desc()).all()
+        # ?since=<cursor> - только задачи, изменённые после курсора, плюс ID удалённых
+        since = parse_cursor(request.args.get('since'))
+        if since and since < datetime.utcnow() - app.config['TASKS_TOMBSTONE_RETENTION']:
+            since = None  # Tombstone'ы уже вычищены - только полная выгрузка
+
+        # Курсор фиксируем до чтения: правки, закоммиченные во время запроса, придут в следующей дельте
+        cursor = datetime.utcnow()
+
+        # Непрочитанные - из счётчиков task_unread одним запросом по ключу пользователя
+        unread_counts = TaskUnread.counts_for_user(current_user.id)
+
+        # Писал ли пользователь в чат - коррелированный EXISTS по индексу (task_id, sender_id):
+        # один поиск по индексу на задачу вместо соединения со всеми сообщениями и GROUP BY;
+        # врача и файлы подгружаем пачкой (selectinload) - без запросов на каждую задачу
+        has_sent_col = db.select(ChatMessage.id).where(
+            ChatMessage.task_id == Task.id,
+            ChatMessage.sender_id == current_user.id
+        ).exists()
+
+        query = db.session.query(Task, has_sent_col).options(
+            selectinload(Task.doctor),
+            selectinload(Task.files)
+        )
+
+        # Врач видит только свои задачи, физик и админ - все
+        visible = Task.doctor_id == current_user.id if current_user.role == 'doctor' else db.true()
+        query = query.filter(visible)
+
+        if since:
+            changed_after = since - timedelta(seconds=app.config['TASKS_SYNC_OVERLAP'])
+            query = query.filter(db.or_(Task.updated_at >= changed_after, Task.created_at >= changed_after))
+
+        rows = query.order_by(Task.created_at.desc()).all()
 
         result = []
-        active_chats_count = 0  # Считаем только задачи где пользователь является участником
-        
-        for task in tasks:
-            unread_count = ChatMessage.query.filter_by(
-                task_id=task.id,
-                receiver_id=current_user.id,
-                is_read=False
-            ).count()
+        stats = {
+            'total': 0,
+            'pending': 0,
+            'in_progress': 0,
+            'completed': 0,
+            'cancelled': 0,
+            'active_chats': 0  # Активные чаты только где пользователь участник
+        }
 
-            # Проверяем, является ли пользователь участником этого чата
+        for task, has_sent in rows:
             # Участник чата = врач-создатель ИЛИ любой, кто писал сообщения в чат
-            is_participant = False
-            
-            # Врач-создатель всегда участник
-            if task.doctor_id == current_user.id:
-                is_participant = True
-            else:
-                # Проверяем, писал ли пользователь сообщения в этот чат
-                message_count = ChatMessage.query.filter_by(
-                    task_id=task.id,
-                    sender_id=current_user.id
-                ).count()
-                if message_count > 0:
-                    is_participant = True
-            
+            is_participant = task.doctor_id == current_user.id or has_sent
+
             # Считаем активный чат только если пользователь участник и задача не завершена/не отменена
             if is_participant and task.status not in ['completed', 'cancelled']:
-                active_chats_count += 1
+                stats['active_chats'] += 1
+
+            stats['total'] += 1
+            if task.status in stats:
+                stats[task.status] += 1
 
             result.append({
                 'id': task.id,
@@ -265,7 +530,7 @@ def create_app(config_name='development'):
                 'doctor_full_name': task.doctor.get_full_name_with_dept(),  # Полное имя с отделением для title
                 'created_at': (task.created_at + timedelta(hours=3)).strftime('%d.%m.%Y %H:%M'),  # Формат даты как в оригинале
                 'updated_at': (task.updated_at + timedelta(hours=3)).strftime('%d.%m.%Y %H:%M') if task.updated_at else None,
-                'unread_count': unread_count,
+                'unread_count': unread_counts.get(task.id, 0),
                 # Файлы для отображения в карточке
                 'files': [
                     {
@@ -275,7 +540,8 @@ def create_app(config_name='development'):
                         'is_pdf': f.is_pdf,
                         'icon_class': f.get_icon_class(),
                         'download_url': f.download_url,
-                        'view_url': f.view_url if (f.is_image or f.is_pdf) else None
+                        'view_url': f.view_url if (f.is_image or f.is_pdf) else None,
+                        'thumb_url': f.thumb_url
                     }
                     for f in task.files
                 ],
@@ -291,17 +557,47 @@ def create_app(config_name='development'):
                 'pet_diagnostic': task.pet_diagnostic
             })
 
-        # Добавляем статистику по статусам
-        stats = {
-            'total': len(result),
-            'pending': sum(1 for t in result if t['status'] == 'pending'),
-            'in_progress': sum(1 for t in result if t['status'] == 'in_progress'),
-            'completed': sum(1 for t in result if t['status'] == 'completed'),
-            'cancelled': sum(1 for t in result if t['status'] == 'cancelled'),
-            'active_chats': active_chats_count  # Активные чаты только где пользователь участник
-        }
+        if not since:
+            return jsonify({'tasks': result, 'stats': stats, 'cursor': cursor.isoformat(), 'full': True})
+
+        # Дельта: статистику считаем агрегатом по всем видимым задачам (без загрузки строк)
+        participant = db.or_(
+            Task.doctor_id == current_user.id,
+            Task.id.in_(db.select(ChatMessage.task_id).where(ChatMessage.sender_id == current_user.id))
+        )
+        active_col = db.func.sum(db.case(
+            (participant & Task.status.notin_(['completed', 'cancelled']), 1),
+            else_=0
+        ))
+        stats = dict.fromkeys(stats, 0)
+        for status, count, active in db.session.query(Task.status, db.func.count(Task.id), active_col).filter(visible).group_by(Task.status):
+            stats['total'] += count
+            stats['active_chats'] += active or 0
+            if status in stats:
+                stats[status] = count
+
+        # Непрочитанные по всем задачам - отметка о прочтении не меняет updated_at
+        unread = unread_counts
+
+        # Удалённые задачи (и переназначенные на другого врача - для бывшего врача)
+        tombstones = TaskTombstone.query.filter(
+            TaskTombstone.deleted_at >= since - timedelta(seconds=app.config['TASKS_SYNC_OVERLAP'])
+        )
+        if current_user.role == 'doctor':
+            tombstones = tombstones.filter(db.or_(TaskTombstone.doctor_id.is_(None), TaskTombstone.doctor_id == current_user.id))
+        else:
+            tombstones = tombstones.filter(TaskTombstone.doctor_id.is_(None))
+        changed_ids = {t['id'] for t in result}
+        deleted = sorted({t.task_id for t in tombstones} - changed_ids)
 
-        return jsonify({'tasks': result, 'stats': stats})
+        return jsonify({
+            'tasks': result,
+            'deleted': deleted,
+            'unread': unread,
+            'stats': stats,
+            'cursor': cursor.isoformat(),
+            'full': False
+        })
     
     @app.route('/api/users/<role>')
     @login_required
@@ -332,11 +628,16 @@ def create_app(config_name='development'):
     @login_required
     def api_online_users():
         """Получить всех онлайн-пользователей, сгруппированных по отделениям"""
-        all_users = User.query.all()
+        # Онлайн по трекеру этого процесса или по уже сброшенному last_seen (другие воркеры)
+        cutoff = datetime.utcnow() - presence_tracker.online_window
+        candidates = User.query.filter(db.or_(
+            User.id.in_(presence_tracker.online_user_ids()),
+            User.last_seen >= cutoff
+        )).all()
 
         # Группируем по отделениям
         departments = {}
-        for user in all_users:
+        for user in candidates:
             if user.is_online():
                 dept = user.department
                 if dept not in departments:
@@ -348,7 +649,7 @@ def create_app(config_name='development'):
                     'role': user.get_role_display(),
                     'role_short': user.get_role_short(),
                     'department': user.department,
-                    'last_seen': (user.last_seen + timedelta(hours=3)).strftime('%H:%M') if user.last_seen else ''
+                    'last_seen': (user.last_activity + timedelta(hours=3)).strftime('%H:%M') if user.last_activity else ''
                 })
 
         # Сортируем отделения по названию
@@ -359,39 +660,9 @@ def create_app(config_name='development'):
     @app.route('/api/stats')
     def api_stats():
         """Получить статистику системы для GUI лаунчера (публичный endpoint)"""
-        from pathlib import Path
-        
-        # Пользователи
-        users_total = User.query.count()
-        users_online = sum(1 for u in User.query.all() if u.is_online())
-        
-        # Задачи по статусам
-        tasks_total = Task.query.count()
-        tasks_pending = Task.query.filter_by(status='pending').count()
-        tasks_in_progress = Task.query.filter_by(status='in_progress').count()
-        tasks_completed = Task.query.filter_by(status='completed').count()
-        tasks_cancelled = Task.query.filter_by(status='cancelled').count()
-        
-        # Сообщения
-        messages_total = ChatMessage.query.count()
-        today = datetime.utcnow().date()
-        messages_today = ChatMessage.query.filter(
-            db.func.date(ChatMessage.created_at) == today
-        ).count()
-        
-        # Файлы
-        files_total = TaskFile.query.count()
-        files_size = 0
-        try:
-            if getattr(sys, 'frozen', False):
-                uploads_dir = Path(sys.executable).parent / 'data' / 'uploads'
-            else:
-                uploads_dir = Path(__file__).parent.parent / 'data' / 'uploads'
-            
-            if uploads_dir.exists():
-                files_size = sum(f.stat().st_size for f in uploads_dir.rglob('*') if f.is_file())
-        except:
-            pass
+        # Снимок из памяти (stats.py) - без запросов к БД и обхода папки uploads (учёт места - storage.py)
+        stats = stats_service.get(db)
+        tasks_by_status = stats['tasks_by_status']
         
         # Время работы сервера (с момента запуска процесса)
         import psutil
@@ -404,28 +675,37 @@ def create_app(config_name='development'):
         
         return jsonify({
             'users': {
-                'total': users_total,
-                'online': users_online
+                'total': stats['total_users'],
+                'online': stats['users_online']
             },
             'tasks': {
-                'total': tasks_total,
-                'pending': tasks_pending,
-                'in_progress': tasks_in_progress,
-                'completed': tasks_completed,
-                'cancelled': tasks_cancelled
+                'total': stats['total_tasks'],
+                'pending': tasks_by_status.get('pending', 0),
+                'in_progress': tasks_by_status.get('in_progress', 0),
+                'completed': tasks_by_status.get('completed', 0),
+                'cancelled': tasks_by_status.get('cancelled', 0)
             },
             'messages': {
-                'total': messages_total,
-                'today': messages_today
+                'total': stats['total_messages'],
+                'today': stats['messages_today']
             },
             'files': {
-                'total': files_total,
-                'size_bytes': files_size
+                'total': stats['uploads_files'],
+                'size_bytes': stats['uploads_size'],
+                'by_directory': stats['storage_by_directory'],
+                'by_type': stats['storage_by_type']
             },
             'uptime': uptime
         })
 
 
+    @app.route('/metrics')
+    def metrics():
+        """Метрики сервера в формате Prometheus (публичный endpoint, без запросов к БД)"""
+        if not app.config['METRICS_ENABLED']:
+            abort(404)
+        return Response(server_metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
     @app.route('/api/task/<int:task_id>')
     @login_required
     def api_task(task_id):
@@ -597,41 +877,45 @@ def create_app(config_name='development'):
             task.title = f'Задача #{task.id}'
 
         # Обработка загруженных файлов
+        task_files = []
+        failed_files = []
         if 'files' in request.files:
-            upload_dir = os.path.join(app.config['UPLOAD_FOLDER'], str(task.id))
-            os.makedirs(upload_dir, exist_ok=True)
-            
             for file in request.files.getlist('files'):
                 if file and file.filename:
                     filename = secure_filename(file.filename)
                     if filename:
-                        import uuid
-                        unique_filename = f"{uuid.uuid4().hex}_{filename}"
-                        file_path = os.path.join(upload_dir, unique_filename)
-                        
                         try:
-                            file.save(file_path)
-                            file_size = os.path.getsize(file_path)
-                            ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+                            # Размер, SHA-256 и тип (по сигнатуре) считаются при приёме тела запроса;
+                            # одинаковое содержимое хранится один раз (blobstore.py)
+                            ingested = ingest_upload(file, app.config)
                             
                             task_file = TaskFile(
                                 task_id=task.id,
                                 uploader_id=current_user.id,
                                 original_filename=filename,
-                                stored_filename=unique_filename,
-                                file_size=file_size,
-                                is_image=ext in app.config['ALLOWED_IMAGE_EXTENSIONS'],
-                                is_pdf=ext in app.config['ALLOWED_PDF_EXTENSIONS'],
-                                is_dicom=ext in app.config['ALLOWED_DICOM_EXTENSIONS'],
-                                is_archive=ext in app.config['ALLOWED_ARCHIVE_EXTENSIONS']
+                                stored_filename=store_blob(ingested, app.config['UPLOAD_FOLDER']),
+                                file_size=ingested.size,
+                                mime_type=ingested.mime_type,
+                                sha256=ingested.sha256,
+                                is_image=ingested.is_image,
+                                is_pdf=ingested.is_pdf,
+                                is_dicom=ingested.is_dicom,
+                                is_archive=ingested.is_archive
                             )
                             db.session.add(task_file)
+                            queue_preview(str(task.id), task_file)
+                            task_files.append(task_file)
                         except Exception as e:
-                            print(f"Error uploading file {filename}: {e}")
+                            failed_files.append(filename)
+                            app.logger.warning(f'File {filename} not uploaded to new task #{task.id}: {e}', extra={'category': 'files', 'task_id': task.id, 'user_id': current_user.id, 'username': current_user.username})
 
         db.session.commit()
+        queue_dicom_index(task_files)
+        publish_task_event('task_updated', task.id, task.doctor_id)
         app.logger.info(f'Task #{task.id} created by {current_user.username}', extra={'category': 'tasks', 'task_id': task.id, 'user_id': current_user.id, 'username': current_user.username})
         flash('Задача успешно создана', 'success')
+        if failed_files:
+            flash(f'Не удалось загрузить файлы: {", ".join(failed_files)}', 'danger')
         return redirect(url_for('index'))
     
     @app.route('/update_task/<int:id>', methods=['POST'])
@@ -652,11 +936,85 @@ def create_app(config_name='development'):
                 task.completed_at = None
             task.updated_at = datetime.utcnow()
             db.session.commit()
+            publish_task_event('task_updated', task.id, task.doctor_id)
             flash('Статус задачи обновлен', 'success')
         
         return redirect(url_for('index'))
     
     # ==================== ЧАТ ====================
+    def mark_task_messages_read(task_id, user_id, after_id=None, up_to_id=None):
+        """
+        Отметить прочитанными сообщения задачи, адресованные пользователю, одним UPDATE
+        (только after_id < id <= up_to_id, если заданы) и поправить счётчик task_unread.
+        Без commit.
+
+        Returns:
+            Количество отмеченных сообщений
+        """
+        query = db.update(ChatMessage).where(
+            ChatMessage.task_id == task_id,
+            ChatMessage.receiver_id == user_id,
+            ChatMessage.is_read == False
+        )
+        if after_id is not None:
+            query = query.where(ChatMessage.id > after_id)
+        if up_to_id is not None:
+            query = query.where(ChatMessage.id <= up_to_id)
+        marked = db.session.execute(query.values(is_read=True), execution_options={'synchronize_session': False}).rowcount
+        if marked:
+            if after_id is None and up_to_id is None:
+                TaskUnread.reset(user_id, task_id)
+            else:
+                TaskUnread.decrement(user_id, task_id, marked)
+        return marked
+
+    def mark_chat_messages_read(chat_id, user_id, after_id=None, up_to_id=None):
+        """То же для личного чата: сообщения собеседника, счётчик personal_chat_unread"""
+        query = db.update(PersonalMessage).where(
+            PersonalMessage.chat_id == chat_id,
+            PersonalMessage.sender_id != user_id,
+            PersonalMessage.is_read == False
+        )
+        if after_id is not None:
+            query = query.where(PersonalMessage.id > after_id)
+        if up_to_id is not None:
+            query = query.where(PersonalMessage.id <= up_to_id)
+        marked = db.session.execute(query.values(is_read=True), execution_options={'synchronize_session': False}).rowcount
+        if marked:
+            if after_id is None and up_to_id is None:
+                PersonalChatUnread.reset(user_id, chat_id)
+            else:
+                PersonalChatUnread.decrement(user_id, chat_id, marked)
+        return marked
+
+    def message_cursor_args():
+        """Курсор истории из запроса: ?before_id, ?after_id (старое имя - last_id), ?limit <= MESSAGES_PER_PAGE"""
+        per_page = app.config['MESSAGES_PER_PAGE']
+        limit = max(1, min(request.args.get('limit', per_page, type=int), per_page))
+        before_id = request.args.get('before_id', type=int)
+        after_id = request.args.get('after_id', type=int)
+        if after_id is None:
+            after_id = request.args.get('last_id', type=int)
+        return before_id, after_id, limit
+
+    def message_page(query, model, before_id=None, after_id=None, limit=None):
+        """
+        Страница истории по курсору (keyset по id) в хронологическом порядке:
+        after_id - следующие limit сообщений после него, before_id - предыдущие limit
+        перед ним, без курсора - последние limit.
+
+        Returns:
+            (сообщения, есть ли ещё сообщения в направлении курсора)
+        """
+        limit = limit or app.config['MESSAGES_PER_PAGE']
+        if after_id is not None:
+            messages = query.filter(model.id > after_id).order_by(model.id.asc()).limit(limit + 1).all()
+            return messages[:limit], len(messages) > limit
+        if before_id is not None:
+            query = query.filter(model.id < before_id)
+        messages = query.order_by(model.id.desc()).limit(limit + 1).all()
+        return messages[:limit][::-1], len(messages) > limit
+
     @app.route('/task/<int:id>/chat')
     @login_required
     def chat(id):
@@ -687,42 +1045,90 @@ def create_app(config_name='development'):
             # Если физик - показываем врача-создателя
             chat_partner = task.doctor
 
-        messages = ChatMessage.query.filter_by(task_id=id).order_by(ChatMessage.created_at).all()
-
-        # Помечаем сообщения как прочитанные
-        for msg in messages:
-            if msg.receiver_id == current_user.id and not msg.is_read:
-                msg.is_read = True
+        # Помечаем прочитанным всё адресованное пользователю - без загрузки истории
+        marked = mark_task_messages_read(id, current_user.id)
         db.session.commit()
+        if marked:
+            message_hub.publish(('task', id))
+            publish_unread(current_user.id, 'task', task_id=id)
 
-        return render_template('chat.html', task=task, chat_partner=chat_partner, messages=messages)
+        messages, has_more = message_page(ChatMessage.query.filter_by(task_id=id), ChatMessage,
+                                          before_id=request.args.get('before', type=int))
+
+        return render_template('chat.html', task=task, chat_partner=chat_partner, messages=messages, has_more=has_more)
     
+    def long_poll(key, fetch):
+        """
+        Long-poll: при ?wait=<сек> и пустом результате fetch() держит запрос
+        до публикации в message_hub по ключу key или до таймаута.
+        fetch() должен закоммитить сессию, чтобы не держать соединение с БД во время ожидания.
+        """
+        wait = max(0.0, min(request.args.get('wait', 0, type=float), app.config['LONG_POLL_TIMEOUT']))
+        deadline = time.monotonic() + wait
+
+        version = message_hub.version(key)
+        result = fetch()
+        remaining = deadline - time.monotonic()
+        if result or remaining <= 0:
+            return result
+
+        if message_hub.waiting >= app.config['LONG_POLL_MAX_WAITING']:
+            # Ждущие long-poll заняли свою долю потоков WSGI - отвечаем сразу, клиент повторит позже
+            retry_after = str(app.config['LONG_POLL_RETRY_AFTER'])
+
+            @after_this_request
+            def add_retry_after(response):
+                response.headers['Retry-After'] = retry_after
+                return response
+            return result
+
+        waited = time.monotonic()
+        notified = message_hub.wait(key, version, remaining)
+        request_metrics.add_wait(time.monotonic() - waited)
+        if notified:
+            # Новое сообщение или отметка о прочтении - перечитываем один раз и отдаём как есть
+            result = fetch()
+        return result
+
     @app.route('/task/<int:id>/get_messages')
     @login_required
     def get_messages(id):
         task = Task.query.get_or_404(id)
-        last_id = request.args.get('last_id', 0, type=int)
-        
-        messages = ChatMessage.query.filter(
-            ChatMessage.task_id == id,
-            ChatMessage.id > last_id
-        ).order_by(ChatMessage.created_at.asc()).all()
-        
-        # Помечаем сообщения как прочитанные
-        for msg in messages:
-            if msg.receiver_id == current_user.id:
-                msg.is_read = True
-        db.session.commit()
-        
-        return jsonify([{
-            'id': m.id,
-            'content': m.content,
-            'sender_id': m.sender_id,
-            'sender_name': m.sender.username,
-            'created_at': (m.created_at + timedelta(hours=3)).strftime('%H:%M'),
-            'created_at_iso': (m.created_at + timedelta(hours=3)).isoformat(),
-            'is_read': m.is_read
-        } for m in messages])
+        before_id, after_id, limit = message_cursor_args()
+        # После commit current_user истекает - запоминаем ID заранее
+        user_id = current_user.id
+
+        def fetch():
+            messages, _ = message_page(ChatMessage.query.filter_by(task_id=id), ChatMessage,
+                                       before_id, after_id, limit)
+
+            # Новые сообщения помечаем прочитанными до последнего отданного (последняя
+            # страница - всё); подгрузка ранних страниц ничего не меняет
+            marked = 0
+            if before_id is None and messages:
+                up_to_id = messages[-1].id if after_id is not None else None
+                marked = mark_task_messages_read(id, user_id, after_id=after_id, up_to_id=up_to_id)
+
+            result = [{
+                'id': m.id,
+                'content': m.content,
+                'sender_id': m.sender_id,
+                'sender_name': m.sender.username,
+                'created_at': (m.created_at + timedelta(hours=3)).strftime('%H:%M'),
+                'created_at_iso': (m.created_at + timedelta(hours=3)).isoformat(),
+                'is_read': m.is_read or (marked > 0 and m.receiver_id == user_id)
+            } for m in messages]
+
+            db.session.commit()
+            if marked:
+                message_hub.publish(('task', id))
+                publish_unread(user_id, 'task', task_id=id)
+            return result
+
+        # Long-poll только для новых сообщений после курсора
+        if after_id is None:
+            return jsonify(fetch())
+        return jsonify(long_poll(('task', id), fetch))
     
     @app.route('/task/<int:id>/send_message', methods=['POST'])
     @login_required
@@ -762,11 +1168,15 @@ def create_app(config_name='development'):
             receiver_id=receiver_id
         )
         db.session.add(message)
+        TaskUnread.increment(receiver_id, id)
         
         # Обновляем updated_at задачи при отправке сообщения
         task.updated_at = datetime.utcnow()
         
         db.session.commit()
+        message_hub.publish(('task', id))
+        publish_task_event('message', id, task.doctor_id, scope='task', message_id=message.id, sender_id=current_user.id)
+        publish_unread(receiver_id, 'task', task_id=id)
         app.logger.info(f'Message sent in task #{id} by {current_user.username}', extra={'category': 'chat', 'task_id': id, 'user_id': current_user.id, 'username': current_user.username})
 
         return jsonify({
@@ -782,20 +1192,16 @@ def create_app(config_name='development'):
     @app.route('/unread_messages')
     @login_required
     def unread_messages():
-        tasks_with_unread = db.session.query(Task).join(ChatMessage).filter(
-            ChatMessage.receiver_id == current_user.id,
-            ChatMessage.is_read == False
-        ).distinct().all()
+        tasks_with_unread = db.session.query(Task, TaskUnread.count).join(
+            TaskUnread, TaskUnread.task_id == Task.id
+        ).filter(
+            TaskUnread.user_id == current_user.id,
+            TaskUnread.count > 0
+        ).all()
         
         result = []
-        for task in tasks_with_unread:
-            unread_count = ChatMessage.query.filter_by(
-                task_id=task.id,
-                receiver_id=current_user.id,
-                is_read=False
-            ).count()
-            
-            last_message = ChatMessage.query.filter_by(task_id=task.id).order_by(ChatMessage.created_at.desc()).first()
+        for task, unread_count in tasks_with_unread:
+            last_message = ChatMessage.query.filter_by(task_id=task.id).order_by(ChatMessage.id.desc()).first()
             
             result.append({
                 'task_id': task.id,
@@ -816,144 +1222,128 @@ def create_app(config_name='development'):
     @login_required
     def set_typing(id):
         data = request.get_json() or {}
-        
-        status = TypingStatus.query.filter_by(task_id=id, user_id=current_user.id).first()
-        if not status:
-            status = TypingStatus(
-                task_id=id,
-                user_id=current_user.id,
-                is_typing=data.get('is_typing', True)
-            )
-            db.session.add(status)
-        else:
-            status.is_typing = data.get('is_typing', True)
-            status.updated_at = datetime.utcnow()
-        
-        db.session.commit()
+        is_typing = bool(data.get('is_typing', True))
+
+        task = db.session.get(Task, id)
+        if not task:
+            return jsonify({'success': False}), 404
+
+        # Врач может печатать только в своих задачах (физики и админы - во всех)
+        if current_user.role == 'doctor' and current_user.id != task.doctor_id:
+            return jsonify({'error': 'Нет доступа', 'success': False}), 403
+
+        typing_store.set(('task', id), current_user.id, current_user.username, is_typing)
+        publish_task_event('typing', id, task.doctor_id, exclude=current_user.id, scope='task',
+                           user_id=current_user.id, username=current_user.username, is_typing=is_typing)
         return jsonify({'success': True})
     
     @app.route('/task/<int:id>/typing_status')
     @login_required
     def get_typing_status(id):
-        task = Task.query.get(id)
-        if not task:
-            return jsonify({'is_typing': False, 'username': None})
-
-        # Получаем всех пользователей, которые могут участвовать в чате задачи
-        # Врач-создатель + все физики + все админы (так как все они имеют доступ к задачам)
-        participant_ids = {task.doctor_id}
-        physicists = User.query.filter_by(role='physicist').all()
-        for p in physicists:
-            participant_ids.add(p.id)
-        admins = User.query.filter_by(role='admin').all()
-        for a in admins:
-            participant_ids.add(a.id)
-
-        # Исключаем текущего пользователя
-        participant_ids.discard(current_user.id)
-
-        # Ищем всех, кто печатает в этой задаче
-        typing_statuses = TypingStatus.query.filter(
-            TypingStatus.task_id == id,
-            TypingStatus.user_id.in_(participant_ids),
-            TypingStatus.is_typing == True
-        ).all()
+        # Участники проверяются при записи - здесь только чтение из памяти
+        typing_users = typing_store.get_typing(('task', id), exclude_user_id=current_user.id)
+        if typing_users:
+            # Показываем первого, кто печатает
+            return jsonify({'is_typing': True, 'username': typing_users[0][1]})
+        return jsonify({'is_typing': False, 'username': None})
 
-        is_typing = False
-        username = None
-
-        for status in typing_statuses:
-            # Проверяем не истекло ли время (5 секунд)
-            if datetime.utcnow() - status.updated_at < timedelta(seconds=5):
-                is_typing = True
-                typing_user = User.query.get(status.user_id)
-                username = typing_user.username if typing_user else None
-                break  # Показываем первого, кто печатает
+    # ==================== ЛИЧНЫЕ ЧАТЫ ====================
+    def personal_chat_filter(user_id):
+        """Условие: пользователь - участник личного чата"""
+        return db.or_(PersonalChat.user1_id == user_id, PersonalChat.user2_id == user_id)
+
+    def chat_partner_id_col(user_id):
+        """ID собеседника в строке personal_chat"""
+        return db.case((PersonalChat.user1_id == user_id, PersonalChat.user2_id), else_=PersonalChat.user1_id)
+
+    def personal_chat_rows(user_id, changed_after=None):
+        """
+        Строки списка чатов одним запросом: (чат, собеседник, последнее сообщение,
+        его первый файл, непрочитанные) - последнее сообщение по personal_chat.last_message_id
+        """
+        partner = aliased(User)
+        last_message = aliased(PersonalMessage)
+        first_file = aliased(PersonalChatFile)
+        first_file_id = db.select(db.func.min(PersonalChatFile.id)).where(
+            PersonalChatFile.message_id == last_message.id
+        ).correlate(last_message).scalar_subquery()
+
+        query = db.session.query(
+            PersonalChat, partner, last_message, first_file, db.func.coalesce(PersonalChatUnread.count, 0)
+        ).join(
+            partner, partner.id == chat_partner_id_col(user_id)
+        ).outerjoin(
+            last_message, last_message.id == PersonalChat.last_message_id
+        ).outerjoin(
+            first_file, first_file.id == first_file_id
+        ).outerjoin(
+            PersonalChatUnread,
+            (PersonalChatUnread.chat_id == PersonalChat.id) & (PersonalChatUnread.user_id == user_id)
+        ).filter(personal_chat_filter(user_id))
+
+        if changed_after:
+            query = query.filter(PersonalChat.updated_at >= changed_after)
+        return query.order_by(PersonalChat.updated_at.desc()).all()
+
+    def personal_file_type(file):
+        """Тип файла личного чата для превью последнего сообщения: image / pdf / archive / other"""
+        ext = file.original_filename.rsplit('.', 1)[-1].lower() if '.' in file.original_filename else ''
+        if file.is_image:
+            return 'image'
+        if ext == 'pdf' or file.mime_type == 'application/pdf':
+            return 'pdf'
+        if ext in app.config['ALLOWED_ARCHIVE_EXTENSIONS']:
+            return 'archive'
+        return 'other'
+
+    def serialize_chat_row(chat, partner, last_message, first_file, unread_count):
+        """Карточка чата для страницы списка и /api/chats/list"""
+        last_message_content = None
+        last_message_is_file = False
+        last_message_file_type = 'other'
+        last_message_date = None
+        last_message_time = None
+
+        if last_message:
+            # Конвертируем время в МСК (UTC+3)
+            moscow_time = last_message.created_at + timedelta(hours=3)
+            last_message_date = moscow_time.strftime('%d.%m')
+            last_message_time = moscow_time.strftime('%H:%M')
+
+            if first_file:
+                last_message_is_file = True
+                last_message_file_type = personal_file_type(first_file)
+                prefix = {'image': 'Изображение', 'pdf': 'PDF', 'archive': 'Архив'}.get(last_message_file_type, 'Файл')
+                last_message_content = f"{prefix}: {first_file.original_filename}"
             else:
-                # Сбрасываем истёкший статус
-                status.is_typing = False
-                db.session.commit()
-
-        return jsonify({'is_typing': is_typing, 'username': username})
+                last_message_content = last_message.content
+
+        return {
+            'chat_id': chat.id,
+            'partner_id': partner.id,
+            'partner_username': partner.username,
+            'partner_full_name': partner.get_full_name_full(),
+            'partner_full_name_short': partner.get_full_name(),  # Сокращённое имя для мобильных (Фамилия И.О.)
+            'partner_role': partner.get_role_display(),
+            'partner_department': partner.department,
+            'partner_is_online': partner.is_online(),
+            'unread_count': unread_count,
+            'last_message_content': last_message_content,
+            'last_message_is_file': last_message_is_file,
+            'last_message_file_type': last_message_file_type,
+            'last_message_date': last_message_date,
+            'last_message_time': last_message_time
+        }
 
-    # ==================== ЛИЧНЫЕ ЧАТЫ ====================
     @app.route('/chats')
     @login_required
     def chats_list():
         """Список личных чатов пользователя"""
-        from datetime import timezone
-        
-        user_chats = PersonalChat.query.filter(
-            (PersonalChat.user1_id == current_user.id) | 
-            (PersonalChat.user2_id == current_user.id)
-        ).order_by(PersonalChat.updated_at.desc()).all()
-        
-        chats_data = []
-        for chat in user_chats:
-            partner_id = chat.user2_id if chat.user1_id == current_user.id else chat.user1_id
-            partner = User.query.get(partner_id)
-            
-            unread_count = PersonalMessage.query.filter_by(
-                chat_id=chat.id,
-                is_read=False
-            ).filter(PersonalMessage.sender_id != current_user.id).count()
-            
-            last_message = PersonalMessage.query.filter_by(
-                chat_id=chat.id
-            ).order_by(PersonalMessage.created_at.desc()).first()
-            
-            # Определяем тип последнего сообщения
-            last_message_content = None
-            last_message_is_file = False
-            last_message_file_type = 'other'
-            last_message_date = None
-            last_message_time = None
-            
-            if last_message:
-                # Конвертируем время в МСК (UTC+3)
-                moscow_time = last_message.created_at + timedelta(hours=3)
-                last_message_date = moscow_time.strftime('%d.%m')
-                last_message_time = moscow_time.strftime('%H:%M')
-                
-                if last_message.files:
-                    last_message_is_file = True
-                    file = last_message.files[0]
-                    if file.is_image:
-                        last_message_file_type = 'image'
-                        last_message_content = f"Изображение: {file.original_filename}"
-                    elif file.is_pdf:
-                        last_message_file_type = 'pdf'
-                        last_message_content = f"PDF: {file.original_filename}"
-                    elif file.is_archive:
-                        last_message_file_type = 'archive'
-                        last_message_content = f"Архив: {file.original_filename}"
-                    else:
-                        last_message_file_type = 'other'
-                        last_message_content = f"Файл: {file.original_filename}"
-                else:
-                    last_message_content = last_message.content
-            
-            # Сокращённое имя для мобильных (Фамилия И.О.)
-            partner_full_name_short = partner.get_full_name()
-            
-            chats_data.append({
-                'chat_id': chat.id,
-                'partner_id': partner.id,
-                'partner_username': partner.username,
-                'partner_full_name': partner.get_full_name_full(),
-                'partner_full_name_short': partner_full_name_short,
-                'partner_role': partner.get_role_display(),
-                'partner_department': partner.department,
-                'partner_is_online': partner.is_online(),
-                'unread_count': unread_count,
-                'last_message_content': last_message_content,
-                'last_message_is_file': last_message_is_file,
-                'last_message_file_type': last_message_file_type,
-                'last_message_date': last_message_date,
-                'last_message_time': last_message_time
-            })
-        
-        return render_template('chats_list.html', chats=chats_data)
+        # Курсор для последующих дельта-запросов /api/chats/list?since=
+        cursor = datetime.utcnow()
+        chats_data = [serialize_chat_row(*row) for row in personal_chat_rows(current_user.id)]
+
+        return render_template('chats_list.html', chats=chats_data, chats_cursor=cursor.isoformat())
     
     @app.route('/chat/<int:chat_id>')
     @login_required
@@ -970,15 +1360,17 @@ def create_app(config_name='development'):
         partner_id = chat.user2_id if chat.user1_id == current_user.id else chat.user1_id
         partner = User.query.get(partner_id)
         
-        messages = PersonalMessage.query.filter_by(chat_id=chat_id).order_by(PersonalMessage.created_at).all()
-        
-        # Помечаем сообщения как прочитанные
-        for msg in messages:
-            if msg.sender_id != current_user.id and not msg.is_read:
-                msg.is_read = True
+        # Помечаем прочитанными сообщения собеседника - без загрузки истории
+        marked = mark_chat_messages_read(chat_id, current_user.id)
         db.session.commit()
+        if marked:
+            message_hub.publish(('chat', chat_id))
+            publish_unread(current_user.id, 'chat', chat_id=chat_id)
+
+        messages, has_more = message_page(PersonalMessage.query.filter_by(chat_id=chat_id), PersonalMessage,
+                                          before_id=request.args.get('before', type=int))
         
-        return render_template('personal_chat.html', chat=chat, partner=partner, messages=messages)
+        return render_template('personal_chat.html', chat=chat, partner=partner, messages=messages, has_more=has_more)
     
     @app.route('/chat/start/<int:user_id>', methods=['POST'])
     @login_required
@@ -1027,28 +1419,21 @@ def create_app(config_name='development'):
 
             # Сохраняем файл
             original_filename = secure_filename(file.filename)
-            stored_filename = f"{uuid.uuid4().hex}_{original_filename}"
-            upload_folder = os.path.join(app.config['UPLOAD_FOLDER'], 'personal_chats')
-            
-            # Создаём директорию
-            os.makedirs(upload_folder, exist_ok=True)
-            file_path = os.path.join(upload_folder, stored_filename)
-
-            file.save(file_path)
 
-            # Получаем размер и тип файла
-            file_size = os.path.getsize(file_path)
-            mime_type = file.content_type
+            # Размер, SHA-256 и тип (по сигнатуре, а не по Content-Type клиента) - за один проход
+            ingested = ingest_upload(file, app.config)
 
             # Создаём запись о файле
             chat_file = PersonalChatFile(
                 original_filename=original_filename,
-                stored_filename=stored_filename,
-                file_size=file_size,
-                mime_type=mime_type,
-                is_image=mime_type.startswith('image/') if mime_type else original_filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.webp'))
+                stored_filename=store_blob(ingested, app.config['UPLOAD_FOLDER']),
+                file_size=ingested.size,
+                mime_type=ingested.mime_type or file.content_type,
+                sha256=ingested.sha256,
+                is_image=ingested.is_image
             )
             db.session.add(chat_file)
+            queue_preview(PERSONAL_CHATS_DIRECTORY, chat_file)
             db.session.commit()
 
             return jsonify({
@@ -1058,9 +1443,12 @@ def create_app(config_name='development'):
                     'original_filename': chat_file.original_filename,
                     'file_size_mb': chat_file.file_size_mb,
                     'is_image': chat_file.is_image,
-                    'url': f'/chat/{chat_id}/files/{chat_file.id}/download'
+                    'url': f'/chat/{chat_id}/files/{chat_file.id}/download',
+                    'thumb_url': f'/chat/{chat_id}/files/{chat_file.id}/thumb' if chat_file.is_image else None
                 }
             })
+        except RequestEntityTooLarge as e:
+            return jsonify({'error': e.description}), 413
         except Exception as e:
             print(f"Upload error: {str(e)}")
             return jsonify({'error': str(e)}), 500
@@ -1076,14 +1464,7 @@ def create_app(config_name='development'):
             return redirect(url_for('chats_list'))
         
         chat_file = PersonalChatFile.query.get_or_404(file_id)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'personal_chats', chat_file.stored_filename)
-        
-        return send_from_directory(
-            os.path.dirname(file_path),
-            os.path.basename(file_path),
-            as_attachment=True,
-            download_name=chat_file.original_filename
-        )
+        return send_stored_file(PERSONAL_CHATS_DIRECTORY, chat_file, as_attachment=True)
     
     @app.route('/chat/<int:chat_id>/files/<int:file_id>/view')
     @login_required
@@ -1096,12 +1477,19 @@ def create_app(config_name='development'):
             return redirect(url_for('chats_list'))
         
         chat_file = PersonalChatFile.query.get_or_404(file_id)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'personal_chats', chat_file.stored_filename)
-        
-        return send_from_directory(
-            os.path.dirname(file_path),
-            os.path.basename(file_path)
-        )
+        return send_stored_file(PERSONAL_CHATS_DIRECTORY, chat_file)
+
+    @app.route('/chat/<int:chat_id>/files/<int:file_id>/thumb')
+    @login_required
+    def thumb_personal_file(chat_id, file_id):
+        """Превью изображения или первой страницы PDF"""
+        chat = PersonalChat.query.get_or_404(chat_id)
+
+        if chat.user1_id != current_user.id and chat.user2_id != current_user.id:
+            abort(403)
+
+        chat_file = PersonalChatFile.query.get_or_404(file_id)
+        return send_thumbnail(PERSONAL_CHATS_DIRECTORY, chat_file)
 
     @app.route('/chat/<int:chat_id>/send_message', methods=['POST'])
     @login_required
@@ -1126,6 +1514,9 @@ def create_app(config_name='development'):
             content=content
         )
         db.session.add(message)
+        db.session.flush()  # Нужен message.id для файлов и last_message_id
+        partner_id = chat.user2_id if chat.user1_id == current_user.id else chat.user1_id
+        PersonalChatUnread.increment(partner_id, chat_id)
 
         # Привязываем файлы к сообщению
         for file_id in file_ids:
@@ -1133,9 +1524,14 @@ def create_app(config_name='development'):
             if chat_file:
                 chat_file.message_id = message.id
         
-        # Обновляем время чата
+        # Обновляем время чата и последнее сообщение (для списка чатов)
         chat.updated_at = datetime.utcnow()
+        chat.last_message_id = message.id
         db.session.commit()
+        message_hub.publish(('chat', chat_id))
+        event_bus.publish('message', {'scope': 'chat', 'chat_id': chat_id, 'message_id': message.id,
+                                      'sender_id': current_user.id}, user_ids=[current_user.id, partner_id])
+        publish_unread(partner_id, 'chat', chat_id=chat_id)
 
         return jsonify({
             'success': True,
@@ -1150,7 +1546,8 @@ def create_app(config_name='development'):
                         'original_filename': f.original_filename,
                         'file_size_mb': f.file_size_mb,
                         'is_image': f.is_image,
-                        'url': f'/chat/{chat_id}/files/{f.id}/view' if f.is_image else f'/chat/{chat_id}/files/{f.id}/download'
+                        'url': f'/chat/{chat_id}/files/{f.id}/view' if f.is_image else f'/chat/{chat_id}/files/{f.id}/download',
+                        'thumb_url': f'/chat/{chat_id}/files/{f.id}/thumb' if f.is_image else None
                     }
                     for f in message.files
                 ]
@@ -1167,46 +1564,58 @@ def create_app(config_name='development'):
         if chat.user1_id != current_user.id and chat.user2_id != current_user.id:
             return jsonify({'error': 'Нет доступа'}), 403
 
-        last_id = request.args.get('last_id', 0, type=int)
-
-        messages = PersonalMessage.query.filter_by(
-            chat_id=chat_id
-        ).filter(
-            PersonalMessage.id > last_id
-        ).order_by(PersonalMessage.created_at).all()
-
-        result = []
-        for msg in messages:
-            # Помечаем сообщения как прочитанные, если они адресованы текущему пользователю
-            if msg.sender_id != current_user.id and not msg.is_read:
-                msg.is_read = True
-            
-            result.append({
-                'id': msg.id,
-                'content': msg.content,
-                'sender_id': msg.sender_id,
-                'is_read': msg.is_read,
-                'created_at_iso': (msg.created_at + timedelta(hours=3)).isoformat(),
-                'files': [
-                    {
-                        'id': f.id,
-                        'original_filename': f.original_filename,
-                        'file_size_mb': f.file_size_mb,
-                        'is_image': f.is_image,
-                        'url': f'/chat/{chat_id}/files/{f.id}/view' if f.is_image else f'/chat/{chat_id}/files/{f.id}/download'
-                    }
-                    for f in msg.files
-                ]
-            })
+        before_id, after_id, limit = message_cursor_args()
+        # После commit current_user истекает - запоминаем ID заранее
+        user_id = current_user.id
+
+        def fetch():
+            messages, _ = message_page(PersonalMessage.query.filter_by(chat_id=chat_id), PersonalMessage,
+                                       before_id, after_id, limit)
+
+            # Новые сообщения собеседника помечаем прочитанными до последнего отданного
+            marked = 0
+            if before_id is None and messages:
+                up_to_id = messages[-1].id if after_id is not None else None
+                marked = mark_chat_messages_read(chat_id, user_id, after_id=after_id, up_to_id=up_to_id)
+
+            result = []
+            for msg in messages:
+                result.append({
+                    'id': msg.id,
+                    'content': msg.content,
+                    'sender_id': msg.sender_id,
+                    'is_read': msg.is_read or (marked > 0 and msg.sender_id != user_id),
+                    'created_at_iso': (msg.created_at + timedelta(hours=3)).isoformat(),
+                    'files': [
+                        {
+                            'id': f.id,
+                            'original_filename': f.original_filename,
+                            'file_size_mb': f.file_size_mb,
+                            'is_image': f.is_image,
+                            'url': f'/chat/{chat_id}/files/{f.id}/view' if f.is_image else f'/chat/{chat_id}/files/{f.id}/download',
+                            'thumb_url': f'/chat/{chat_id}/files/{f.id}/thumb' if f.is_image else None
+                        }
+                        for f in msg.files
+                    ]
+                })
 
-        db.session.commit()
-        return jsonify(result)
+            db.session.commit()
+            if marked:
+                message_hub.publish(('chat', chat_id))
+                publish_unread(user_id, 'chat', chat_id=chat_id)
+            return result
+
+        # Long-poll только для новых сообщений после курсора
+        if after_id is None:
+            return jsonify(fetch())
+        return jsonify(long_poll(('chat', chat_id), fetch))
     
     @app.route('/chat/<int:chat_id>/typing', methods=['POST'])
     @login_required
     def personal_chat_typing(chat_id):
         """Статус 'печатает' для личного чата"""
         data = request.get_json() or {}
+        is_typing = bool(data.get('is_typing', True))
 
         chat = PersonalChat.query.get_or_404(chat_id)
 
@@ -1214,19 +1623,12 @@ def create_app(config_name='development'):
         if chat.user1_id != current_user.id and chat.user2_id != current_user.id:
             return jsonify({'error': 'Нет доступа', 'success': False}), 403
 
-        status = TypingStatus.query.filter_by(chat_id=chat_id, user_id=current_user.id).first()
-        if not status:
-            status = TypingStatus(
-                chat_id=chat_id,
-                user_id=current_user.id,
-                is_typing=data.get('is_typing', True)
-            )
-            db.session.add(status)
-        else:
-            status.is_typing = data.get('is_typing', True)
-            status.updated_at = datetime.utcnow()
+        typing_store.set(('chat', chat_id), current_user.id, current_user.username, is_typing)
 
-        db.session.commit()
+        partner_id = chat.user2_id if chat.user1_id == current_user.id else chat.user1_id
+        event_bus.publish('typing', {'scope': 'chat', 'chat_id': chat_id, 'user_id': current_user.id,
+                                     'username': current_user.username,
+                                     'is_typing': is_typing}, user_ids=[partner_id])
         return jsonify({'success': True})
 
     @app.route('/chat/<int:chat_id>/typing_status')
@@ -1239,24 +1641,11 @@ def create_app(config_name='development'):
         if chat.user1_id != current_user.id and chat.user2_id != current_user.id:
             return jsonify({'is_typing': False, 'username': None})
 
-        # Определяем ID собеседника
-        partner_id = chat.user2_id if chat.user1_id == current_user.id else chat.user1_id
-
-        status = TypingStatus.query.filter_by(chat_id=chat_id, user_id=partner_id).first()
-        is_typing = False
-        username = None
-
-        if status and status.is_typing:
-            # Проверяем не истекло ли время (5 секунд)
-            if datetime.utcnow() - status.updated_at < timedelta(seconds=5):
-                is_typing = True
-                partner = User.query.get(partner_id)
-                username = partner.username if partner else None
-            else:
-                status.is_typing = False
-                db.session.commit()
-
-        return jsonify({'is_typing': is_typing, 'username': username})
+        # Записывать в ключ чата могут только его участники, поэтому "печатает кто-то кроме меня" = собеседник
+        typing_users = typing_store.get_typing(('chat', chat_id), exclude_user_id=current_user.id)
+        if typing_users:
+            return jsonify({'is_typing': True, 'username': typing_users[0][1]})
+        return jsonify({'is_typing': False, 'username': None})
 
     @app.route('/chat/<int:chat_id>/mark_read/<int:message_id>', methods=['POST'])
     @login_required
@@ -1268,9 +1657,12 @@ def create_app(config_name='development'):
             return jsonify({'error': 'Нет доступа'}), 403
         
         message = PersonalMessage.query.get_or_404(message_id)
-        if message.sender_id != current_user.id:
+        if message.sender_id != current_user.id and not message.is_read:
             message.is_read = True
+            PersonalChatUnread.decrement(current_user.id, message.chat_id)
             db.session.commit()
+            message_hub.publish(('chat', chat_id))
+            publish_unread(current_user.id, 'chat', chat_id=chat_id)
         
         return jsonify({'success': True, 'is_read': True})
     
@@ -1284,16 +1676,12 @@ def create_app(config_name='development'):
             return jsonify({'error': 'Нет доступа'}), 403
         
         # Помечаем все непрочитанные сообщения от другого пользователя как прочитанные
-        messages = PersonalMessage.query.filter_by(
-            chat_id=chat_id,
-            is_read=False
-        ).filter(PersonalMessage.sender_id != current_user.id).all()
-        
-        for msg in messages:
-            msg.is_read = True
-        
+        marked = mark_chat_messages_read(chat_id, current_user.id)
         db.session.commit()
-        return jsonify({'success': True, 'marked_count': len(messages)})
+        if marked:
+            message_hub.publish(('chat', chat_id))
+            publish_unread(current_user.id, 'chat', chat_id=chat_id)
+        return jsonify({'success': True, 'marked_count': marked})
     
     @app.route('/chat/<int:chat_id>/get_message_status/<int:message_id>')
     @login_required
@@ -1330,23 +1718,8 @@ def create_app(config_name='development'):
     @login_required
     def get_personal_chats_unread_count():
         """Получить количество непрочитанных личных сообщений"""
-        # Получаем все чаты пользователя
-        user_chats = PersonalChat.query.filter(
-            (PersonalChat.user1_id == current_user.id) | 
-            (PersonalChat.user2_id == current_user.id)
-        ).all()
-        
-        chat_ids = [chat.id for chat in user_chats]
-        
-        if not chat_ids:
-            return jsonify({'total_unread': 0})
-        
-        # Считаем непрочитанные сообщения от других пользователей
-        total_unread = PersonalMessage.query.filter(
-            PersonalMessage.chat_id.in_(chat_ids),
-            PersonalMessage.sender_id != current_user.id,
-            PersonalMessage.is_read == False
-        ).count()
+        # Сумма счётчиков пользователя - по первичному ключу, без подсчёта сообщений
+        total_unread = PersonalChatUnread.total_for_user(current_user.id)
         
         return jsonify({'total_unread': total_unread})
 
@@ -1354,69 +1727,33 @@ def create_app(config_name='development'):
     @login_required
     def api_chats_list():
         """Получить список чатов для real-time обновления"""
-        user_chats = PersonalChat.query.filter(
-            (PersonalChat.user1_id == current_user.id) | 
-            (PersonalChat.user2_id == current_user.id)
-        ).order_by(PersonalChat.updated_at.desc()).all()
-        
-        chats_data = []
-        for chat in user_chats:
-            partner_id = chat.user2_id if chat.user1_id == current_user.id else chat.user1_id
-            partner = User.query.get(partner_id)
-            
-            unread_count = PersonalMessage.query.filter_by(
-                chat_id=chat.id,
-                is_read=False
-            ).filter(PersonalMessage.sender_id != current_user.id).count()
-            
-            last_message = PersonalMessage.query.filter_by(
-                chat_id=chat.id
-            ).order_by(PersonalMessage.created_at.desc()).first()
-            
-            # Определяем тип последнего сообщения
-            last_message_content = None
-            last_message_is_file = False
-            last_message_file_type = 'other'
-            last_message_date = None
-            last_message_time = None
-            
-            if last_message:
-                # Конвертируем время в МСК (UTC+3)
-                moscow_time = last_message.created_at + timedelta(hours=3)
-                last_message_date = moscow_time.strftime('%d.%m')
-                last_message_time = moscow_time.strftime('%H:%M')
-                
-                if last_message.files:
-                    last_message_is_file = True
-                    file = last_message.files[0]
-                    if file.is_image:
-                        last_message_file_type = 'image'
-                        last_message_content = f"Изображение: {file.original_filename}"
-                    elif file.is_pdf:
-                        last_message_file_type = 'pdf'
-                        last_message_content = f"PDF: {file.original_filename}"
-                    elif file.is_archive:
-                        last_message_file_type = 'archive'
-                        last_message_content = f"Архив: {file.original_filename}"
-                    else:
-                        last_message_file_type = 'other'
-                        last_message_content = f"Файл: {file.original_filename}"
-                else:
-                    last_message_content = last_message.content
-            
-            chats_data.append({
-                'chat_id': chat.id,
-                'partner_id': partner.id,
-                'partner_is_online': partner.is_online(),
-                'unread_count': unread_count,
-                'last_message_content': last_message_content,
-                'last_message_is_file': last_message_is_file,
-                'last_message_file_type': last_message_file_type,
-                'last_message_date': last_message_date,
-                'last_message_time': last_message_time
-            })
-        
-        return jsonify(chats_data)
+        # ?since=<cursor> - только чаты с новыми сообщениями после курсора,
+        # непрочитанные и онлайн-статус - компактными картами по всем чатам
+        since = parse_cursor(request.args.get('since'))
+
+        # Курсор фиксируем до чтения: сообщения, закоммиченные во время запроса, придут в следующей дельте
+        cursor = datetime.utcnow()
+        user_id = current_user.id
+
+        if not since:
+            chats_data = [serialize_chat_row(*row) for row in personal_chat_rows(user_id)]
+            return jsonify({'chats': chats_data, 'cursor': cursor.isoformat(), 'full': True})
+
+        changed_after = since - timedelta(seconds=app.config['TASKS_SYNC_OVERLAP'])
+        chats_data = [serialize_chat_row(*row) for row in personal_chat_rows(user_id, changed_after)]
+
+        partner = aliased(User)
+        partners = db.session.query(PersonalChat.id, partner).join(
+            partner, partner.id == chat_partner_id_col(user_id)
+        ).filter(personal_chat_filter(user_id)).all()
+
+        return jsonify({
+            'chats': chats_data,
+            'unread': PersonalChatUnread.counts_for_user(user_id),
+            'online': {chat_id: chat_partner.is_online() for chat_id, chat_partner in partners},
+            'cursor': cursor.isoformat(),
+            'full': False
+        })
 
     # ==================== ФАЙЛЫ ====================
     @app.route('/task/<int:id>/files')
@@ -1424,6 +1761,14 @@ def create_app(config_name='development'):
     def get_files(id):
         task = Task.query.get_or_404(id)
         files = TaskFile.query.filter_by(task_id=id).all()
+
+        # ?modality=CT&series=<SeriesInstanceUID>&study=<StudyInstanceUID> - только файлы с такими DICOM
+        conditions = instance_filter(id, request.args.get('modality'), request.args.get('series'),
+                                     request.args.get('study'))
+        if len(conditions) > 1:
+            matching = {file_id for (file_id,) in db.session.query(DicomInstance.task_file_id)
+                        .filter(*conditions).distinct()}
+            files = [f for f in files if f.id in matching]
         
         result = []
         for f in files:
@@ -1438,6 +1783,9 @@ def create_app(config_name='development'):
                 'is_pdf': f.is_pdf,
                 'download_url': f.download_url,
                 'view_url': f.view_url,
+                'thumb_url': f.thumb_url,
+                'is_dicom': f.is_dicom,
+                'is_archive': f.is_archive,
                 'icon_class': f.get_icon_class()
             })
         
@@ -1453,6 +1801,7 @@ def create_app(config_name='development'):
         return jsonify({
             'files': result,
             'stats': stats,
+            'series': summarize_series(db, conditions),
             'task_title': task.title
         })
     
@@ -1460,20 +1809,19 @@ def create_app(config_name='development'):
     @login_required
     def download_file(id, file_id):
         file = TaskFile.query.get_or_404(file_id)
-        upload_dir = os.path.join(app.config['UPLOAD_FOLDER'], str(id))
-        return send_from_directory(
-            upload_dir,
-            file.stored_filename,
-            as_attachment=True,
-            download_name=file.original_filename
-        )
+        return send_stored_file(str(id), file, as_attachment=True)
     
     @app.route('/task/<int:id>/files/<int:file_id>/view')
     @login_required
     def view_file(id, file_id):
         file = TaskFile.query.get_or_404(file_id)
-        upload_dir = os.path.join(app.config['UPLOAD_FOLDER'], str(id))
-        return send_from_directory(upload_dir, file.stored_filename)
+        return send_stored_file(str(id), file)
+
+    @app.route('/task/<int:id>/files/<int:file_id>/thumb')
+    @login_required
+    def thumb_file(id, file_id):
+        file = TaskFile.query.get_or_404(file_id)
+        return send_thumbnail(str(id), file)
     
     @app.route('/task/<int:id>/files/<int:file_id>', methods=['DELETE'])
     @login_required
@@ -1487,13 +1835,25 @@ def create_app(config_name='development'):
         if current_user.role != 'admin' and file.uploader_id != current_user.id:
             return jsonify({'error': 'Нет прав на удаление', 'success': False}), 403
         
-        # Удаляем файл с диска
+        # Блоб удаляется после commit, если ссылок не осталось; файл старого формата - сразу
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], str(id), file.stored_filename)
-        if os.path.exists(file_path):
+        stored_filename = file.stored_filename
+        if is_blob_name(stored_filename):
+            release_blob(stored_filename)
+        elif os.path.exists(file_path):
+            remove_previews(app.config['UPLOAD_FOLDER'], preview_key(str(id), stored_filename, file.sha256))
+            StorageUsage.subtract(TASKS_DIRECTORY, read_file_type(file_path, file.stored_filename, app.config),
+                                  os.path.getsize(file_path))
             os.remove(file_path)
         
+        # Обновляем updated_at задачи, чтобы дельта /api/tasks подхватила новый список файлов
+        file.task.updated_at = datetime.utcnow()
+        doctor_id = file.task.doctor_id
+        DicomInstance.query.filter_by(task_file_id=file.id).delete()
         db.session.delete(file)
         db.session.commit()
+        collect_released_blobs([stored_filename])
+        publish_task_event('task_updated', id, doctor_id)
         
         return jsonify({'success': True})
     
@@ -1505,10 +1865,8 @@ def create_app(config_name='development'):
         if 'files' not in request.files:
             return jsonify({'error': 'Нет файлов', 'success': False}), 400
 
-        upload_dir = os.path.join(app.config['UPLOAD_FOLDER'], str(id))
-        os.makedirs(upload_dir, exist_ok=True)
-
         uploaded = []
+        task_files = []
         errors = []
 
         for file in request.files.getlist('files'):
@@ -1520,39 +1878,188 @@ def create_app(config_name='development'):
                 errors.append(f'Недопустимое имя файла')
                 continue
 
-            unique_filename = f"{uuid.uuid4().hex}_{filename}"
-            file_path = os.path.join(upload_dir, unique_filename)
-
             try:
-                file.save(file_path)
-                file_size = os.path.getsize(file_path)
-                ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+                ingested = ingest_upload(file, app.config)
 
                 task_file = TaskFile(
                     task_id=id,
                     uploader_id=current_user.id,
                     original_filename=filename,
-                    stored_filename=unique_filename,
-                    file_size=file_size,
-                    is_image=ext in app.config['ALLOWED_IMAGE_EXTENSIONS'],
-                    is_pdf=ext in app.config['ALLOWED_PDF_EXTENSIONS'],
-                    is_dicom=ext in app.config['ALLOWED_DICOM_EXTENSIONS'],
-                    is_archive=ext in app.config['ALLOWED_ARCHIVE_EXTENSIONS']
+                    stored_filename=store_blob(ingested, app.config['UPLOAD_FOLDER']),
+                    file_size=ingested.size,
+                    mime_type=ingested.mime_type,
+                    sha256=ingested.sha256,
+                    is_image=ingested.is_image,
+                    is_pdf=ingested.is_pdf,
+                    is_dicom=ingested.is_dicom,
+                    is_archive=ingested.is_archive
                 )
                 db.session.add(task_file)
+                db.session.flush()  # ID файла для ответа
+                queue_preview(str(id), task_file)
+                task_files.append(task_file)
                 uploaded.append({'id': task_file.id, 'filename': filename})
+            except RequestEntityTooLarge as e:
+                errors.append(e.description)
             except Exception as e:
                 errors.append(f'Ошибка загрузки {filename}: {str(e)}')
 
         # Обновляем updated_at задачи при добавлении файла
         task.updated_at = datetime.utcnow()
         db.session.commit()
+        queue_dicom_index(task_files)
+        publish_task_event('task_updated', id, task.doctor_id)
 
         return jsonify({
             'success': len(errors) == 0,
             'uploaded_files': uploaded,
             'errors': errors
         })
+
+    # Загрузка частями с возобновлением (большие серии DICOM, архивы):
+    # POST /task/<id>/uploads -> PUT /uploads/<upload_id>?offset=N (тело - байты части) -> POST .../finalize
+    def upload_session_or_404(upload_id):
+        upload = db.session.get(UploadSession, upload_id)
+        if upload is None or upload.user_id != current_user.id:
+            abort(404)
+        return upload
+
+    @app.route('/task/<int:id>/uploads', methods=['POST'])
+    @login_required
+    def start_upload(id):
+        Task.query.get_or_404(id)
+        data = request.get_json(silent=True) or {}
+        filename = secure_filename(data.get('filename') or '')
+        size = data.get('size')
+        if not filename:
+            return jsonify({'error': 'Недопустимое имя файла', 'success': False}), 400
+        if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+            return jsonify({'error': 'Не указан размер файла', 'success': False}), 400
+        limit = app.config['UPLOAD_RESUMABLE_MAX_FILE_SIZE']
+        if size > limit:
+            return jsonify({'error': f'Файл {filename} больше допустимого ({limit // (1024 * 1024)} МБ)',
+                            'success': False}), 413
+
+        upload = UploadSession(id=create_resumable_file(app.config), task_id=id, user_id=current_user.id,
+                               filename=filename, size=size)
+        db.session.add(upload)
+        db.session.commit()
+        return jsonify({'success': True, 'chunk_size': app.config['UPLOAD_RESUMABLE_CHUNK_SIZE'],
+                        **upload.to_dict()}), 201
+
+    @app.route('/uploads/<upload_id>', methods=['GET'])
+    @login_required
+    def upload_status(upload_id):
+        """Сколько байт уже принято - с этого смещения клиент продолжает после обрыва"""
+        return jsonify({'success': True, **upload_session_or_404(upload_id).to_dict()})
+
+    @app.route('/uploads/<upload_id>', methods=['PUT'])
+    @login_required
+    def upload_chunk(upload_id):
+        upload = upload_session_or_404(upload_id)
+        if upload.finalizing:
+            return jsonify({'error': 'Загрузка уже завершается', 'success': False, **upload.to_dict()}), 409
+        offset = request.args.get('offset', type=int)
+        if offset != upload.received:
+            return jsonify({'error': 'Неверное смещение', 'success': False, **upload.to_dict()}), 409
+
+        error, status = None, 200
+        try:
+            # Тело пишется в файл блоками по мере приёма, в памяти - не больше блока
+            write_chunk(upload_id, offset, request.stream, upload.size - offset, app.config)
+        except UploadBusy:
+            return jsonify({'error': 'Часть уже принимается', 'success': False, **upload.to_dict()}), 409
+        except RequestEntityTooLarge as e:
+            error, status = e.description, 413
+        except ClientDisconnected:
+            error, status = 'Соединение прервано', 400
+
+        # Принятое до обрыва сохраняется: размер файла - смещение для продолжения
+        upload.received = os.path.getsize(resumable_path(app.config, upload_id))
+        upload.updated_at = datetime.utcnow()
+        db.session.commit()
+        if error:
+            return jsonify({'error': error, 'success': False, **upload.to_dict()}), status
+        return jsonify({'success': True, **upload.to_dict()})
+
+    @app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+    @login_required
+    def finalize_upload(upload_id):
+        upload = upload_session_or_404(upload_id)
+        if upload.received != upload.size:
+            return jsonify({'error': 'Файл принят не полностью', 'success': False, **upload.to_dict()}), 409
+        task = db.session.get(Task, upload.task_id)
+        if task is None:
+            db.session.delete(upload)
+            db.session.commit()
+            discard_resumable(upload_id, app.config)
+            abort(404)
+
+        # Сессия занимается условным UPDATE: из параллельных или повторных finalize файл
+        # переносит только тот, чей UPDATE изменил строку; зависшее завершение занимается заново
+        now = datetime.utcnow()
+        claimed = db.session.execute(
+            db.update(UploadSession)
+            .where(UploadSession.id == upload_id, db.or_(
+                UploadSession.status.is_(None), UploadSession.status == 'uploading',
+                UploadSession.updated_at < now - app.config['UPLOAD_FINALIZE_TIMEOUT']))
+            .values(status='finalizing', updated_at=now)
+        ).rowcount
+        db.session.commit()
+        if not claimed:
+            return jsonify({'error': 'Загрузка уже завершается', 'success': False}), 409
+
+        try:
+            ingested = finish_resumable(upload_id, upload.filename, upload.size, app.config)
+            task_file = TaskFile(
+                task_id=task.id,
+                uploader_id=current_user.id,
+                original_filename=upload.filename,
+                # Принятый файл остаётся на месте до commit - при ошибке finalize можно повторить
+                stored_filename=store_blob(ingested, app.config['UPLOAD_FOLDER'], keep_source=True),
+                file_size=ingested.size,
+                mime_type=ingested.mime_type,
+                sha256=ingested.sha256,
+                is_image=ingested.is_image,
+                is_pdf=ingested.is_pdf,
+                is_dicom=ingested.is_dicom,
+                is_archive=ingested.is_archive
+            )
+            db.session.add(task_file)
+            db.session.delete(upload)
+            task.updated_at = datetime.utcnow()
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            db.session.execute(
+                db.update(UploadSession).where(UploadSession.id == upload_id).values(status='uploading')
+            )
+            db.session.commit()
+            app.logger.error(f'Finalizing upload {upload_id} failed: {e}',
+                             extra={'category': 'files', 'task_id': task.id, 'user_id': current_user.id})
+            return jsonify({'error': 'Не удалось сохранить файл, повторите завершение загрузки',
+                            'success': False}), 500
+
+        discard_resumable(upload_id, app.config)
+        queue_preview(str(task.id), task_file)
+        queue_dicom_index([task_file])
+        publish_task_event('task_updated', task.id, task.doctor_id)
+        app.logger.info(f'File {task_file.original_filename} ({task_file.file_size} bytes) uploaded in chunks to task #{task.id}',
+                        extra={'category': 'files', 'task_id': task.id, 'user_id': current_user.id})
+
+        return jsonify({'success': True, 'file': {'id': task_file.id, 'filename': task_file.original_filename,
+                                                  'file_size_mb': task_file.file_size_mb}})
+
+    @app.route('/uploads/<upload_id>', methods=['DELETE'])
+    @login_required
+    def cancel_upload(upload_id):
+        upload = upload_session_or_404(upload_id)
+        if upload.finalizing:
+            return jsonify({'error': 'Загрузка уже завершается', 'success': False}), 409
+        db.session.delete(upload)
+        db.session.commit()
+        discard_resumable(upload_id, app.config)
+        return jsonify({'success': True})
     
     # ==================== АДМИН ПАНЕЛЬ ====================
     @app.route('/admin')
@@ -1562,40 +2069,8 @@ def create_app(config_name='development'):
             flash('Доступ запрещен', 'danger')
             return redirect(url_for('index'))
 
-        # Статистика
-        total_users = User.query.count()
-        total_tasks = Task.query.count()
-        total_messages = ChatMessage.query.count()
-        total_files = TaskFile.query.count()
-
-        # Статистика по статусам задач
-        tasks_by_status = db.session.query(
-            Task.status,
-            db.func.count(Task.id)
-        ).group_by(Task.status).all()
-
-        # Статистика по ролям пользователей
-        users_by_role = db.session.query(
-            User.role,
-            db.func.count(User.id)
-        ).group_by(User.role).all()
-
-        # Активные чаты (задачи с сообщениями за последние 7 дней)
-        seven_days_ago = datetime.utcnow() - timedelta(days=7)
-        active_chats = db.session.query(Task).join(ChatMessage).filter(
-            ChatMessage.created_at >= seven_days_ago
-        ).distinct().count()
-
-        # Статистика личных чатов
-        total_personal_chats = PersonalChat.query.count()
-        active_personal_chats = db.session.query(PersonalChat).join(PersonalMessage).filter(
-            PersonalMessage.created_at >= seven_days_ago
-        ).distinct().count()
-        total_personal_messages = PersonalMessage.query.count()
-
-        # Статистика файлов
-        total_file_size = db.session.query(db.func.sum(TaskFile.file_size)).scalar() or 0
-        total_file_size_mb = round(total_file_size / (1024 * 1024), 2)
+        # Статистика - снимок из памяти (stats.py)
+        stats = stats_service.get(db)
 
         # Последние задачи (с последними изменениями - создание или редактирование)
         # Сортируем по updated_at если есть, иначе по created_at
@@ -1610,17 +2085,17 @@ def create_app(config_name='development'):
         recent_users = User.query.order_by(User.created_at.desc()).limit(5).all()
 
         return render_template('admin.html',
-                             total_users=total_users,
-                             total_tasks=total_tasks,
-                             total_messages=total_messages,
-                             total_files=total_files,
-                             total_file_size_mb=total_file_size_mb,
-                             tasks_by_status=dict(tasks_by_status),
-                             users_by_role=dict(users_by_role),
-                             active_chats=active_chats,
-                             total_personal_chats=total_personal_chats,
-                             active_personal_chats=active_personal_chats,
-                             total_personal_messages=total_personal_messages,
+                             total_users=stats['total_users'],
+                             total_tasks=stats['total_tasks'],
+                             total_messages=stats['total_messages'],
+                             total_files=stats['total_files'],
+                             total_file_size_mb=round(stats['total_file_size'] / (1024 * 1024), 2),
+                             tasks_by_status=stats['tasks_by_status'],
+                             users_by_role=stats['users_by_role'],
+                             active_chats=stats['active_chats'],
+                             total_personal_chats=stats['total_personal_chats'],
+                             active_personal_chats=stats['active_personal_chats'],
+                             total_personal_messages=stats['total_personal_messages'],
                              recent_tasks=recent_tasks,
                              recent_users=recent_users)
     
@@ -1630,80 +2105,35 @@ def create_app(config_name='development'):
         if current_user.role != 'admin':
             return jsonify({'error': 'Доступ запрещен'}), 403
 
-        # Статистика
-        total_users = User.query.count()
-        total_tasks = Task.query.count()
-        total_messages = ChatMessage.query.count()
-        total_files = TaskFile.query.count()
-
-        # Статистика по статусам задач
-        tasks_by_status = db.session.query(
-            Task.status,
-            db.func.count(Task.id)
-        ).group_by(Task.status).all()
-
-        # Статистика по ролям пользователей
-        users_by_role = db.session.query(
-            User.role,
-            db.func.count(User.id)
-        ).group_by(User.role).all()
-
-        # Активные чаты задач (7 дней)
-        seven_days_ago = datetime.utcnow() - timedelta(days=7)
-        active_chats = db.session.query(Task).join(ChatMessage).filter(
-            ChatMessage.created_at >= seven_days_ago
-        ).distinct().count()
-
-        # Статистика личных чатов
-        total_personal_chats = PersonalChat.query.count()
-        active_personal_chats = db.session.query(PersonalChat).join(PersonalMessage).filter(
-            PersonalMessage.created_at >= seven_days_ago
-        ).distinct().count()
-        total_personal_messages = PersonalMessage.query.count()
-
-        # Статистика файлов
-        total_file_size = db.session.query(db.func.sum(TaskFile.file_size)).scalar() or 0
-        
-        # Группировка по типам файлов
-        all_files = TaskFile.query.all()
-        files_by_type_dict = {}
-        for f in all_files:
-            if f.is_image:
-                ftype = 'images'
-            elif f.is_pdf:
-                ftype = 'pdf'
-            elif f.is_dicom:
-                ftype = 'dicom'
-            elif f.is_archive:
-                ftype = 'archives'
-            else:
-                ftype = 'other'
-            
-            if ftype not in files_by_type_dict:
-                files_by_type_dict[ftype] = {'count': 0, 'size': 0}
-            files_by_type_dict[ftype]['count'] += 1
-            files_by_type_dict[ftype]['size'] += f.file_size
-        
-        files_by_type = [
-            {'type': k, 'count': v['count'], 'size_mb': round(v['size'] / (1024 * 1024), 2)}
-            for k, v in files_by_type_dict.items()
-        ]
+        # Статистика - снимок из памяти (stats.py)
+        stats = stats_service.get(db)
 
         return jsonify({
-            'total_users': total_users,
-            'total_tasks': total_tasks,
-            'total_messages': total_messages,
-            'total_files': total_files,
-            'total_file_size_mb': round(total_file_size / (1024 * 1024), 2),
-            'tasks_by_status': dict(tasks_by_status),
-            'users_by_role': dict(users_by_role),
-            'active_chats': active_chats,
-            'total_personal_chats': total_personal_chats,
-            'active_personal_chats': active_personal_chats,
-            'total_personal_messages': total_personal_messages,
-            'files_by_type': files_by_type
+            'total_users': stats['total_users'],
+            'total_tasks': stats['total_tasks'],
+            'total_messages': stats['total_messages'],
+            'total_files': stats['total_files'],
+            'total_file_size_mb': round(stats['total_file_size'] / (1024 * 1024), 2),
+            'tasks_by_status': stats['tasks_by_status'],
+            'users_by_role': stats['users_by_role'],
+            'active_chats': stats['active_chats'],
+            'total_personal_chats': stats['total_personal_chats'],
+            'active_personal_chats': stats['active_personal_chats'],
+            'total_personal_messages': stats['total_personal_messages'],
+            'files_by_type': stats['files_by_type'],
+            'updated_at': stats['updated_at'].isoformat()
         })
     
+    @app.route('/admin/api/request_metrics')
+    @login_required
+    def admin_api_request_metrics():
+        if current_user.role != 'admin':
+            return jsonify({'error': 'Доступ запрещен'}), 403
+
+        # Время обработки по endpoint с запуска процесса, самые затратные - первыми
+        sort_by = request.args.get('sort', 'total_ms')
+        return jsonify(request_metrics.snapshot(sort_by))
+
     @app.route('/admin/api/users')
     @login_required
     def admin_api_users():
@@ -1725,7 +2155,7 @@ def create_app(config_name='development'):
                 'full_name': user.get_full_name(),
                 'department': user.department,
                 'created_at': (user.created_at + timedelta(hours=3)).strftime('%d.%m.%Y %H:%M'),
-                'last_seen': (user.last_seen + timedelta(hours=3)).strftime('%d.%m.%Y %H:%M') if user.last_seen else 'Никогда',
+                'last_seen': (user.last_activity + timedelta(hours=3)).strftime('%d.%m.%Y %H:%M') if user.last_activity else 'Никогда',
                 'is_online': user.is_online()
             })
 
@@ -1824,7 +2254,11 @@ def create_app(config_name='development'):
         task.description = request.form.get('description', task.description)
         task.status = request.form.get('status', task.status)
         task.priority = request.form.get('priority', task.priority)
-        task.doctor_id = request.form.get('doctor_id', task.doctor_id)
+        old_doctor_id = task.doctor_id
+        new_doctor_id = request.form.get('doctor_id', task.doctor_id)
+        if str(new_doctor_id) != str(task.doctor_id):
+            record_task_removal(task.id, doctor_id=task.doctor_id)
+        task.doctor_id = new_doctor_id
         task.physicist_id = request.form.get('physicist_id', task.physicist_id)
         
         # Обновляем поля исследования
@@ -1867,6 +2301,9 @@ def create_app(config_name='development'):
             task.completed_at = None
 
         db.session.commit()
+        publish_task_event('task_updated', task.id, task.doctor_id)
+        if str(old_doctor_id) != str(task.doctor_id):
+            publish_task_event('task_updated', task.id, old_doctor_id, deleted=True)
         flash(f'Задача #{task.id} обновлена', 'success')
         return redirect(url_for('admin_tasks'))
     
@@ -1880,10 +2317,21 @@ def create_app(config_name='development'):
         
         # Удаляем сообщения и файлы
         ChatMessage.query.filter_by(task_id=id).delete()
+        released = release_task_blobs([id])
+        DicomInstance.query.filter_by(task_id=id).delete()
         TaskFile.query.filter_by(task_id=id).delete()
+        TaskUnread.delete_for(scope_ids=[id])
+        uploads = delete_task_uploads([id])
+        subtract_directory(task_upload_dir(id), TASKS_DIRECTORY, app.config)
         
+        doctor_id = task.doctor_id
         db.session.delete(task)
+        record_task_removal(id)
         db.session.commit()
+        remove_task_upload_dirs([id])
+        discard_uploads(uploads)
+        collect_released_blobs(released)
+        publish_task_event('task_updated', id, doctor_id, deleted=True)
         
         flash(f'Задача #{task.id} удалена', 'success')
         return redirect(url_for('admin_tasks'))
@@ -1902,6 +2350,8 @@ def create_app(config_name='development'):
             return jsonify({'error': 'Не выбрано задач', 'success': False}), 400
 
         tasks = Task.query.filter(Task.id.in_(task_ids)).all()
+        # Врачи до изменения - им тоже нужно событие (задача могла уйти к другому врачу)
+        affected = [(task.id, task.doctor_id) for task in tasks]
 
         if action == 'change_status':
             new_status = data.get('new_status')
@@ -1916,20 +2366,38 @@ def create_app(config_name='development'):
         elif action == 'change_doctor':
             new_doctor = data.get('new_doctor')
             for task in tasks:
+                if str(task.doctor_id) != str(new_doctor):
+                    record_task_removal(task.id, doctor_id=task.doctor_id)
                 task.doctor_id = new_doctor
                 task.updated_at = datetime.utcnow()
 
         elif action == 'delete':
             # Удаляем сообщения и файлы
+            released = release_task_blobs(task_ids)
+            DicomInstance.query.filter(DicomInstance.task_id.in_(task_ids)).delete(synchronize_session=False)
             for task in tasks:
                 ChatMessage.query.filter_by(task_id=task.id).delete()
                 TaskFile.query.filter_by(task_id=task.id).delete()
+                subtract_directory(task_upload_dir(task.id), TASKS_DIRECTORY, app.config)
+                record_task_removal(task.id)
+            TaskUnread.delete_for(scope_ids=task_ids)
+            uploads = delete_task_uploads(task_ids)
             
             Task.query.filter(Task.id.in_(task_ids)).delete(synchronize_session=False)
             db.session.commit()
+            remove_task_upload_dirs([task_id for task_id, _ in affected])
+            discard_uploads(uploads)
+            collect_released_blobs(released)
+            for task_id, doctor_id in affected:
+                publish_task_event('task_updated', task_id, doctor_id, deleted=True)
             return jsonify({'success': True, 'deleted_count': len(task_ids)})
 
         db.session.commit()
+        for task_id, doctor_id in affected:
+            publish_task_event('task_updated', task_id, doctor_id)
+        if action == 'change_doctor' and data.get('new_doctor'):
+            for task_id, _ in affected:
+                publish_task_event('task_updated', task_id, data.get('new_doctor'))
         return jsonify({'success': True, 'updated_count': len(tasks)})
 
     @app.route('/admin/tasks/mass_delete', methods=['POST'])
@@ -1983,8 +2451,11 @@ def create_app(config_name='development'):
             flash('Нельзя удалить последнего администратора', 'danger')
             return redirect(url_for('admin_users'))
         
+        TaskUnread.delete_for(user_id=user.id)
+        PersonalChatUnread.delete_for(user_id=user.id)
         db.session.delete(user)
         db.session.commit()
+        presence_tracker.forget(user.id)
         
         flash(f'Пользователь {user.username} удален', 'success')
         return redirect(url_for('admin_users'))
@@ -1994,6 +2465,14 @@ def create_app(config_name='development'):
     def page_not_found(e):
         return render_template('404.html'), 404
     
+    @app.errorhandler(413)
+    def request_entity_too_large(e):
+        # Лимит запроса или файла (uploads.py) - приём прерван до конца передачи
+        if request.endpoint == 'create_task':
+            flash(e.description, 'danger')
+            return redirect(url_for('index'))
+        return jsonify({'error': e.description, 'success': False}), 413
+    
     @app.errorhandler(500)
     def internal_server_error(e):
         return render_template('500.html'), 500
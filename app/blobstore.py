@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Task-Chat - Хранилище файлов по содержимому (content-addressed)
+Загруженный файл хранится один раз: UPLOAD_FOLDER/blobs/<sha[:2]>/<sha256>, а
+TaskFile.stored_filename / PersonalChatFile.stored_filename содержат его SHA-256.
+Таблица file_blob ведёт счётчик ссылок; блоб без ссылок удаляется после commit
+(или фоновой сборкой), если его не трогали дольше BLOB_GC_GRACE секунд.
+
+Файлы, загруженные до хранилища (stored_filename = '<uuid>_<имя>'), остаются в
+каталогах задач и personal_chats.
+"""
+
+import os
+import re
+import shutil
+import threading
+import time
+from typing import Iterable, List, Optional
+
+try:
+    from .models import FileBlob, StorageUsage
+    from .previews import remove_previews
+except ImportError:
+    from models import FileBlob, StorageUsage
+    from previews import remove_previews
+
+
+BLOBS_DIRECTORY = 'blobs'
+BLOB_NAME_RE = re.compile(r'^[0-9a-f]{64}$')
+
+# Проверка "файл есть / перенести" и "ссылок нет / удалить" не должны перемешиваться
+_fs_lock = threading.Lock()
+
+
+def is_blob_name(stored_filename: str) -> bool:
+    return bool(BLOB_NAME_RE.match(stored_filename or ''))
+
+
+def blob_path(upload_folder, sha256: str) -> str:
+    return os.path.join(upload_folder, BLOBS_DIRECTORY, sha256[:2], sha256)
+
+
+def stored_file_path(upload_folder, directory: str, stored_filename: str) -> str:
+    """Путь к файлу на диске: блоб или файл старого формата в каталоге directory"""
+    if is_blob_name(stored_filename):
+        return blob_path(upload_folder, stored_filename)
+    return os.path.join(upload_folder, directory, stored_filename)
+
+
+def store_blob(ingested, upload_folder, keep_source: bool = False) -> str:
+    """
+    Положить принятый файл (uploads.IngestedFile) в хранилище и добавить ссылку (без commit)
+
+    Args:
+        keep_source: не удалять принятый файл, а связать блоб с ним жёсткой ссылкой - при откате
+            транзакции его можно завершить повторно; удаляет его вызывающий после commit, а блоб
+            без строки file_blob убирает collect_orphan_blobs
+
+    Returns:
+        stored_filename (SHA-256 содержимого)
+    """
+    sha256 = ingested.sha256
+    FileBlob.acquire(sha256, ingested.size, ingested.file_type)
+    path = blob_path(upload_folder, sha256)
+    with _fs_lock:
+        if os.path.exists(path):
+            # Такое содержимое уже есть - копию не храним; mtime защищает блоб от сборки
+            os.utime(path)
+            if not keep_source:
+                os.remove(ingested.path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if not keep_source:
+                os.replace(ingested.path, path)
+            else:
+                try:
+                    os.link(ingested.path, path)
+                except OSError:
+                    shutil.copyfile(ingested.path, path)  # ФС без жёстких ссылок
+            StorageUsage.add(BLOBS_DIRECTORY, ingested.file_type, ingested.size)
+    return sha256
+
+
+def release_blob(stored_filename: str):
+    """Убрать ссылку на блоб (без commit); файлы старого формата пропускаются"""
+    if is_blob_name(stored_filename):
+        FileBlob.release(stored_filename)
+
+
+def _recently_touched(path, grace: float) -> bool:
+    try:
+        return time.time() - os.stat(path).st_mtime < grace
+    except FileNotFoundError:
+        return False
+
+
+def collect_blobs(db, upload_folder, grace: float, sha256s: Optional[Iterable[str]] = None) -> List[str]:
+    """
+    Удалить блобы без ссылок, не тронутые дольше grace секунд
+
+    Args:
+        sha256s: только эти блобы (после удаления ссылок), иначе - все с refcount = 0
+    """
+    query = db.session.query(FileBlob.sha256, FileBlob.size, FileBlob.file_type).filter(FileBlob.refcount <= 0)
+    if sha256s is not None:
+        sha256s = [sha256 for sha256 in set(sha256s) if is_blob_name(sha256)]
+        if not sha256s:
+            return []
+        query = query.filter(FileBlob.sha256.in_(sha256s))
+
+    reclaimed = []
+    for sha256, size, file_type in query.all():
+        path = blob_path(upload_folder, sha256)
+        if _recently_touched(path, grace):
+            continue
+        # Условное удаление: ссылка, добавленная после выборки, сохраняет строку и файл
+        deleted = db.session.execute(
+            db.delete(FileBlob).where(FileBlob.sha256 == sha256, FileBlob.refcount <= 0)
+        ).rowcount
+        db.session.commit()
+        if not deleted:
+            continue
+        with _fs_lock:
+            # Загрузка того же содержимого между commit и удалением файла обновила бы
+            # mtime (store_blob) или уже закоммитила новую ссылку
+            if _recently_touched(path, grace) or \
+                    db.session.query(FileBlob.sha256).filter_by(sha256=sha256).first() is not None:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+        remove_previews(upload_folder, sha256)
+        StorageUsage.subtract(BLOBS_DIRECTORY, file_type, size)
+        db.session.commit()
+        reclaimed.append(sha256)
+    return reclaimed
+
+
+def collect_orphan_blobs(db, upload_folder, grace: float) -> List[str]:
+    """
+    Удалить файлы блобов без строки в file_blob (загрузка, чья транзакция откатилась).
+    Место вычтет сверка учёта (storage.reconcile_storage), которая выполняется следом.
+    """
+    root = os.path.join(upload_folder, BLOBS_DIRECTORY)
+    try:
+        shards = [entry.path for entry in os.scandir(root) if entry.is_dir(follow_symlinks=False)]
+    except FileNotFoundError:
+        return []
+    on_disk = {}
+    for shard in shards:
+        for entry in os.scandir(shard):
+            if entry.is_file(follow_symlinks=False) and is_blob_name(entry.name):
+                on_disk[entry.name] = entry.path
+    known = {sha256 for (sha256,) in db.session.query(FileBlob.sha256)}
+
+    removed = []
+    for sha256, path in on_disk.items():
+        if sha256 in known:
+            continue
+        with _fs_lock:
+            if _recently_touched(path, grace) or \
+                    db.session.query(FileBlob.sha256).filter_by(sha256=sha256).first() is not None:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+        removed.append(sha256)
+    return removed
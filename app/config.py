@@ -42,6 +42,27 @@ class Config:
     
     MAX_CONTENT_LENGTH = 50 * 1024 * 1024  # 50 MB max file size
 
+    # Приём файлов (uploads.py): лимит на один файл, по типу - например {'images': 20 * 1024 * 1024};
+    # превышение прерывает приём с 413 до конца передачи
+    UPLOAD_MAX_FILE_SIZE = MAX_CONTENT_LENGTH
+    UPLOAD_MAX_FILE_SIZE_BY_TYPE = {}
+    UPLOAD_CHUNK_SIZE = 1024 * 1024  # блок копирования потоков не из UploadRequest
+
+    # Загрузка частями (/task/<id>/uploads): лимит на файл, рекомендуемый размер части
+    # (тело PUT не больше MAX_CONTENT_LENGTH) и срок жизни брошенной загрузки
+    UPLOAD_RESUMABLE_MAX_FILE_SIZE = 20 * 1024 * 1024 * 1024
+    UPLOAD_RESUMABLE_CHUNK_SIZE = 8 * 1024 * 1024
+    UPLOAD_SESSION_TTL = timedelta(hours=24)
+    # Завершение, не закончившееся за это время (процесс упал), можно начать заново
+    UPLOAD_FINALIZE_TIMEOUT = timedelta(minutes=30)
+
+    # Раздача загрузок (downloads.py): файлы неизменяемы - кэш браузера на год
+    UPLOAD_CACHE_MAX_AGE = 365 * 24 * 60 * 60
+    # Передача файла прокси: None, 'x-accel-redirect' (nginx) или 'x-sendfile' (Apache, lighttpd).
+    # Для nginx - internal location с alias на UPLOAD_FOLDER
+    SEND_FILE_OFFLOAD = os.environ.get('SEND_FILE_OFFLOAD') or None
+    SEND_FILE_ACCEL_LOCATION = os.environ.get('SEND_FILE_ACCEL_LOCATION', '/_uploads/')
+
     # Разрешенные расширения для файлов
     ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
     ALLOWED_PDF_EXTENSIONS = {'pdf'}
@@ -59,13 +80,71 @@ class Config:
 
     # Размеры для миниатюр изображений
     IMAGE_THUMBNAIL_SIZE = (800, 600)
+    # Превью изображений и PDF (previews.py, нужен Pillow; для PDF - pypdfium2)
+    PREVIEW_FORMAT = 'WEBP'  # без поддержки WebP в Pillow - JPEG
+    PREVIEW_QUALITY = 80
+
+    # Индекс заголовков DICOM (dicom_headers.py): предел чтения заголовка одного файла
+    # и число файлов архива, которые разбираются
+    DICOM_HEADER_MAX_BYTES = 1024 * 1024
+    DICOM_INDEX_MAX_MEMBERS = 20000
+    # Файлы индексирует фоновый поток: сразу после загрузки и раз в N секунд (файлы других воркеров);
+    # файл, занятый дольше DICOM_INDEX_CLAIM_TIMEOUT (воркер упал), занимается заново
+    DICOM_INDEX_INTERVAL = 60
+    DICOM_INDEX_CLAIM_TIMEOUT = timedelta(minutes=30)
 
     # Pagination
     TASKS_PER_PAGE = 20
+
+    # Дельта-синхронизация /api/tasks
+    TASKS_SYNC_OVERLAP = 2  # секунды перекрытия курсора (незакоммиченные на момент чтения правки)
+    TASKS_TOMBSTONE_RETENTION = timedelta(days=7)  # курсоры старше - полная выгрузка
     MESSAGES_PER_PAGE = 50
 
+    # Long-poll сообщений чата: максимальное время удержания запроса (секунды)
+    LONG_POLL_TIMEOUT = 25
+
+    # Потоки WSGI-сервера (waitress). Каждый открытый long-poll занимает поток на время ожидания,
+    # и каждая вкладка держит SSE-поток /api/events: вкладка чата - два потока. Долгие запросы
+    # ограничены долями WSGI_THREADS (SSE_MAX_STREAMS, LONG_POLL_MAX_WAITING), остальные потоки
+    # всегда свободны для обычных запросов; сверх лимита клиенты переходят на опрос
+    WSGI_THREADS = int(os.environ.get('WSGI_THREADS', 64))
+
+    # SSE-поток событий пользователя (секунды)
+    SSE_HEARTBEAT = 15  # комментарий-пинг, чтобы прокси не рвали соединение
+    SSE_MAX_DURATION = 300  # после этого поток закрывается, EventSource переподключается
+    SSE_MAX_STREAMS = WSGI_THREADS // 2  # открытых потоков на процесс
+    SSE_MAX_STREAMS_PER_USER = 4  # вкладок одного пользователя с потоком
+    SSE_RETRY_AFTER = 60  # сверх лимита - 503, клиент опрашивает и пробует снова через N секунд
+    # Одновременно ждущих long-poll на процесс; сверх лимита ответ сразу, с Retry-After (секунды)
+    LONG_POLL_MAX_WAITING = WSGI_THREADS // 4
+    LONG_POLL_RETRY_AFTER = 5
+
+    # Присутствие: last_seen копится в памяти и пишется в БД одним UPDATE раз в N секунд
+    PRESENCE_FLUSH_INTERVAL = 30
+
+    # Статистика (/api/stats, админка): фоновый пересчёт раз в N секунд;
+    # снимок старше STATS_MAX_AGE пересчитывается при чтении
+    STATS_REFRESH_INTERVAL = 30
+    STATS_MAX_AGE = 60
+
+    # Учёт места в папке загрузок (storage_usage): сверка с диском раз в N секунд
+    STORAGE_RECONCILE_INTERVAL = 6 * 60 * 60
+    # Блоб без ссылок удаляется, только если его не трогали N секунд: загрузка того же
+    # содержимого в этот момент успевает закоммитить свою ссылку
+    BLOB_GC_GRACE = 10 * 60
+
     # Typing status timeout (секунды)
     TYPING_STATUS_TIMEOUT = 5
+    # Общее хранилище статуса "печатает" для нескольких воркеров (redis://...); без него - память процесса
+    TYPING_STORE_URL = os.environ.get('TYPING_STORE_URL')
+
+    # Время обработки запросов по endpoint (request_metrics.py, /admin/api/request_metrics);
+    # запрос дольше SLOW_REQUEST_THRESHOLD секунд без ожидания long-poll пишется в лог (0 - не писать)
+    REQUEST_METRICS_ENABLED = True
+    SLOW_REQUEST_THRESHOLD = float(os.environ.get('SLOW_REQUEST_THRESHOLD', 1.0))
+    # GET /metrics - метрики в формате Prometheus (metrics.py), без запросов к БД
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') != '0'
 
     # Логирование - в директории data/logs
     LOG_DIR = data_dir / 'logs'
@@ -73,6 +152,12 @@ class Config:
     LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
     LOG_MAX_BYTES = 10 * 1024 * 1024  # 10 MB
     LOG_BACKUP_COUNT = 10
+    # Запись логов через очередь: файлы и консоль пишет фоновый поток (0 - в потоке запроса).
+    # При переполнении: 'drop' - запись отбрасывается (счётчик dropped), 'block' - ожидание
+    # места до LOG_QUEUE_BLOCK_TIMEOUT секунд
+    LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+    LOG_QUEUE_POLICY = os.environ.get('LOG_QUEUE_POLICY', 'drop')
+    LOG_QUEUE_BLOCK_TIMEOUT = 1.0
 
     @staticmethod
     def init_app(app):
@@ -89,6 +174,26 @@ class ProductionConfig(Config):
     """Конфигурация для продакшена"""
     DEBUG = False
     ENV = 'production'
+
+    # SQLite: PRAGMA на каждое соединение пула (sqlite_profile.py)
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',  # читатели не блокируют писателя
+        'synchronous': 'NORMAL',  # в WAL безопасно, fsync только на checkpoint
+        'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)),  # мс ожидания блокировки
+        'mmap_size': 256 * 1024 * 1024,
+        # в КиБ, на каждое соединение: ~8 МБ x (DB_POOL_SIZE + max_overflow) поверх общего mmap
+        'cache_size': -8000,
+        'temp_store': 'MEMORY',
+    }
+    # Пул меньше числа потоков waitress: потоки, ждущие long-poll или держащие SSE,
+    # соединение не занимают (long-poll коммитит сессию до ожидания, SSE-генератор работает
+    # после teardown запроса); запас - фоновым потокам (сброс присутствия и т.п.)
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 16))
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': 8,
+        'pool_timeout': 30,
+    }
     
     @classmethod
     def init_app(cls, app):
@@ -121,6 +226,8 @@ class TestingConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
     WTF_CSRF_ENABLED = False
+    STATS_MAX_AGE = 0  # без фонового потока - пересчёт на каждое чтение
+    LOG_QUEUE_SIZE = 0  # записи в лог - сразу, в потоке теста
 
 
 config = {
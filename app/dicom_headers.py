@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Task-Chat - Индекс заголовков DICOM
+При загрузке DICOM-файла или zip-архива с серией читается только заголовок каждого
+файла - до первого тега после нужных (задолго до Pixel Data), остальное не
+распаковывается и не читается. Модальность, UID исследования/серии, толщина среза
+и размер пишутся в таблицу dicom_instance: /task/<id>/files сводит серии и фильтрует
+по ним без повторного открытия файлов. Разбор идёт в фоновом потоке (DicomIndexer),
+а не в запросе загрузки: архив может содержать тысячи файлов.
+
+Разбор - собственный, без pydicom: Part 10 (преамбула + 'DICM') и файлы без
+преамбулы; Explicit/Implicit VR Little Endian, Explicit VR Big Endian, Deflated.
+"""
+
+import os
+import struct
+import threading
+import zipfile
+import zlib
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+try:
+    from .models import DicomInstance, TaskFile
+    from .blobstore import stored_file_path
+except ImportError:
+    from models import DicomInstance, TaskFile
+    from blobstore import stored_file_path
+
+
+# Теги, которые индексируются: (группа, элемент) -> поле DicomInstance
+INDEXED_TAGS = {
+    (0x0008, 0x0018): 'sop_instance_uid',
+    (0x0008, 0x0060): 'modality',
+    (0x0008, 0x103E): 'series_description',
+    (0x0018, 0x0050): 'slice_thickness',
+    (0x0020, 0x000D): 'study_instance_uid',
+    (0x0020, 0x000E): 'series_instance_uid',
+    (0x0020, 0x0011): 'series_number',
+    (0x0020, 0x0013): 'instance_number',
+}
+LAST_TAG = max(INDEXED_TAGS)  # теги в наборе данных идут по возрастанию - дальше не читаем
+NUMERIC_FIELDS = {'slice_thickness': float, 'series_number': int, 'instance_number': int}
+
+IMPLICIT_VR_LE = '1.2.840.10008.1.2'
+EXPLICIT_VR_BE = '1.2.840.10008.1.2.2'
+DEFLATED_EXPLICIT_VR_LE = '1.2.840.10008.1.2.1.99'
+
+# VR с 4-байтной длиной в Explicit VR
+LONG_VRS = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'}
+UNDEFINED_LENGTH = 0xFFFFFFFF
+ITEM = (0xFFFE, 0xE000)
+ITEM_DELIMITER = (0xFFFE, 0xE00D)
+SEQUENCE_DELIMITER = (0xFFFE, 0xE0DD)
+
+
+class HeaderError(Exception):
+    """Не DICOM или заголовок повреждён"""
+
+
+class _Reader:
+    """Последовательное чтение потока с ограничением объёма заголовка"""
+
+    def __init__(self, stream, limit: int):
+        self._stream = stream
+        self._pushback = b''
+        self.remaining = limit
+
+    def unread(self, data: bytes):
+        self._pushback = data + self._pushback
+        self.remaining += len(data)
+
+    def read(self, size: int) -> bytes:
+        if size > self.remaining:
+            raise HeaderError('Заголовок больше допустимого')
+        data, self._pushback = self._pushback[:size], self._pushback[size:]
+        while len(data) < size:
+            chunk = self._stream.read(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        self.remaining -= len(data)
+        return data
+
+    def read_exact(self, size: int) -> bytes:
+        data = self.read(size)
+        if len(data) != size:
+            raise HeaderError('Неожиданный конец файла')
+        return data
+
+    def skip(self, size: int):
+        while size > 0:
+            step = min(size, 64 * 1024)
+            self.read_exact(step)
+            size -= step
+
+
+class _Inflater:
+    """Поток Deflated Transfer Syntax (raw deflate после метаинформации)"""
+
+    def __init__(self, reader: _Reader):
+        self._reader = reader
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self._buffer = b''
+
+    def read(self, size: int) -> bytes:
+        while len(self._buffer) < size and not self._decompressor.eof:
+            compressed = self._reader.read(min(16 * 1024, self._reader.remaining))
+            if not compressed:
+                break
+            self._buffer += self._decompressor.decompress(compressed)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+class _Parser:
+    def __init__(self, reader: _Reader, explicit: bool, little_endian: bool = True):
+        self.reader = reader
+        self.explicit = explicit
+        self.endian = '<' if little_endian else '>'
+
+    def read_tag(self) -> Optional[tuple]:
+        data = self.reader.read(4)
+        if not data:
+            return None
+        if len(data) != 4:
+            raise HeaderError('Неожиданный конец файла')
+        return struct.unpack(self.endian + 'HH', data)
+
+    def read_length(self, tag) -> tuple:
+        """(VR, длина значения); у элементов разметки последовательностей VR нет"""
+        if tag[0] == 0xFFFE or not self.explicit:
+            return None, struct.unpack(self.endian + 'I', self.reader.read_exact(4))[0]
+        vr = self.reader.read_exact(2)
+        if vr in LONG_VRS:
+            self.reader.read_exact(2)
+            return vr, struct.unpack(self.endian + 'I', self.reader.read_exact(4))[0]
+        return vr, struct.unpack(self.endian + 'H', self.reader.read_exact(2))[0]
+
+    def skip_undefined(self):
+        """Пропустить последовательность неопределённой длины (с вложенными элементами)"""
+        while True:
+            tag = self.read_tag()
+            if tag is None:
+                raise HeaderError('Незакрытая последовательность')
+            _, length = self.read_length(tag)
+            if tag == SEQUENCE_DELIMITER:
+                return
+            if tag != ITEM:
+                raise HeaderError(f'Неожиданный тег {tag} в последовательности')
+            if length == UNDEFINED_LENGTH:
+                self.skip_item()
+            else:
+                self.reader.skip(length)
+
+    def skip_item(self):
+        while True:
+            tag = self.read_tag()
+            if tag is None:
+                raise HeaderError('Незакрытый элемент последовательности')
+            _, length = self.read_length(tag)
+            if tag == ITEM_DELIMITER:
+                return
+            if length == UNDEFINED_LENGTH:
+                self.skip_undefined()
+            else:
+                self.reader.skip(length)
+
+    def read_dataset(self) -> Dict[str, object]:
+        values = {}
+        while True:
+            tag = self.read_tag()
+            if tag is None or tag > LAST_TAG:
+                return values
+            _, length = self.read_length(tag)
+            if length == UNDEFINED_LENGTH:
+                self.skip_undefined()
+            elif tag in INDEXED_TAGS:
+                values[INDEXED_TAGS[tag]] = decode_value(INDEXED_TAGS[tag], self.reader.read_exact(length))
+            else:
+                self.reader.skip(length)
+
+
+def decode_value(field: str, raw: bytes):
+    text = raw.decode('ascii', errors='replace').strip('\x00 ')
+    if field in NUMERIC_FIELDS:
+        try:
+            return NUMERIC_FIELDS[field](float(text.split('\\')[0])) if text else None
+        except ValueError:
+            return None
+    return text or None
+
+
+def read_header(stream, limit: int) -> Dict[str, object]:
+    """
+    Индексируемые поля заголовка DICOM из потока
+
+    Raises:
+        HeaderError: не DICOM или заголовок повреждён
+    """
+    reader = _Reader(stream, limit)
+    head = reader.read(132)
+    if head[128:132] == b'DICM':
+        # Метаинформация (группа 0002) - всегда Explicit VR Little Endian
+        meta = _Parser(reader, explicit=True)
+        transfer_syntax = None
+        while True:
+            tag = meta.read_tag()
+            if tag is None:
+                raise HeaderError('Нет набора данных')
+            if tag[0] != 0x0002:
+                reader.unread(struct.pack('<HH', *tag))
+                break
+            _, length = meta.read_length(tag)
+            value = reader.read_exact(length)
+            if tag == (0x0002, 0x0010):
+                transfer_syntax = value.decode('ascii', errors='replace').strip('\x00 ')
+        if transfer_syntax == DEFLATED_EXPLICIT_VR_LE:
+            parser = _Parser(_Reader(_Inflater(reader), reader.remaining), explicit=True)
+        elif transfer_syntax == EXPLICIT_VR_BE:
+            parser = _Parser(reader, explicit=True, little_endian=False)
+        else:
+            parser = _Parser(reader, explicit=transfer_syntax != IMPLICIT_VR_LE)
+    else:
+        # Без преамбулы (ACR-NEMA, часть архивов): набор данных с начала файла, обычно с группы 0008
+        if len(head) < 8 or struct.unpack('<H', head[:2])[0] != 0x0008:
+            raise HeaderError('Не DICOM')
+        reader.unread(head)
+        parser = _Parser(reader, explicit=head[4:6].isalpha() and head[4:6].isupper())
+
+    values = parser.read_dataset()
+    if not values.get('series_instance_uid') and not values.get('sop_instance_uid'):
+        raise HeaderError('Нет UID серии/изображения')
+    return values
+
+
+def read_file_headers(path, file_type: str, config) -> List[Dict[str, object]]:
+    """
+    Заголовки DICOM-файла или DICOM-файлов в zip-архиве: [{поля, 'member', 'size'}]
+    Файлы, которые не удалось разобрать, пропускаются; у отдельного .dcm member - пустая строка
+    """
+    limit = config['DICOM_HEADER_MAX_BYTES']
+    headers = []
+    if file_type == 'dicom':
+        try:
+            with open(path, 'rb') as f:
+                headers.append({**read_header(f, limit), 'member': '', 'size': os.path.getsize(path)})
+        except (HeaderError, OSError, struct.error):
+            pass
+        return headers
+
+    try:
+        archive = zipfile.ZipFile(path)
+    except (zipfile.BadZipFile, OSError):
+        return headers
+    with archive:
+        # Одинаковые имена (в том числе после обрезки до 255 символов) - последний файл, как в zipfile
+        members = list({info.filename[:255]: info for info in archive.infolist() if not info.is_dir()}.items())
+        for name, info in members[:config['DICOM_INDEX_MAX_MEMBERS']]:
+            try:
+                # Распаковывается только начало файла - до конца заголовка
+                with archive.open(info) as member:
+                    headers.append({**read_header(member, limit), 'member': name, 'size': info.file_size})
+            except (HeaderError, OSError, RuntimeError, NotImplementedError, zipfile.BadZipFile,
+                    zlib.error, struct.error):
+                continue  # не DICOM, зашифрован, неподдерживаемое сжатие
+    return headers
+
+
+def index_task_file(db, task_file, path, config) -> int:
+    """
+    Записать заголовки DICOM файла задачи в dicom_instance (без commit)
+
+    Returns:
+        Число проиндексированных DICOM-файлов
+    """
+    file_type = 'dicom' if task_file.is_dicom else 'archives' if task_file.is_archive else None
+    if file_type is None:
+        return 0
+    if task_file.id is None:
+        db.session.flush()
+    headers = read_file_headers(path, file_type, config)
+    db.session.add_all([
+        DicomInstance(task_id=task_file.task_id, task_file_id=task_file.id, **header)
+        for header in headers
+    ])
+    task_file.dicom_indexed = True
+    return len(headers)
+
+
+def claim_task_file(db, task_file_id: int, timeout: timedelta) -> bool:
+    """
+    Занять файл для индексации (dicom_indexed -> False) условным UPDATE с commit: из нескольких
+    потоков и процессов файл индексирует только тот, чей UPDATE изменил строку. Файл, занятый
+    дольше timeout (процесс упал), занимается заново
+    """
+    now = datetime.utcnow()
+    result = db.session.execute(
+        db.update(TaskFile)
+        .where(TaskFile.id == task_file_id, pending_condition(db, now - timeout))
+        .values(dicom_indexed=False, dicom_claimed_at=now)
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def pending_condition(db, claimed_before: datetime):
+    """Файл ещё не индексирован или занят до claimed_before"""
+    return db.or_(
+        TaskFile.dicom_indexed.is_(None),
+        db.and_(TaskFile.dicom_indexed == False, TaskFile.dicom_claimed_at < claimed_before)
+    )
+
+
+def index_pending_files(db, upload_folder, config, limit: int = 50) -> int:
+    """
+    Проиндексировать до limit DICOM-файлов и архивов из очереди: новые загрузки, файлы,
+    загруженные до появления индекса, и файлы упавших воркеров
+
+    Returns:
+        Число проиндексированных файлов (0 - больше нечего индексировать)
+    """
+    timeout = config['DICOM_INDEX_CLAIM_TIMEOUT']
+    pending = [file_id for (file_id,) in db.session.query(TaskFile.id).filter(
+        pending_condition(db, datetime.utcnow() - timeout),
+        db.or_(TaskFile.is_dicom == True, TaskFile.is_archive == True)
+    ).order_by(TaskFile.id).limit(limit)]
+    indexed = 0
+    for file_id in pending:
+        if not claim_task_file(db, file_id, timeout):
+            continue  # занят другим процессом
+        task_file = db.session.get(TaskFile, file_id)
+        if task_file is None:
+            continue
+        # До commit файл помечен False: при ошибке его займут заново через timeout
+        index_task_file(db, task_file, stored_file_path(upload_folder, str(task_file.task_id),
+                                                        task_file.stored_filename), config)
+        db.session.commit()
+        indexed += 1
+    return indexed
+
+
+class DicomIndexer:
+    """
+    Фоновая индексация заголовков DICOM (один поток на процесс): загрузки будят поток
+    через notify(), раз в interval секунд проверяется очередь (файлы других воркеров)
+    """
+
+    def __init__(self):
+        self._thread: Optional[threading.Thread] = None
+        self._wake = threading.Event()
+
+    def notify(self):
+        """Загружен DICOM-файл или архив (после commit)"""
+        self._wake.set()
+
+    def run_once(self, app, db) -> int:
+        """Проиндексировать очередь в контексте приложения"""
+        total = 0
+        with app.app_context():
+            try:
+                while True:
+                    indexed = index_pending_files(db, app.config['UPLOAD_FOLDER'], app.config)
+                    if not indexed:
+                        break
+                    total += indexed
+                if total:
+                    app.logger.info(f'Indexed DICOM headers of {total} files', extra={'category': 'files'})
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f'DICOM indexing failed: {e}', extra={'category': 'files'})
+            finally:
+                db.session.remove()
+        return total
+
+    def start(self, app, db, interval: float):
+        """Запустить поток: первый проход сразу (файлы, загруженные до индекса)"""
+        if self._thread is not None:
+            return
+
+        def run():
+            while True:
+                self.run_once(app, db)
+                self._wake.wait(interval)
+                self._wake.clear()
+
+        self._thread = threading.Thread(target=run, name='dicom-index', daemon=True)
+        self._thread.start()
+
+
+# Глобальная индексация процесса
+dicom_indexer = DicomIndexer()
+
+
+def instance_filter(task_id: int, modality: Optional[str] = None, series_uid: Optional[str] = None,
+                    study_uid: Optional[str] = None):
+    """Условия отбора DICOM-файлов задачи"""
+    conditions = [DicomInstance.task_id == task_id]
+    if modality:
+        conditions.append(DicomInstance.modality == modality)
+    if series_uid:
+        conditions.append(DicomInstance.series_instance_uid == series_uid)
+    if study_uid:
+        conditions.append(DicomInstance.study_instance_uid == study_uid)
+    return conditions
+
+
+def summarize_series(db, conditions) -> List[dict]:
+    """Сводка серий задачи одним агрегатным запросом по индексу (task_id, series_instance_uid)"""
+    query = db.session.query(
+        DicomInstance.series_instance_uid,
+        db.func.max(DicomInstance.study_instance_uid),
+        db.func.max(DicomInstance.modality),
+        db.func.max(DicomInstance.series_number),
+        db.func.max(DicomInstance.series_description),
+        db.func.min(DicomInstance.slice_thickness),
+        db.func.max(DicomInstance.slice_thickness),
+        db.func.count(DicomInstance.id),
+        db.func.sum(DicomInstance.size),
+        db.func.group_concat(db.distinct(DicomInstance.task_file_id)),
+    ).filter(*conditions)
+
+    series = []
+    for (series_uid, study_uid, modality, series_number, description, thickness_min, thickness_max,
+         instances, size, file_ids) in query.group_by(DicomInstance.series_instance_uid):
+        series.append({
+            'series_instance_uid': series_uid,
+            'study_instance_uid': study_uid,
+            'modality': modality,
+            'series_number': series_number,
+            'series_description': description,
+            # Разная толщина срезов в одной серии: slice_thickness = None, диапазон - в slice_thickness_range
+            'slice_thickness': thickness_min if thickness_min == thickness_max else None,
+            'slice_thickness_range': [thickness_min, thickness_max],
+            'instances': instances,
+            'size_bytes': size or 0,
+            'file_ids': sorted(int(file_id) for file_id in str(file_ids).split(',')) if file_ids else [],
+        })
+    series.sort(key=lambda s: (s['modality'] or '', s['series_number'] if s['series_number'] is not None else -1))
+    return series
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Task-Chat - Раздача загруженных файлов
+Загрузки неизменяемы (блоб назван по SHA-256 содержимого, файлы старого формата - по uuid),
+поэтому ответ кэшируется браузером без перепроверки: сильный ETag, Cache-Control
+private, immutable. Поддерживаются If-None-Match (304) и Range (206) - PDF-просмотрщик
+запрашивает документ кусками.
+
+За reverse proxy передачу файла можно отдать ему (SEND_FILE_OFFLOAD): приложение
+проверяет доступ и отвечает заголовком X-Accel-Redirect (nginx) или X-Sendfile
+(Apache, lighttpd) без тела, поток waitress не занят передачей.
+"""
+
+import os
+from typing import Optional
+from urllib.parse import quote
+
+from flask import abort, current_app, request, send_file
+
+
+OFFLOAD_MODES = ('x-accel-redirect', 'x-sendfile')
+
+
+def set_cache_headers(response, config):
+    """Кэш браузера для неизменяемого файла (private - файлы доступны только после входа)"""
+    response.cache_control.public = False
+    response.cache_control.no_cache = None
+    response.cache_control.private = True
+    response.cache_control.max_age = config['UPLOAD_CACHE_MAX_AGE']
+    response.cache_control.immutable = True
+
+
+def offload_response(path, upload_folder, mimetype: str, download_name: str, as_attachment: bool,
+                     etag: Optional[str], config):
+    """Ответ без тела: файл отдаёт прокси по заголовку X-Accel-Redirect / X-Sendfile"""
+    response = current_app.response_class(mimetype=mimetype)
+    if config['SEND_FILE_OFFLOAD'] == 'x-accel-redirect':
+        # internal location nginx, которая смотрит в UPLOAD_FOLDER
+        relative = os.path.relpath(path, upload_folder).replace(os.sep, '/')
+        response.headers['X-Accel-Redirect'] = config['SEND_FILE_ACCEL_LOCATION'].rstrip('/') + '/' + quote(relative)
+    else:
+        response.headers['X-Sendfile'] = os.path.abspath(path)
+    response.headers.set('Content-Disposition', 'attachment' if as_attachment else 'inline',
+                         filename=download_name)
+    if etag:
+        response.set_etag(etag)
+    # 304 - здесь, Range обрабатывает прокси
+    return response.make_conditional(request.environ)
+
+
+def send_upload(path, upload_folder, mimetype: str, download_name: str, etag: Optional[str] = None,
+                as_attachment: bool = False):
+    """
+    Отдать загруженный файл
+
+    Args:
+        path: путь к файлу внутри upload_folder
+        etag: сильный ETag (SHA-256 содержимого); без него - ETag werkzeug по mtime и размеру
+    """
+    config = current_app.config
+    if not os.path.isfile(path):
+        abort(404)
+
+    if config['SEND_FILE_OFFLOAD'] in OFFLOAD_MODES:
+        response = offload_response(path, upload_folder, mimetype, download_name, as_attachment, etag, config)
+    else:
+        response = send_file(
+            path,
+            mimetype=mimetype,
+            as_attachment=as_attachment,
+            download_name=download_name,
+            conditional=True,  # If-None-Match / If-Modified-Since -> 304, Range / If-Range -> 206
+            etag=etag or True,
+        )
+        # werkzeug ставит Accept-Ranges только в ответ на Range; PDF.js по нему решает, грузить ли кусками
+        response.headers.setdefault('Accept-Ranges', 'bytes')
+    set_cache_headers(response, config)
+    return response
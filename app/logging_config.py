@@ -11,11 +11,33 @@ Task-Chat Full v0.3.2 - Advanced Logging Module
 import os
 import sys
 import json
+import queue
+import atexit
 import logging
-from datetime import datetime
-from logging.handlers import RotatingFileHandler, TimedRotatingFileHandler
+import threading
+import time
+from logging.handlers import RotatingFileHandler, TimedRotatingFileHandler, QueueHandler, QueueListener
 from pathlib import Path
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple, Callable
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps_json(log_entry: Dict[str, Any]) -> str:
+    """JSON строки лога через json (не-JSON значения - через str)"""
+    return json.dumps(log_entry, ensure_ascii=False, default=str)
+
+
+def dumps_orjson(log_entry: Dict[str, Any]) -> str:
+    """JSON строки лога через orjson (не-JSON значения - через str)"""
+    return orjson.dumps(log_entry, default=str, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+
+# Сериализатор по умолчанию: orjson, если установлен, иначе json
+dumps_log_entry = dumps_orjson if orjson is not None else dumps_json
 
 
 class ColoredFormatter(logging.Formatter):
@@ -37,17 +59,44 @@ class ColoredFormatter(logging.Formatter):
 
 
 class JSONFormatter(logging.Formatter):
-    """JSON форматтер для структурированного логирования"""
+    """
+    JSON форматтер для структурированного логирования
+
+    Запись форматируется один раз: строка кэшируется в записи и повторно отдаётся обработчикам
+    с тем же форматтером (taskchat.log и taskchat_history.log). Метка времени - по времени
+    создания записи, часть до секунд кэшируется. Сериализатор - параметр dumps
+    (по умолчанию dumps_log_entry: orjson, если установлен).
+    """
+
+    # Необязательные поля записи (extra=...) в порядке вывода
+    EXTRA_FIELDS = ('user_id', 'username', 'task_id', 'chat_id', 'extra_data')
     
-    def __init__(self, category: str = 'system'):
+    def __init__(self, category: str = 'system', dumps: Optional[Callable[[Dict[str, Any]], str]] = None):
         super().__init__()
         self.category = category
+        self.dumps = dumps or dumps_log_entry
+        self._cache_attr = f'_json_{id(self)}'
+        self._second: Tuple[int, str] = (-1, '')
+    
+    def format_timestamp(self, created: float) -> str:
+        """ISO 8601 UTC с микросекундами: 2026-03-12T10:00:00.123456Z"""
+        second = int(created)
+        cached_second, prefix = self._second
+        if cached_second != second:
+            prefix = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(second))
+            self._second = (second, prefix)
+        return f'{prefix}.{int((created - second) * 1e6):06d}Z'
     
     def format(self, record):
+        record_fields = record.__dict__
+        cached = record_fields.get(self._cache_attr)
+        if cached is not None:
+            return cached
+
         log_entry = {
-            'timestamp': datetime.utcnow().isoformat() + 'Z',
+            'timestamp': self.format_timestamp(record.created),
             'level': record.levelname,
-            'category': getattr(record, 'category', self.category),
+            'category': record_fields.get('category', self.category),
             'message': record.getMessage(),
             'module': record.module,
             'function': record.funcName,
@@ -55,22 +104,19 @@ class JSONFormatter(logging.Formatter):
         }
         
         # Добавляем дополнительные поля
-        if hasattr(record, 'user_id'):
-            log_entry['user_id'] = record.user_id
-        if hasattr(record, 'username'):
-            log_entry['username'] = record.username
-        if hasattr(record, 'task_id'):
-            log_entry['task_id'] = record.task_id
-        if hasattr(record, 'chat_id'):
-            log_entry['chat_id'] = record.chat_id
-        if hasattr(record, 'extra_data'):
-            log_entry['extra_data'] = record.extra_data
+        for field in self.EXTRA_FIELDS:
+            if field in record_fields:
+                log_entry[field] = record_fields[field]
         
-        # Добавляем информацию об исключении
-        if record.exc_info:
-            log_entry['exception'] = self.formatException(record.exc_info)
+        # Добавляем информацию об исключении (в режиме очереди - уже отформатирована, exc_text)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            log_entry['exception'] = record.exc_text
         
-        return json.dumps(log_entry, ensure_ascii=False)
+        text = self.dumps(log_entry)
+        record_fields[self._cache_attr] = text
+        return text
 
 
 class CategoryFilter(logging.Filter):
@@ -85,6 +131,61 @@ class CategoryFilter(logging.Filter):
         return True
 
 
+# Трассировка исключения для записи, переданной в очередь
+_exception_formatter = logging.Formatter()
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    QueueHandler с ограниченной очередью: поток запроса только кладёт запись в очередь,
+    форматирование и запись в файлы выполняет QueueListener в фоновом потоке.
+
+    При переполнении очереди:
+    - 'drop' - запись отбрасывается сразу
+    - 'block' - поток ждёт место до block_timeout секунд, затем запись отбрасывается
+    Отброшенные записи считаются в dropped.
+    """
+
+    POLICIES = ('drop', 'block')
+
+    def __init__(self, log_queue: queue.Queue, policy: str = 'drop', block_timeout: float = 1.0):
+        super().__init__(log_queue)
+        self.policy = policy if policy in self.POLICIES else 'drop'
+        self.block_timeout = block_timeout
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+
+    def prepare(self, record):
+        """
+        Зафиксировать сообщение и исключение до передачи в другой поток. В отличие от
+        QueueHandler.prepare запись не форматируется здесь: это делают обработчики listener.
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None  # traceback держит кадры стека потока запроса
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.policy == 'block':
+                self.queue.put(record, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+
+class LogQueueListener(QueueListener):
+    """QueueListener, который при остановке ждёт место в заполненной очереди"""
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
 class TaskChatLogger:
     """
     Основной класс логирования Task-Chat
@@ -95,6 +196,7 @@ class TaskChatLogger:
     - Категории логов (auth, tasks, chat, files, admin, system)
     - Консольный и файловый вывод
     - Различные уровни логирования
+    - Запись через очередь (queue_size > 0): файлы и консоль пишет фоновый поток
     """
     
     CATEGORIES = ['auth', 'tasks', 'chat', 'files', 'admin', 'system', 'api', 'database']
@@ -110,7 +212,10 @@ class TaskChatLogger:
         log_level: str = 'INFO',
         console_output: bool = True,
         max_bytes: int = 10 * 1024 * 1024,  # 10 MB
-        backup_count: int = 10
+        backup_count: int = 10,
+        queue_size: int = 0,
+        queue_policy: str = 'drop',
+        queue_block_timeout: float = 1.0
     ):
         self.name = name
         self.log_dir = Path(log_dir) if log_dir else Path(__file__).parent / 'logs'
@@ -120,6 +225,13 @@ class TaskChatLogger:
         self.console_output = console_output
         self.max_bytes = max_bytes
         self.backup_count = backup_count
+        self.queue_size = queue_size
+        self.queue_policy = queue_policy
+        self.queue_block_timeout = queue_block_timeout
+        self.queue_handler: Optional[BoundedQueueHandler] = None
+        self.listener: Optional[LogQueueListener] = None
+        self._category_loggers: Dict[str, logging.Logger] = {}
+        self._category_lock = threading.Lock()
         
         self._setup_logger()
     
@@ -129,7 +241,10 @@ class TaskChatLogger:
         self.logger.setLevel(self.log_level)
         
         # Очищаем существующие обработчики
+        self.stop()
         self.logger.handlers.clear()
+        self._category_loggers.clear()
+        handlers = []
         
         # Создаем форматтеры
         if self.log_format == 'json':
@@ -157,7 +272,7 @@ class TaskChatLogger:
             encoding='utf-8'
         )
         file_handler.setFormatter(file_formatter)
-        self.logger.addHandler(file_handler)
+        handlers.append(file_handler)
         
         # Файловый обработчик с ротацией по времени (для истории)
         time_log_file = self.log_dir / f'{self.name}_history.log'
@@ -169,13 +284,47 @@ class TaskChatLogger:
             encoding='utf-8'
         )
         time_handler.setFormatter(file_formatter)
-        self.logger.addHandler(time_handler)
+        handlers.append(time_handler)
         
         # Консольный обработчик
         if self.console_output:
             console_handler = logging.StreamHandler(sys.stdout)
             console_handler.setFormatter(console_formatter)
-            self.logger.addHandler(console_handler)
+            handlers.append(console_handler)  # последним: ColoredFormatter меняет levelname записи
+
+        if self.queue_size > 0:
+            # Поток запроса только кладёт запись в очередь; форматирование, запись и ротация -
+            # в потоке QueueListener
+            log_queue = queue.Queue(maxsize=self.queue_size)
+            self.queue_handler = BoundedQueueHandler(log_queue, self.queue_policy, self.queue_block_timeout)
+            self.listener = LogQueueListener(log_queue, *handlers, respect_handler_level=True)
+            self.listener.start()
+            self.logger.addHandler(self.queue_handler)
+        else:
+            for handler in handlers:
+                self.logger.addHandler(handler)
+
+    def stop(self):
+        """Дописать записи из очереди и остановить фоновый поток (при выходе процесса)"""
+        if self.listener is not None:
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+            if self.queue_handler.dropped:
+                sys.stderr.write(f'taskchat logging: {self.queue_handler.dropped} records dropped (queue full)\n')
+            self.listener = None
+            self.queue_handler = None
+
+    def queue_stats(self) -> Dict[str, Any]:
+        """Состояние очереди логов: глубина, размер, отброшено записей"""
+        if self.queue_handler is None:
+            return {'enabled': False, 'depth': 0, 'size': 0, 'dropped': 0}
+        return {
+            'enabled': True,
+            'depth': self.queue_handler.queue.qsize(),
+            'size': self.queue_size,
+            'dropped': self.queue_handler.dropped,
+        }
     
     def get_category_logger(self, category: str) -> logging.Logger:
         """
@@ -189,11 +338,20 @@ class TaskChatLogger:
         """
         if category not in self.CATEGORIES:
             category = 'system'
-        
-        category_logger = logging.getLogger(f'{self.name}.{category}')
-        category_logger.handlers = self.logger.handlers.copy()
-        category_logger.addFilter(CategoryFilter(category))
-        category_logger.setLevel(self.log_level)
+
+        # Логгер категории настраивается один раз: свой фильтр с категорией, обработчики -
+        # у основного логгера (запись доходит до них через propagate)
+        category_logger = self._category_loggers.get(category)
+        if category_logger is None:
+            with self._category_lock:
+                category_logger = self._category_loggers.get(category)
+                if category_logger is None:
+                    category_logger = logging.getLogger(f'{self.name}.{category}')
+                    category_logger.handlers = []
+                    category_logger.filters = [CategoryFilter(category)]
+                    category_logger.setLevel(self.log_level)
+                    category_logger.propagate = True
+                    self._category_loggers[category] = category_logger
         
         return category_logger
     
@@ -272,7 +430,10 @@ _logger: Optional[TaskChatLogger] = None
 def get_logger(
     log_dir: Optional[str] = None,
     log_format: str = 'json',
-    log_level: str = 'INFO'
+    log_level: str = 'INFO',
+    queue_size: int = 0,
+    queue_policy: str = 'drop',
+    queue_block_timeout: float = 1.0
 ) -> TaskChatLogger:
     """
     Получение глобального экземпляра логгера
@@ -281,6 +442,9 @@ def get_logger(
         log_dir: Директория для логов
         log_format: Формат логов (json или text)
         log_level: Уровень логирования
+        queue_size: Размер очереди записей (0 - запись в потоке вызова)
+        queue_policy: При переполнении очереди - 'drop' или 'block'
+        queue_block_timeout: Ожидание места в очереди при 'block' (секунды)
     
     Returns:
         Экземпляр TaskChatLogger
@@ -290,8 +454,13 @@ def get_logger(
         _logger = TaskChatLogger(
             log_dir=log_dir,
             log_format=log_format,
-            log_level=log_level
+            log_level=log_level,
+            queue_size=queue_size,
+            queue_policy=queue_policy,
+            queue_block_timeout=queue_block_timeout
         )
+        # Записи, оставшиеся в очереди, дописываются при завершении процесса
+        atexit.register(_logger.stop)
     return _logger
 
 
@@ -364,3 +533,99 @@ def log_user_action(action: str):
                 raise
         return wrapper
     return decorator
+
+
+def benchmark_category_logging(calls: int = 1_000_000, batch: int = 100_000) -> Tuple[List[Tuple[int, float]], int]:
+    """
+    Стоимость вызова log_auth (get_category_logger + запись) по пачкам вызовов.
+    Обработчики заменены на NullHandler - измеряется только путь логгера.
+
+    Returns:
+        ([(вызовов с начала, мкс на вызов в пачке)], число фильтров логгера auth)
+    """
+    import tempfile
+    import time
+
+    with tempfile.TemporaryDirectory() as log_dir:
+        bench = TaskChatLogger(name='taskchat_bench', log_dir=log_dir, console_output=False)
+        for handler in bench.logger.handlers:
+            handler.close()
+        bench.logger.handlers = [logging.NullHandler()]
+
+        results = []
+        done = 0
+        while done < calls:
+            started = time.perf_counter()
+            for _ in range(batch):
+                bench.log_auth('info', 'User logged in', user_id=1)
+            done += batch
+            results.append((done, (time.perf_counter() - started) / batch * 1e6))
+        filters = len(bench.get_category_logger('auth').filters)
+        bench.logger.handlers = []
+    return results, filters
+
+
+def benchmark_json_formatter(records: int = 100_000) -> Dict[str, float]:
+    """
+    Записей в секунду: прежний JSONFormatter против текущего (json и orjson, если установлен).
+    Каждая запись форматируется дважды - как файловыми обработчиками taskchat.log и
+    taskchat_history.log.
+    """
+    from datetime import datetime
+
+    def reference_format(record):
+        # JSONFormatter до кэширования: словарь, utcnow().isoformat(), hasattr, json.dumps
+        log_entry = {
+            'timestamp': datetime.utcnow().isoformat() + 'Z',
+            'level': record.levelname,
+            'category': getattr(record, 'category', 'system'),
+            'message': record.getMessage(),
+            'module': record.module,
+            'function': record.funcName,
+            'line': record.lineno,
+        }
+        for field in JSONFormatter.EXTRA_FIELDS:
+            if hasattr(record, field):
+                log_entry[field] = getattr(record, field)
+        return json.dumps(log_entry, ensure_ascii=False)
+
+    def make_records():
+        return [
+            logging.LogRecord('taskchat.auth', logging.INFO, __file__, 1, 'Пользователь %s вошёл', ('doc',), None,
+                              func='login')
+            for _ in range(records)
+        ]
+
+    def measure(format_record) -> float:
+        batch = make_records()
+        for record in batch:
+            record.category, record.user_id, record.extra_data = 'auth', 1, {'ip': '10.0.0.1'}
+        started = time.perf_counter()
+        for record in batch:
+            format_record(record)
+            format_record(record)
+        return records / (time.perf_counter() - started)
+
+    results = {
+        'reference': measure(reference_format),
+        'json': measure(JSONFormatter(dumps=dumps_json).format),
+    }
+    if orjson is not None:
+        results['orjson'] = measure(JSONFormatter(dumps=dumps_orjson).format)
+    return results
+
+
+if __name__ == '__main__':
+    # python logging_config.py --bench [вызовов]
+    if '--bench' in sys.argv:
+        args = [arg for arg in sys.argv[1:] if arg != '--bench']
+        results, filters = benchmark_category_logging(int(args[0]) if args else 1_000_000)
+        for done, per_call in results:
+            print(f'{done:>10} calls: {per_call:.2f} us/call')
+        print(f'auth logger filters: {filters}')
+    # python logging_config.py --bench-json [записей]
+    if '--bench-json' in sys.argv:
+        args = [arg for arg in sys.argv[1:] if arg != '--bench-json']
+        results = benchmark_json_formatter(int(args[0]) if args else 100_000)
+        for name, rate in results.items():
+            print(f'{name:>10}: {rate:>10,.0f} records/s ({rate / results["reference"]:.1f}x)')
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Task-Chat - Метрики сервера в формате Prometheus (GET /metrics)
+Всё читается из памяти процесса, без запросов к БД: время запросов по endpoint
+(request_metrics.py), открытые SSE и long-poll соединения, пул соединений БД,
+ошибки блокировки SQLite, очередь логов, принятые байты загрузок, память и CPU
+процесса (psutil).
+
+Метрики - на процесс: при нескольких воркерах Prometheus опрашивает каждый.
+"""
+
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    from .request_metrics import request_metrics
+    from .notifications import message_hub, event_bus
+    from .uploads import upload_counters
+except ImportError:
+    from request_metrics import request_metrics
+    from notifications import message_hub, event_bus
+    from uploads import upload_counters
+
+
+# Границы корзин времени запроса (секунды)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def escape_label(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value) -> str:
+    if isinstance(value, float):
+        return repr(value) if value != int(value) else f'{value:.1f}'
+    return str(value)
+
+
+class MetricsWriter:
+    """Текст в формате Prometheus 0.0.4: HELP/TYPE один раз на метрику"""
+
+    def __init__(self):
+        self._lines: List[str] = []
+
+    def metric(self, name: str, kind: str, help_text: str):
+        self._lines.append(f'# HELP {name} {help_text}')
+        self._lines.append(f'# TYPE {name} {kind}')
+
+    def sample(self, name: str, value, labels: Optional[Dict[str, object]] = None):
+        if labels:
+            rendered = ','.join(f'{key}="{escape_label(label)}"' for key, label in labels.items())
+            self._lines.append(f'{name}{{{rendered}}} {format_value(value)}')
+        else:
+            self._lines.append(f'{name} {format_value(value)}')
+
+    def gauge(self, name: str, help_text: str, value):
+        self.metric(name, 'gauge', help_text)
+        self.sample(name, value)
+
+    def counter(self, name: str, help_text: str, value):
+        self.metric(name, 'counter', help_text)
+        self.sample(name, value)
+
+    def text(self) -> str:
+        return '\n'.join(self._lines) + '\n'
+
+
+class ServerMetrics:
+    """Счётчики пула соединений и блокировок SQLite; сборка ответа /metrics"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._engines = set()
+        self.engine = None
+        self.pool_checkouts = 0
+        self.pool_wait_seconds = 0.0
+        self.pool_timeouts = 0
+        self.sqlite_lock_errors = 0
+        # TaskChatLogger.queue_stats (задаётся при настройке логирования)
+        self.log_queue_stats: Optional[Callable[[], Dict[str, object]]] = None
+        self._process = None
+
+    def instrument_engine(self, engine):
+        """Считать выдачи соединений пула, ожидание и таймауты пула, ошибки 'database is locked'"""
+        if id(engine) in self._engines:
+            return
+        self._engines.add(id(engine))
+
+        # У пула нет события "запрошено соединение" - замеряется сам вызов pool.connect()
+        pool = engine.pool
+        connect = pool.connect
+
+        def timed_connect():
+            started = time.perf_counter()
+            try:
+                return connect()
+            except PoolTimeoutError:
+                with self._lock:
+                    self.pool_timeouts += 1
+                raise
+            finally:
+                waited = time.perf_counter() - started
+                with self._lock:
+                    self.pool_checkouts += 1
+                    self.pool_wait_seconds += waited
+
+        pool.connect = timed_connect
+        self.engine = engine
+
+        @event.listens_for(engine, 'handle_error')
+        def count_lock_errors(context):
+            # busy_timeout истёк: SQLite ждал блокировку и сдался
+            message = str(context.original_exception).lower()
+            if 'database is locked' in message or 'database is busy' in message:
+                with self._lock:
+                    self.sqlite_lock_errors += 1
+
+    def process(self):
+        if psutil is None:
+            return None
+        if self._process is None:
+            self._process = psutil.Process(os.getpid())
+        return self._process
+
+    def write_requests(self, writer: MetricsWriter):
+        histograms = request_metrics.histograms()
+        rows = []
+        for key, timing in sorted(histograms.items()):
+            method, _, endpoint = key.partition(' ')
+            rows.append(({'method': method, 'endpoint': endpoint}, timing))
+
+        name = 'taskchat_http_request_duration_seconds'
+        writer.metric(name, 'histogram', 'Request wall time by endpoint (including long-poll waits)')
+        for labels, timing in rows:
+            for bound in LATENCY_BUCKETS:
+                writer.sample(f'{name}_bucket', timing.wall.count_at_most(int(bound * 1e6)),
+                              {**labels, 'le': bound})
+            writer.sample(f'{name}_bucket', timing.wall.count, {**labels, 'le': '+Inf'})
+            writer.sample(f'{name}_sum', timing.wall.total / 1e6, labels)
+            writer.sample(f'{name}_count', timing.wall.count, labels)
+
+        for name, kind, help_text, value in (
+            ('taskchat_http_request_db_seconds_total', 'counter', 'Time spent in SQL statements by endpoint',
+             lambda timing: timing.db.total / 1e6),
+            ('taskchat_http_request_sql_statements_total', 'counter', 'SQL statements executed by endpoint',
+             lambda timing: timing.statements.total),
+            ('taskchat_http_request_wait_seconds_total', 'counter', 'Long-poll wait time by endpoint',
+             lambda timing: timing.wait_us / 1e6),
+            ('taskchat_http_request_errors_total', 'counter', 'Responses with status 5xx by endpoint',
+             lambda timing: timing.errors),
+            ('taskchat_http_slow_requests_total', 'counter', 'Requests above SLOW_REQUEST_THRESHOLD by endpoint',
+             lambda timing: timing.slow),
+        ):
+            writer.metric(name, kind, help_text)
+            for labels, timing in rows:
+                writer.sample(name, value(timing), labels)
+
+    def write_database(self, writer: MetricsWriter):
+        pool = self.engine.pool if self.engine is not None else None
+        # QueuePool (продакшен); у пулов SQLite в памяти (тесты) размера нет
+        if isinstance(pool, QueuePool):
+            writer.gauge('taskchat_db_pool_size', 'Configured connection pool size', pool.size())
+            writer.gauge('taskchat_db_pool_checked_out', 'Connections currently checked out', pool.checkedout())
+            writer.gauge('taskchat_db_pool_overflow', 'Connections open above pool size', max(pool.overflow(), 0))
+        with self._lock:
+            checkouts, wait, timeouts, locked = (self.pool_checkouts, self.pool_wait_seconds,
+                                                 self.pool_timeouts, self.sqlite_lock_errors)
+        writer.counter('taskchat_db_pool_checkouts_total', 'Connections requested from the pool', checkouts)
+        writer.counter('taskchat_db_pool_wait_seconds_total', 'Time spent obtaining pool connections', wait)
+        writer.counter('taskchat_db_pool_timeouts_total', 'Pool checkouts that timed out', timeouts)
+        writer.counter('taskchat_sqlite_lock_errors_total',
+                       'Statements failed with "database is locked" after busy_timeout', locked)
+
+    def write_process(self, writer: MetricsWriter):
+        if self.log_queue_stats is not None:
+            stats = self.log_queue_stats()
+            writer.gauge('taskchat_log_queue_depth', 'Log records waiting for the writer thread', stats['depth'])
+            writer.gauge('taskchat_log_queue_size', 'Log queue capacity (0 - synchronous logging)', stats['size'])
+            writer.counter('taskchat_log_records_dropped_total', 'Log records dropped on full queue',
+                           stats['dropped'])
+
+        files, received = upload_counters.snapshot()
+        writer.counter('taskchat_upload_received_bytes_total', 'Upload bytes received (files and chunks)', received)
+        writer.counter('taskchat_upload_files_total', 'Uploaded files accepted', files)
+
+        process = self.process()
+        if process is None:
+            return
+        with process.oneshot():
+            cpu = process.cpu_times()
+            writer.counter('process_cpu_seconds_total', 'User and system CPU time', cpu.user + cpu.system)
+            writer.gauge('process_resident_memory_bytes', 'Resident memory size', process.memory_info().rss)
+            writer.gauge('process_start_time_seconds', 'Process start time (unix)', process.create_time())
+            writer.gauge('process_threads', 'OS threads in the process', process.num_threads())
+
+    def render(self) -> str:
+        """Ответ /metrics (без запросов к БД)"""
+        writer = MetricsWriter()
+        self.write_requests(writer)
+        writer.gauge('taskchat_sse_connections', 'Open SSE streams (/api/events)', event_bus.connections)
+        writer.gauge('taskchat_long_poll_waiting', 'Long-poll requests waiting for messages', message_hub.waiting)
+        self.write_database(writer)
+        self.write_process(writer)
+        return writer.text()
+
+
+# Глобальные метрики процесса
+server_metrics = ServerMetrics()
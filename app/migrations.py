@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Task-Chat - Миграции схемы БД
+db.create_all() создаёт только отсутствующие таблицы, поэтому изменения в уже
+существующих (индексы, новые столбцы) применяются здесь идемпотентными шагами
+при каждом запуске create_app.
+
+Проверка планов запросов (EXPLAIN QUERY PLAN) для polling-endpoint'ов на фиксированных
+данных в БД в памяти (то же проверяет tests/test_migrations.py):
+    python migrations.py --explain
+"""
+
+import re
+import sys
+from typing import Dict, List, Tuple
+
+from sqlalchemy import event, inspect
+
+
+def create_missing_indexes(db) -> List[str]:
+    """Создать индексы из моделей, которых ещё нет в БД (CREATE INDEX IF NOT EXISTS)"""
+    created = []
+    with db.engine.begin() as conn:
+        inspector = inspect(conn)
+        for table in db.metadata.sorted_tables:
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(bind=conn)
+                    created.append(index.name)
+    return created
+
+
+# Индексы, убранные из моделей: на существующих БД удаляются, чтобы не замедлять запись
+OBSOLETE_INDEXES = {
+    'chat_message': ('ix_chat_message_receiver_read', 'ix_chat_message_task_sender',
+                     'ix_chat_message_task_created', 'ix_chat_message_created_at'),
+    'dicom_instance': ('ix_dicom_instance_task_file',),
+}
+
+
+def drop_obsolete_indexes(db) -> List[str]:
+    """Удалить индексы из OBSOLETE_INDEXES, если они есть в БД (DROP INDEX)"""
+    dropped = []
+    with db.engine.begin() as conn:
+        inspector = inspect(conn)
+        tables = set(inspector.get_table_names())
+        for table, names in OBSOLETE_INDEXES.items():
+            if table not in tables:
+                continue
+            existing = {index['name'] for index in inspector.get_indexes(table)}
+            for name in names:
+                if name in existing:
+                    conn.exec_driver_sql(f'DROP INDEX "{name}"')
+                    dropped.append(name)
+    return dropped
+
+
+def add_missing_columns(db) -> List[str]:
+    """
+    Добавить в существующие таблицы столбцы моделей, которых нет в БД (ALTER TABLE ADD COLUMN).
+    Поддерживаются только столбцы, допускающие NULL, - их заполняют отдельные шаги.
+    """
+    added = []
+    with db.engine.begin() as conn:
+        inspector = inspect(conn)
+        for table in db.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing or not column.nullable:
+                    continue
+                column_type = column.type.compile(dialect=conn.dialect)
+                conn.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}')
+                added.append(f'{table.name}.{column.name}')
+    return added
+
+
+def dedupe_dicom_instances(db) -> List[str]:
+    """
+    Подготовить dicom_instance к уникальному индексу (task_file_id, member): NULL в member
+    (отдельный .dcm) -> '', удалить дубли, записанные параллельной индексацией
+    """
+    inspector = inspect(db.engine)
+    if 'dicom_instance' not in inspector.get_table_names():
+        return []
+    if 'ux_dicom_instance_file_member' in {index['name'] for index in inspector.get_indexes('dicom_instance')}:
+        return []
+    db.session.execute(db.text("UPDATE dicom_instance SET member = '' WHERE member IS NULL"))
+    removed = db.session.execute(db.text(
+        'DELETE FROM dicom_instance WHERE id NOT IN '
+        '(SELECT min(id) FROM dicom_instance GROUP BY task_file_id, member)'
+    ))
+    db.session.commit()
+    return [f'dicom_instance: {removed.rowcount} duplicates'] if removed.rowcount else []
+
+
+def backfill_last_message_ids(db) -> List[str]:
+    """Заполнить personal_chat.last_message_id у чатов с сообщениями, где он ещё пуст"""
+    result = db.session.execute(db.text(
+        'UPDATE personal_chat SET last_message_id = '
+        '(SELECT max(id) FROM personal_message WHERE personal_message.chat_id = personal_chat.id) '
+        'WHERE last_message_id IS NULL '
+        'AND EXISTS (SELECT 1 FROM personal_message WHERE personal_message.chat_id = personal_chat.id)'
+    ))
+    db.session.commit()
+    return [f'personal_chat: {result.rowcount}'] if result.rowcount else []
+
+
+def backfill_unread_counters(db) -> List[str]:
+    """Заполнить счётчики непрочитанных по сообщениям, если таблицы счётчиков только что созданы"""
+    try:
+        from .models import TaskUnread, PersonalChatUnread, ChatMessage, PersonalMessage
+    except ImportError:
+        from models import TaskUnread, PersonalChatUnread, ChatMessage, PersonalMessage
+
+    filled = []
+    for counter, message in ((TaskUnread, ChatMessage), (PersonalChatUnread, PersonalMessage)):
+        if db.session.query(counter.query.exists()).scalar():
+            continue
+        if db.session.query(message.query.filter(message.is_read == False).exists()).scalar():
+            counter.rebuild()
+            filled.append(counter.__tablename__)
+    db.session.commit()
+    return filled
+
+
+def backfill_storage_usage(db) -> List[str]:
+    """Заполнить учёт места по папке загрузок, если таблица storage_usage пуста"""
+    from flask import current_app
+    try:
+        from .models import StorageUsage
+        from .storage import reconcile_storage
+    except ImportError:
+        from models import StorageUsage
+        from storage import reconcile_storage
+
+    if db.session.query(StorageUsage.query.exists()).scalar():
+        return []
+    return reconcile_storage(db, current_app.config['UPLOAD_FOLDER'], current_app.config)
+
+
+# Шаги выполняются по порядку при каждом старте, каждый должен быть идемпотентным
+MIGRATIONS = (
+    add_missing_columns,
+    dedupe_dicom_instances,
+    create_missing_indexes,
+    drop_obsolete_indexes,
+    backfill_unread_counters,
+    backfill_last_message_ids,
+    backfill_storage_usage,
+)
+
+
+def run_migrations(db, logger=None):
+    """Применить все шаги миграции (вызывается в контексте приложения после create_all)"""
+    for step in MIGRATIONS:
+        result = step(db)
+        if result and logger:
+            logger.info(f'Migration {step.__name__}: {", ".join(result)}', extra={'category': 'database'})
+
+
+# ==================== ПРОВЕРКА ПЛАНОВ ЗАПРОСОВ ====================
+
+# Endpoint'ы, которые клиенты опрашивают периодически: (роль, URL-шаблон)
+POLLING_ENDPOINTS = (
+    ('doctor', '/api/tasks'),
+    ('physicist', '/api/tasks'),
+    ('doctor', '/api/tasks?since={since}'),
+    ('physicist', '/task/{task_id}/get_messages?last_id={message_id}'),
+    ('physicist', '/task/{task_id}/typing_status'),
+    ('physicist', '/api/task/{task_id}'),
+    ('doctor', '/chat/{chat_id}/typing_status'),
+    ('doctor', '/task/{task_id}/files'),
+    ('admin', '/admin/api/task/{task_id}'),
+    ('physicist', '/unread_messages'),
+    ('doctor', '/chat/{chat_id}/get_messages?last_id={personal_message_id}'),
+    ('doctor', '/api/personal_chats/unread_count'),
+    ('doctor', '/api/chats/list'),
+    ('doctor', '/api/chats/list?since={since}'),
+    ('doctor', '/api/online_users'),
+    ('admin', '/admin/api/stats'),
+)
+
+# Полный проход по таблице, для которой нет индекса под условие (SCAN без USING INDEX)
+TABLE_SCAN_RE = re.compile(r'^SCAN (\w+)\b(?! USING)')
+
+# Полные проходы, нужные endpoint'у по смыслу: (endpoint из POLLING_ENDPOINTS, таблица) -> причина.
+# Счётчики непрочитанных (task_unread, personal_chat_unread) читаются только по ключу
+# (user_id[, task_id/chat_id]) - их SCAN всегда ошибка.
+EXPECTED_SCANS = {
+    ('physicist /api/tasks', 'task'): 'физик видит все задачи',
+    ('admin /admin/api/stats', 'user'): 'пересчёт снимка статистики: пользователи по ролям',
+    ('admin /admin/api/stats', 'task'): 'пересчёт снимка статистики: задачи по статусам',
+    ('admin /admin/api/stats', 'personal_chat'): 'пересчёт снимка статистики: число личных чатов',
+}
+
+
+def seed_explain_fixtures(db, tasks: int = 20):
+    """
+    Фиксированные данные для проверки планов (пустая БД приложения в контексте, обычно
+    TestingConfig в памяти): врач, два физика, задачи с сообщениями и файлами, личный чат,
+    счётчики непрочитанных. Планы не зависят от содержимого рабочей БД.
+    """
+    try:
+        from .models import (User, Task, ChatMessage, TaskFile, PersonalChat, PersonalMessage,
+                             TaskUnread, PersonalChatUnread)
+    except ImportError:
+        from models import (User, Task, ChatMessage, TaskFile, PersonalChat, PersonalMessage,
+                            TaskUnread, PersonalChatUnread)
+
+    users = {}
+    for username, role in (('explain_doctor', 'doctor'), ('explain_physicist', 'physicist'),
+                           ('explain_physicist2', 'physicist'), ('explain_admin', 'admin')):
+        user = User(username=username, role=role, first_name=username, last_name='Explain', department='RO')
+        user.set_password(username)
+        db.session.add(user)
+        users.setdefault(role, user)
+    db.session.flush()
+    doctor, physicist = users['doctor'], users['physicist']
+
+    for number in range(tasks):
+        task = Task(title=f'Explain {number}', treatment='', ct_diagnostic='', doctor_id=doctor.id,
+                    physicist_id=physicist.id, status=('pending', 'in_progress', 'completed')[number % 3])
+        db.session.add(task)
+        db.session.flush()
+        db.session.add(TaskFile(task_id=task.id, uploader_id=doctor.id, original_filename='scan.pdf',
+                                stored_filename=f'explain_{number}.pdf', file_size=10, is_pdf=True))
+        for sender, receiver in ((doctor, physicist), (physicist, doctor)):
+            message = ChatMessage(task_id=task.id, sender_id=sender.id, receiver_id=receiver.id, content='explain')
+            db.session.add(message)
+        TaskUnread.increment(doctor.id, task.id)
+        TaskUnread.increment(physicist.id, task.id)
+
+    chat = PersonalChat(user1_id=doctor.id, user2_id=physicist.id)
+    db.session.add(chat)
+    db.session.flush()
+    for sender in (doctor, physicist):
+        message = PersonalMessage(chat_id=chat.id, sender_id=sender.id, content='explain')
+        db.session.add(message)
+        db.session.flush()
+        chat.last_message_id = message.id
+    PersonalChatUnread.increment(doctor.id, chat.id)
+    db.session.commit()
+    return users
+
+
+def explain_polling_endpoints(app, db) -> Dict[str, List[Tuple[str, List[str]]]]:
+    """
+    Выполнить polling-endpoint'ы тестовым клиентом на фиксированных данных
+    (seed_explain_fixtures) и получить EXPLAIN QUERY PLAN каждого SELECT
+
+    Args:
+        app: приложение с пустой БД в памяти (create_app('testing'))
+
+    Returns:
+        {'роль URL': [(sql, [строки плана]), ...]}
+
+    Raises:
+        ValueError: БД приложения не в памяти (данные проверки не пишутся в рабочую БД)
+        RuntimeError: endpoint не выполнен (нет данных для URL или ответ не 200)
+    """
+    from datetime import datetime, timedelta
+    try:
+        from .models import ChatMessage, PersonalChat, PersonalMessage
+    except ImportError:
+        from models import ChatMessage, PersonalChat, PersonalMessage
+
+    with app.app_context():
+        if db.engine.url.database not in (None, '', ':memory:'):
+            raise ValueError(f'EXPLAIN check needs an in-memory database, got {db.engine.url}')
+        users = seed_explain_fixtures(db)
+        doctor_id = users['doctor'].id
+        chat = PersonalChat.query.filter(
+            db.or_(PersonalChat.user1_id == doctor_id, PersonalChat.user2_id == doctor_id)
+        ).first()
+        values = {
+            'since': (datetime.utcnow() - timedelta(minutes=5)).isoformat(),
+            'task_id': db.session.query(db.func.max(ChatMessage.task_id)).scalar(),
+            'message_id': db.session.query(db.func.min(ChatMessage.id)).scalar(),
+            'chat_id': chat.id,
+            'personal_message_id': db.session.query(db.func.min(PersonalMessage.id)).scalar(),
+        }
+        user_ids = {role: user.id for role, user in users.items()}
+        engine = db.engine
+
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    plans = {}
+    event.listen(engine, 'before_cursor_execute', capture)
+    try:
+        for role, url_template in POLLING_ENDPOINTS:
+            url = url_template.format(**values)
+            client = app.test_client()
+            with client.session_transaction() as session:
+                session['_user_id'] = str(user_ids[role])
+                session['_fresh'] = True
+            statements.clear()
+            response = client.get(url)
+            if response.status_code != 200:
+                raise RuntimeError(f'{role} {url}: HTTP {response.status_code}')
+            plans[f'{role} {url_template}'] = list(statements)
+    finally:
+        event.remove(engine, 'before_cursor_execute', capture)
+
+    result = {}
+    with engine.connect() as conn:
+        for name, executed in plans.items():
+            result[name] = []
+            for statement, parameters in executed:
+                rows = conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters).fetchall()
+                result[name].append((statement, [row[-1] for row in rows]))
+    return result
+
+
+def find_table_scans(plans, tables) -> List[Tuple[str, str, str]]:
+    """
+    Полные сканирования таблиц в планах, кроме EXPECTED_SCANS: [(endpoint, таблица, sql)]
+
+    Args:
+        tables: имена таблиц БД (SCAN подзапросов anon_N не учитываются)
+    """
+    scans = []
+    for name, statements in plans.items():
+        for statement, plan in statements:
+            for line in plan:
+                match = TABLE_SCAN_RE.match(line)
+                if match and match.group(1) in tables and (name, match.group(1)) not in EXPECTED_SCANS:
+                    scans.append((name, match.group(1), statement))
+    return scans
+
+
+if __name__ == '__main__':
+    try:
+        from .app import create_app
+        from .models import db
+    except ImportError:
+        from app import create_app
+        from models import db
+
+    if '--explain' in sys.argv:
+        # Проверка всегда на фиксированных данных в БД в памяти, не на рабочей БД
+        application = create_app('testing')
+        plans = explain_polling_endpoints(application, db)
+        for name, statements in plans.items():
+            print(f'== {name}')
+            for statement, plan in statements:
+                print('   ' + ' '.join(statement.split())[:120])
+                for line in plan:
+                    print(f'      {line}')
+        scans = find_table_scans(plans, set(db.metadata.tables))
+        for name, table, _ in scans:
+            print(f'TABLE SCAN: {table} in {name}')
+        sys.exit(1 if scans else 0)
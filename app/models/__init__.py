@@ -2,9 +2,52 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+
+try:
+    from ..presence import presence_tracker
+    from ..previews import can_preview
+except ImportError:
+    from presence import presence_tracker
+    from previews import can_preview
 
 db = SQLAlchemy()
 
+# INSERT ... ON CONFLICT DO UPDATE по диалекту; в остальных СУБД - UPDATE, затем INSERT
+ON_CONFLICT_INSERTS = {'sqlite': sqlite_insert, 'postgresql': postgresql_insert}
+
+
+def upsert(model, values, key_columns, set_):
+    """
+    Вставить строку или обновить существующую по ключу key_columns (без commit)
+
+    Args:
+        values: значения новой строки
+        set_: {столбец: выражение} для существующей строки (например, count + 1)
+    """
+    insert = ON_CONFLICT_INSERTS.get(db.session.get_bind().dialect.name)
+    if insert is not None:
+        db.session.execute(insert(model).values(**values).on_conflict_do_update(index_elements=key_columns,
+                                                                                set_=set_))
+        return
+
+    key = [getattr(model, column) == values[column] for column in key_columns]
+    if db.session.execute(db.update(model).where(*key).values(set_)).rowcount:
+        return
+    try:
+        # Точка сохранения: при параллельной первой вставке откатывается только INSERT
+        with db.session.begin_nested():
+            db.session.execute(db.insert(model).values(**values))
+    except IntegrityError:
+        db.session.execute(db.update(model).where(*key).values(set_))
+
+
+def at_least_zero(expression):
+    """Выражение, но не меньше нуля (CASE вместо max()/GREATEST - одинаково во всех СУБД)"""
+    return db.case((expression > 0, expression), else_=0)
+
 
 class User(UserMixin, db.Model):
     __tablename__ = 'user'
@@ -19,13 +62,12 @@ class User(UserMixin, db.Model):
     department = db.Column(db.String(50), nullable=False)  # Отделение
     
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    last_seen = db.Column(db.DateTime, default=datetime.utcnow)
+    last_seen = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
     # Связи
     doctor_tasks = db.relationship('Task', foreign_keys='Task.doctor_id', backref='doctor', lazy=True)
     physicist_tasks = db.relationship('Task', foreign_keys='Task.physicist_id', backref='physicist', lazy=True)
     uploaded_files = db.relationship('TaskFile', foreign_keys='TaskFile.uploader_id', backref='uploader', lazy=True)
-    typing_statuses = db.relationship('TypingStatus', backref='user', lazy=True)
     sent_messages = db.relationship('ChatMessage', foreign_keys='ChatMessage.sender_id', backref='sender', lazy=True)
     received_messages = db.relationship('ChatMessage', foreign_keys='ChatMessage.receiver_id', backref='receiver', lazy=True)
 
@@ -36,12 +78,21 @@ class User(UserMixin, db.Model):
         return check_password_hash(self.password_hash, password)
 
     def update_last_seen(self):
-        self.last_seen = datetime.utcnow()
-        db.session.commit()
+        """Отметить активность (в памяти, в БД попадёт при сбросе трекера)"""
+        presence_tracker.touch(self.id)
+
+    @property
+    def last_activity(self):
+        """Последняя активность: отметка трекера процесса или last_seen из БД"""
+        tracked = presence_tracker.last_seen(self.id)
+        if tracked and (not self.last_seen or tracked > self.last_seen):
+            return tracked
+        return self.last_seen
 
     def is_online(self):
-        if self.last_seen:
-            return datetime.utcnow() - self.last_seen < timedelta(minutes=5)
+        last_activity = self.last_activity
+        if last_activity:
+            return datetime.utcnow() - last_activity < presence_tracker.online_window
         return False
 
     def get_full_name(self):
@@ -113,6 +164,13 @@ class Task(db.Model):
     chat_messages = db.relationship('ChatMessage', backref='task', lazy=True, cascade='all, delete-orphan')
     files = db.relationship('TaskFile', backref='task', lazy=True, cascade='all, delete-orphan')
 
+    __table_args__ = (
+        db.Index('ix_task_doctor_created', 'doctor_id', 'created_at'),  # задачи врача
+        db.Index('ix_task_created_at', 'created_at'),  # общий список задач (физик/админ)
+        db.Index('ix_task_updated_at', 'updated_at'),  # дельта-синхронизация /api/tasks
+        db.Index('ix_task_status', 'status'),  # статистика по статусам
+    )
+
     def get_status_display(self):
         statuses = {
             'pending': 'Ожидает',
@@ -135,6 +193,26 @@ class Task(db.Model):
         return f'<Task {self.title}>'
 
 
+class TaskTombstone(db.Model):
+    """Отметка об удалении задачи (для дельта-синхронизации /api/tasks)"""
+    __tablename__ = 'task_tombstone'
+
+    id = db.Column(db.Integer, primary_key=True)
+    task_id = db.Column(db.Integer, nullable=False)
+    # Если задан - задача не удалена, а переназначена и пропала только у этого врача
+    doctor_id = db.Column(db.Integer, nullable=True)
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    @classmethod
+    def prune(cls, retention) -> int:
+        """Удалить отметки старше retention (курсоры старше получают полную выгрузку), без commit"""
+        cutoff = datetime.utcnow() - retention
+        return db.session.execute(db.delete(cls).where(cls.deleted_at < cutoff)).rowcount
+
+    def __repr__(self):
+        return f'<TaskTombstone {self.task_id}>'
+
+
 class ChatMessage(db.Model):
     __tablename__ = 'chat_message'
 
@@ -146,6 +224,13 @@ class ChatMessage(db.Model):
     is_read = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_chat_message_task_receiver_read', 'task_id', 'receiver_id', 'is_read'),  # непрочитанные в задаче
+        db.Index('ix_chat_message_sender_task', 'sender_id', 'task_id'),  # задачи, где пользователь писал
+        db.Index('ix_chat_message_task_id', 'task_id', 'id'),  # история и страницы по курсору id
+        db.Index('ix_chat_message_created_task', 'created_at', 'task_id'),  # статистика: за день, активные чаты
+    )
+
     def __repr__(self):
         return f'<ChatMessage {self.id}>'
 
@@ -159,12 +244,21 @@ class PersonalChat(db.Model):
     user2_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Последнее сообщение (обновляется при отправке) - для списка чатов без поиска по сообщениям.
+    # Без ForeignKey: personal_message уже ссылается на personal_chat
+    last_message_id = db.Column(db.Integer, nullable=True)
 
     # Связи
     messages = db.relationship('PersonalMessage', backref='chat', lazy=True, cascade='all, delete-orphan')
+    last_message = db.relationship(
+        'PersonalMessage',
+        primaryjoin='foreign(PersonalChat.last_message_id) == PersonalMessage.id',
+        viewonly=True
+    )
 
     __table_args__ = (
-        db.UniqueConstraint('user1_id', 'user2_id', name='unique_user_pair'),
+        db.UniqueConstraint('user1_id', 'user2_id', name='unique_user_pair'),  # он же индекс по user1_id
+        db.Index('ix_personal_chat_user2', 'user2_id'),
     )
 
     def __repr__(self):
@@ -186,6 +280,13 @@ class PersonalMessage(db.Model):
     sender = db.relationship('User', foreign_keys=[sender_id], backref='sent_personal_messages')
     files = db.relationship('PersonalChatFile', backref='message', lazy=True, cascade='all, delete-orphan')
 
+    __table_args__ = (
+        db.Index('ix_personal_message_chat_read_sender', 'chat_id', 'is_read', 'sender_id'),  # непрочитанные в чате
+        db.Index('ix_personal_message_chat_created', 'chat_id', 'created_at'),  # история и последнее сообщение
+        db.Index('ix_personal_message_chat_id', 'chat_id', 'id'),  # страницы истории по курсору id
+        db.Index('ix_personal_message_created_at', 'created_at'),  # активные чаты за период
+    )
+
     def __repr__(self):
         return f'<PersonalMessage {self.id}>'
 
@@ -195,11 +296,12 @@ class PersonalChatFile(db.Model):
     __tablename__ = 'personal_chat_file'
 
     id = db.Column(db.Integer, primary_key=True)
-    message_id = db.Column(db.Integer, db.ForeignKey('personal_message.id'), nullable=True)
+    message_id = db.Column(db.Integer, db.ForeignKey('personal_message.id'), nullable=True, index=True)
     original_filename = db.Column(db.String(255), nullable=False)
     stored_filename = db.Column(db.String(255), nullable=False)
     file_size = db.Column(db.Integer, nullable=False)
     mime_type = db.Column(db.String(100), nullable=True)
+    sha256 = db.Column(db.String(64), nullable=True)  # считается при приёме файла
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     is_image = db.Column(db.Boolean, default=False)
@@ -208,6 +310,13 @@ class PersonalChatFile(db.Model):
     def file_size_mb(self):
         return round(self.file_size / (1024 * 1024), 2)
 
+    @property
+    def thumb_url(self):
+        """URL превью (previews.py) - для изображений и PDF (если есть pypdfium2), прикреплённых к сообщению"""
+        if self.message_id and (self.is_image or (self.mime_type == 'application/pdf' and can_preview('pdf'))):
+            return f'/chat/{self.message.chat_id}/files/{self.id}/thumb'
+        return None
+
     def __repr__(self):
         return f'<PersonalChatFile {self.original_filename}>'
 
@@ -216,19 +325,27 @@ class TaskFile(db.Model):
     __tablename__ = 'task_file'
     
     id = db.Column(db.Integer, primary_key=True)
-    task_id = db.Column(db.Integer, db.ForeignKey('task.id'), nullable=False)
+    task_id = db.Column(db.Integer, db.ForeignKey('task.id'), nullable=False, index=True)
     uploader_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     original_filename = db.Column(db.String(255), nullable=False)
     stored_filename = db.Column(db.String(255), nullable=False)  # Уникальное имя на диске
     file_size = db.Column(db.Integer, nullable=False)  # Размер в байтах
     mime_type = db.Column(db.String(100), nullable=True)
+    sha256 = db.Column(db.String(64), nullable=True)  # считается при приёме файла
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
     
-    # Флаги типа файла
+    # Флаги типа файла (по сигнатуре содержимого, uploads.detect_file_type)
     is_image = db.Column(db.Boolean, default=False)
     is_pdf = db.Column(db.Boolean, default=False)
     is_dicom = db.Column(db.Boolean, default=False)
     is_archive = db.Column(db.Boolean, default=False)
+    # заголовки DICOM записаны в dicom_instance (False - индексируется, NULL - ещё не индексирован)
+    dicom_indexed = db.Column(db.Boolean, nullable=True)
+    dicom_claimed_at = db.Column(db.DateTime, nullable=True)  # когда фоновый поток занял файл
+
+    __table_args__ = (
+        db.Index('ix_task_file_dicom_pending', 'dicom_indexed', 'is_dicom', 'is_archive'),  # очередь индекса DICOM
+    )
 
     @property
     def file_size_mb(self):
@@ -247,6 +364,13 @@ class TaskFile(db.Model):
             return f'/task/{self.task_id}/files/{self.id}/view'
         return self.download_url
 
+    @property
+    def thumb_url(self):
+        """URL превью (previews.py) - для изображений и PDF (если есть pypdfium2)"""
+        if self.is_image or (self.is_pdf and can_preview('pdf')):
+            return f'/task/{self.task_id}/files/{self.id}/thumb'
+        return None
+
     def get_icon_class(self):
         """Возвращает класс иконки Font Awesome"""
         if self.is_image:
@@ -263,20 +387,255 @@ class TaskFile(db.Model):
         return f'<TaskFile {self.original_filename}>'
 
 
-class TypingStatus(db.Model):
-    __tablename__ = 'typing_status'
+class UnreadCounterMixin:
+    """
+    Денормализованный счётчик непрочитанных: строка на (пользователь, чат)
+
+    Методы меняют счётчик в текущей транзакции (без commit) - вызываются рядом
+    с вставкой сообщения или отметкой о прочтении, коммитит вызывающий код.
+    """
+    SCOPE_COLUMN = None  # имя столбца с ID чата
+
+    @classmethod
+    def _key(cls, user_id, scope_id):
+        return (cls.user_id == user_id) & (getattr(cls, cls.SCOPE_COLUMN) == scope_id)
+
+    @classmethod
+    def increment(cls, user_id, scope_id, by=1):
+        """Увеличить счётчик (UPSERT - без гонки на первой вставке)"""
+        upsert(cls, {'user_id': user_id, 'count': by, cls.SCOPE_COLUMN: scope_id},
+               ['user_id', cls.SCOPE_COLUMN], {'count': cls.count + by})
+
+    @classmethod
+    def decrement(cls, user_id, scope_id, by=1):
+        """Уменьшить счётчик (не ниже нуля)"""
+        if by > 0:
+            db.session.execute(
+                db.update(cls).where(cls._key(user_id, scope_id)).values(count=at_least_zero(cls.count - by))
+            )
+
+    @classmethod
+    def reset(cls, user_id, scope_id):
+        """Всё прочитано - строка счётчика не нужна"""
+        db.session.execute(db.delete(cls).where(cls._key(user_id, scope_id)))
+
+    @classmethod
+    def get_count(cls, user_id, scope_id):
+        """Непрочитанные пользователя в одном чате (поиск по первичному ключу)"""
+        counter = db.session.get(cls, (user_id, scope_id))
+        return counter.count if counter else 0
+
+    @classmethod
+    def counts_for_user(cls, user_id):
+        """{ID чата: непрочитанные} по всем чатам пользователя с непрочитанными"""
+        scope_column = getattr(cls, cls.SCOPE_COLUMN)
+        return dict(db.session.query(scope_column, cls.count).filter(cls.user_id == user_id, cls.count > 0).all())
+
+    @classmethod
+    def total_for_user(cls, user_id):
+        """Всего непрочитанных пользователя"""
+        return db.session.query(db.func.coalesce(db.func.sum(cls.count), 0)).filter(cls.user_id == user_id).scalar()
+
+    @classmethod
+    def delete_for(cls, user_id=None, scope_ids=None):
+        """Удалить счётчики пользователя и/или чатов (при удалении пользователя, задачи, чата)"""
+        query = db.delete(cls)
+        if user_id is not None:
+            query = query.where(cls.user_id == user_id)
+        if scope_ids is not None:
+            query = query.where(getattr(cls, cls.SCOPE_COLUMN).in_(scope_ids))
+        db.session.execute(query)
+
+
+class TaskUnread(UnreadCounterMixin, db.Model):
+    """Непрочитанные сообщения чата задачи для получателя (ChatMessage.receiver_id)"""
+    __tablename__ = 'task_unread'
+    SCOPE_COLUMN = 'task_id'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    task_id = db.Column(db.Integer, db.ForeignKey('task.id'), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def rebuild(cls):
+        """Пересчитать все счётчики по chat_message (миграция, сверка)"""
+        db.session.execute(db.delete(cls))
+        db.session.execute(db.insert(cls).from_select(
+            ['user_id', 'task_id', 'count'],
+            db.select(ChatMessage.receiver_id, ChatMessage.task_id, db.func.count(ChatMessage.id))
+            .where(ChatMessage.is_read == False)
+            .group_by(ChatMessage.receiver_id, ChatMessage.task_id)
+        ))
 
-    id = db.Column(db.Integer, primary_key=True)
-    task_id = db.Column(db.Integer, db.ForeignKey('task.id'), nullable=True)
-    chat_id = db.Column(db.Integer, db.ForeignKey('personal_chat.id'), nullable=True)
+    def __repr__(self):
+        return f'<TaskUnread user={self.user_id} task={self.task_id}: {self.count}>'
+
+
+class PersonalChatUnread(UnreadCounterMixin, db.Model):
+    """Непрочитанные сообщения личного чата для собеседника отправителя"""
+    __tablename__ = 'personal_chat_unread'
+    SCOPE_COLUMN = 'chat_id'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    chat_id = db.Column(db.Integer, db.ForeignKey('personal_chat.id'), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def rebuild(cls):
+        """Пересчитать все счётчики по personal_message (миграция, сверка)"""
+        receiver_id = db.case(
+            (PersonalMessage.sender_id == PersonalChat.user1_id, PersonalChat.user2_id),
+            else_=PersonalChat.user1_id
+        )
+        db.session.execute(db.delete(cls))
+        db.session.execute(db.insert(cls).from_select(
+            ['user_id', 'chat_id', 'count'],
+            db.select(receiver_id, PersonalMessage.chat_id, db.func.count(PersonalMessage.id))
+            .join(PersonalChat, PersonalChat.id == PersonalMessage.chat_id)
+            .where(PersonalMessage.is_read == False)
+            .group_by(receiver_id, PersonalMessage.chat_id)
+        ))
+
+    def __repr__(self):
+        return f'<PersonalChatUnread user={self.user_id} chat={self.chat_id}: {self.count}>'
+
+
+class StorageUsage(db.Model):
+    """
+    Занятое место в папке загрузок: строка на (каталог, тип файла)
+
+    Меняется в транзакции загрузки/удаления файла (без commit), периодически
+    сверяется с диском (storage.reconcile_storage).
+    """
+    __tablename__ = 'storage_usage'
+
+    directory = db.Column(db.String(64), primary_key=True)  # tasks, personal_chats, ...
+    file_type = db.Column(db.String(16), primary_key=True)  # images, pdf, dicom, archives, other
+    files = db.Column(db.Integer, nullable=False, default=0)
+    bytes = db.Column(db.BigInteger, nullable=False, default=0)
+
+    @classmethod
+    def add(cls, directory, file_type, size, files=1):
+        """Учесть загруженные файлы (UPSERT)"""
+        upsert(cls, {'directory': directory, 'file_type': file_type, 'files': files, 'bytes': size},
+               ['directory', 'file_type'], {'files': cls.files + files, 'bytes': cls.bytes + size})
+
+    @classmethod
+    def subtract(cls, directory, file_type, size, files=1):
+        """Учесть удалённые файлы (не ниже нуля)"""
+        db.session.execute(
+            db.update(cls).where((cls.directory == directory) & (cls.file_type == file_type)).values(
+                files=at_least_zero(cls.files - files),
+                bytes=at_least_zero(cls.bytes - size)
+            )
+        )
+
+    def __repr__(self):
+        return f'<StorageUsage {self.directory}/{self.file_type}: {self.files} files, {self.bytes} bytes>'
+
+
+class FileBlob(db.Model):
+    """
+    Файл в хранилище по содержимому (blobstore.py): счётчик ссылок TaskFile / PersonalChatFile
+
+    acquire/release меняют счётчик в транзакции загрузки/удаления (без commit).
+    """
+    __tablename__ = 'file_blob'
+
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    file_type = db.Column(db.String(16), nullable=False)  # images, pdf, dicom, archives, other
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_file_blob_refcount', 'refcount'),  # сборка блобов без ссылок
+    )
+
+    @classmethod
+    def acquire(cls, sha256, size, file_type):
+        """Добавить ссылку (UPSERT)"""
+        upsert(cls, {'sha256': sha256, 'size': size, 'file_type': file_type, 'refcount': 1},
+               ['sha256'], {'refcount': cls.refcount + 1})
+
+    @classmethod
+    def release(cls, sha256):
+        """Убрать ссылку (не ниже нуля; строку удаляет сборка)"""
+        db.session.execute(
+            db.update(cls).where(cls.sha256 == sha256).values(refcount=at_least_zero(cls.refcount - 1))
+        )
+
+    def __repr__(self):
+        return f'<FileBlob {self.sha256[:12]} refs={self.refcount}>'
+
+
+class UploadSession(db.Model):
+    """
+    Загрузка файла в задачу частями с возобновлением (uploads.py): принято received байт из size.
+    Данные - во временном файле UPLOAD_FOLDER/.incoming/<id>.upload, TaskFile создаётся при завершении.
+    """
+    __tablename__ = 'upload_session'
+
+    id = db.Column(db.String(32), primary_key=True)
+    task_id = db.Column(db.Integer, db.ForeignKey('task.id'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    is_typing = db.Column(db.Boolean, default=False)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    filename = db.Column(db.String(255), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    received = db.Column(db.BigInteger, nullable=False, default=0)
+    # 'uploading' (NULL у сессий, созданных до столбца) или 'finalizing' - файл переносится в хранилище
+    status = db.Column(db.String(16), nullable=True, default='uploading')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_upload_session_updated_at', 'updated_at'),  # удаление брошенных загрузок
+        db.Index('ix_upload_session_task_id', 'task_id'),  # удаление вместе с задачей
+    )
+
+    @property
+    def finalizing(self):
+        return self.status == 'finalizing'
+
+    def to_dict(self):
+        return {
+            'upload_id': self.id,
+            'task_id': self.task_id,
+            'filename': self.filename,
+            'size': self.size,
+            'offset': self.received
+        }
+
+    def __repr__(self):
+        return f'<UploadSession {self.id} {self.received}/{self.size}>'
+
+
+class DicomInstance(db.Model):
+    """
+    Заголовок DICOM-файла задачи (dicom_headers.py): отдельный .dcm или файл внутри zip-архива.
+    Пишется при загрузке - сводка серий не открывает файлы.
+    """
+    __tablename__ = 'dicom_instance'
+
+    id = db.Column(db.Integer, primary_key=True)
+    task_id = db.Column(db.Integer, db.ForeignKey('task.id'), nullable=False)
+    task_file_id = db.Column(db.Integer, db.ForeignKey('task_file.id'), nullable=False)
+    member = db.Column(db.String(255), nullable=False, default='')  # путь внутри архива ('' - отдельный .dcm)
+    size = db.Column(db.BigInteger, nullable=False, default=0)
+    modality = db.Column(db.String(16), nullable=True)
+    study_instance_uid = db.Column(db.String(64), nullable=True)
+    series_instance_uid = db.Column(db.String(64), nullable=True)
+    sop_instance_uid = db.Column(db.String(64), nullable=True)
+    series_number = db.Column(db.Integer, nullable=True)
+    instance_number = db.Column(db.Integer, nullable=True)
+    series_description = db.Column(db.String(255), nullable=True)
+    slice_thickness = db.Column(db.Float, nullable=True)
 
     __table_args__ = (
-        db.UniqueConstraint('task_id', 'user_id', name='unique_task_user_typing'),
-        db.UniqueConstraint('chat_id', 'user_id', name='unique_chat_user_typing'),
+        db.Index('ix_dicom_instance_task_series', 'task_id', 'series_instance_uid'),  # сводка серий задачи
+        db.Index('ix_dicom_instance_task_modality', 'task_id', 'modality'),  # фильтр по модальности
+        # удаление вместе с файлом; один заголовок на файл архива - повторная индексация не удваивает серии
+        db.Index('ux_dicom_instance_file_member', 'task_file_id', 'member', unique=True),
     )
 
     def __repr__(self):
-        return f'<TypingStatus User:{self.user_id} Task:{self.task_id} Chat:{self.chat_id}>'
+        return f'<DicomInstance {self.modality} {self.series_instance_uid}>'
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Task-Chat - In-process notification hub
+Хаб уведомлений для long-poll запросов: пробуждает ожидающие потоки
+при появлении новых сообщений в чате задачи или личном чате.
+Шина событий для SSE-потока пользователя (/api/events).
+
+Работает в пределах одного процесса. При нескольких воркерах
+ожидающий запрос всё равно завершится по таймауту и перечитает БД.
+"""
+
+import queue
+import threading
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+
+
+class MessageHub:
+    """
+    Счётчики версий по ключам (('task', id), ('chat', id)) с ожиданием изменений
+
+    publish(key) увеличивает версию ключа и будит только потоки, ждущие этот ключ.
+    Ожидающий сначала берёт version(key), затем читает БД и только потом вызывает
+    wait(key, version, timeout) - так публикация между чтением и ожиданием не теряется.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions: Dict[Hashable, int] = {}
+        self._conditions: Dict[Hashable, threading.Condition] = {}
+        self._waiters: Dict[Hashable, int] = {}
+
+    def version(self, key: Hashable) -> int:
+        """Текущая версия ключа"""
+        with self._lock:
+            return self._versions.get(key, 0)
+
+    def publish(self, key: Hashable):
+        """Отметить изменение по ключу и разбудить ожидающих"""
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            condition = self._conditions.get(key)
+            if condition is not None:
+                condition.notify_all()
+
+    def wait(self, key: Hashable, version: int, timeout: float) -> bool:
+        """
+        Ждать, пока версия ключа отличается от version
+
+        Returns:
+            True - было изменение, False - истёк таймаут
+        """
+        with self._lock:
+            condition = self._conditions.get(key)
+            if condition is None:
+                condition = self._conditions[key] = threading.Condition(self._lock)
+            self._waiters[key] = self._waiters.get(key, 0) + 1
+            try:
+                return condition.wait_for(lambda: self._versions.get(key, 0) != version, timeout)
+            finally:
+                self._waiters[key] -= 1
+                if not self._waiters[key]:
+                    # Никто больше не ждёт - не держим Condition для неактивных чатов
+                    del self._waiters[key]
+                    del self._conditions[key]
+
+    @property
+    def waiting(self) -> int:
+        """Количество потоков, ожидающих сейчас"""
+        with self._lock:
+            return sum(self._waiters.values())
+
+
+class Subscription:
+    """Подписка одного SSE-соединения: ограниченная очередь событий"""
+
+    def __init__(self, user_id: int, role: str, maxsize: int):
+        self.user_id = user_id
+        self.role = role
+        self.queue: "queue.Queue[Tuple[str, dict]]" = queue.Queue(maxsize=maxsize)
+
+    def put(self, event: str, data: dict):
+        """Положить событие; у медленного клиента вытесняем самое старое"""
+        while True:
+            try:
+                self.queue.put_nowait((event, data))
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout: float) -> Optional[Tuple[str, dict]]:
+        """Следующее событие или None по таймауту"""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventBus:
+    """
+    Шина типизированных событий для SSE (unread, typing, task_updated, message, presence)
+
+    Адресация без запросов к БД: по ID пользователей и/или по ролям подписчиков.
+    """
+
+    EVENTS = ('unread', 'typing', 'task_updated', 'message', 'presence')
+
+    def __init__(self, queue_size: int = 100):
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._subscriptions: Dict[int, List[Subscription]] = {}
+
+    def subscribe(self, user_id: int, role: str, max_total: Optional[int] = None,
+                  max_per_user: Optional[int] = None) -> Optional[Subscription]:
+        """
+        Открыть подписку; первое соединение пользователя рассылает presence
+
+        Returns:
+            Подписка или None, если открыто уже max_total потоков или max_per_user у пользователя
+        """
+        subscription = Subscription(user_id, role, self.queue_size)
+        with self._lock:
+            if max_total is not None and sum(map(len, self._subscriptions.values())) >= max_total:
+                return None
+            if max_per_user is not None and len(self._subscriptions.get(user_id, ())) >= max_per_user:
+                return None
+            first = user_id not in self._subscriptions
+            self._subscriptions.setdefault(user_id, []).append(subscription)
+        if first:
+            self.broadcast('presence', {'user_id': user_id, 'is_online': True})
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """Закрыть подписку"""
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id, [])
+            if subscription in subscriptions:
+                subscriptions.remove(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.user_id, None)
+
+    def publish(
+        self,
+        event: str,
+        data: dict,
+        user_ids: Iterable[int] = (),
+        roles: Iterable[str] = (),
+        exclude: Optional[int] = None
+    ):
+        """Отправить событие пользователям user_ids и всем подписчикам с ролями roles"""
+        user_ids = set(user_ids)
+        roles = set(roles)
+        with self._lock:
+            targets = [
+                subscription
+                for user_id, subscriptions in self._subscriptions.items()
+                if user_id != exclude
+                for subscription in subscriptions
+                if user_id in user_ids or subscription.role in roles
+            ]
+        for subscription in targets:
+            subscription.put(event, data)
+
+    def broadcast(self, event: str, data: dict):
+        """Отправить событие всем подписчикам"""
+        with self._lock:
+            targets = [s for subscriptions in self._subscriptions.values() for s in subscriptions]
+        for subscription in targets:
+            subscription.put(event, data)
+
+    def is_connected(self, user_id: int) -> bool:
+        """Есть ли у пользователя открытый SSE-поток"""
+        with self._lock:
+            return user_id in self._subscriptions
+
+    @property
+    def connections(self) -> int:
+        """Количество открытых SSE-соединений"""
+        with self._lock:
+            return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+
+# Глобальные экземпляры процесса
+message_hub = MessageHub()
+event_bus = EventBus()
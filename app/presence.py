@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Task-Chat - Учёт присутствия пользователей
+last_seen обновляется в памяти на каждом запросе и сбрасывается в таблицу user
+одним пакетным UPDATE раз в PRESENCE_FLUSH_INTERVAL секунд (фоновый поток),
+вместо commit на каждый запрос.
+"""
+
+import atexit
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Set
+
+
+class PresenceTracker:
+    """Отметки last_seen в памяти с периодическим сбросом в БД"""
+
+    def __init__(self, online_window: timedelta = timedelta(minutes=5)):
+        self.online_window = online_window
+        self._lock = threading.Lock()
+        self._last_seen: Dict[int, datetime] = {}  # все известные отметки процесса
+        self._dirty: Dict[int, datetime] = {}      # ещё не записанные в БД
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def touch(self, user_id: int, now: Optional[datetime] = None):
+        """Отметить активность пользователя"""
+        now = now or datetime.utcnow()
+        with self._lock:
+            self._last_seen[user_id] = now
+            self._dirty[user_id] = now
+
+    def last_seen(self, user_id: int) -> Optional[datetime]:
+        """Последняя отметка в памяти процесса"""
+        with self._lock:
+            return self._last_seen.get(user_id)
+
+    def online_user_ids(self) -> Set[int]:
+        """ID пользователей, активных в пределах online_window (по данным процесса)"""
+        cutoff = datetime.utcnow() - self.online_window
+        with self._lock:
+            return {user_id for user_id, seen in self._last_seen.items() if seen >= cutoff}
+
+    def forget(self, user_id: int):
+        """Убрать пользователя (например, после удаления)"""
+        with self._lock:
+            self._last_seen.pop(user_id, None)
+            self._dirty.pop(user_id, None)
+
+    def flush(self, db, user_model) -> int:
+        """
+        Записать накопленные отметки одним пакетным UPDATE
+
+        Returns:
+            Количество обновлённых пользователей
+        """
+        with self._lock:
+            pending, self._dirty = self._dirty, {}
+        if not pending:
+            return 0
+
+        try:
+            # Core executemany без проверки числа строк: отметка удалённого пользователя
+            # (удалён в другом воркере или во время сброса) просто ничего не обновляет
+            table = user_model.__table__
+            db.session.execute(
+                db.update(table).where(table.c.id == db.bindparam('user_id')).values(last_seen=db.bindparam('seen')),
+                [{'user_id': user_id, 'seen': seen} for user_id, seen in pending.items()]
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            # Вернём отметки, чтобы записать их в следующий раз (если не появились более свежие)
+            with self._lock:
+                for user_id, seen in pending.items():
+                    if user_id not in self._dirty:
+                        self._dirty[user_id] = seen
+            raise
+        return len(pending)
+
+    def start(self, app, db, user_model, interval: float):
+        """Запустить фоновый сброс (один поток на процесс) и сброс при завершении"""
+        if self._thread is not None:
+            return
+
+        def flush_in_context():
+            with app.app_context():
+                try:
+                    self.flush(db, user_model)
+                except Exception as e:
+                    app.logger.error(f'Presence flush failed: {e}', extra={'category': 'database'})
+                finally:
+                    db.session.remove()
+
+        def run():
+            while not self._stop.wait(interval):
+                flush_in_context()
+
+        self._thread = threading.Thread(target=run, name='presence-flush', daemon=True)
+        self._thread.start()
+        atexit.register(flush_in_context)
+
+
+# Глобальный трекер процесса
+presence_tracker = PresenceTracker()
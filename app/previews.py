@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Task-Chat - Превью загруженных файлов
+Уменьшенные копии изображений и первой страницы PDF (IMAGE_THUMBNAIL_SIZE, WebP или JPEG)
+для карточек задач и чатов. Создаются в фоне после загрузки (PreviewGenerator) и лежат
+в UPLOAD_FOLDER/previews/<key[:2]>/<key>.<ext> - по тому же ключу, что и блобы
+(SHA-256 содержимого); отсутствующее превью создаётся при первом запросе.
+
+Превью - кэш: в учёт места не входит, удаляется вместе с блобом.
+Pillow и pypdfium2 (PDF) - опциональные зависимости: без них превью не создаются,
+а /thumb отдаёт изображение как есть.
+"""
+
+import hashlib
+import os
+import queue
+import threading
+from typing import Optional
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:
+    Image = None
+
+try:
+    import pypdfium2
+except ImportError:
+    pypdfium2 = None
+
+
+PREVIEWS_DIRECTORY = 'previews'
+PREVIEW_EXTENSIONS = {'WEBP': 'webp', 'JPEG': 'jpg'}
+FAILED_SUFFIX = '.failed'  # отметка рядом с путём превью: файл не удалось разобрать
+
+
+def preview_key(directory: str, stored_filename: str, sha256: Optional[str]) -> str:
+    """Ключ превью: SHA-256 содержимого (общий для одинаковых файлов) или хэш пути файла старого формата"""
+    if sha256:
+        return sha256
+    return hashlib.sha256(f'{directory}/{stored_filename}'.encode('utf-8')).hexdigest()
+
+
+def preview_format(config) -> str:
+    """WEBP, если Pillow собран с libwebp, иначе JPEG"""
+    fmt = config['PREVIEW_FORMAT'].upper()
+    if fmt == 'WEBP' and Image is not None and not features.check('webp'):
+        return 'JPEG'
+    return fmt if fmt in PREVIEW_EXTENSIONS else 'JPEG'
+
+
+def preview_path(upload_folder, key: str, config) -> str:
+    ext = PREVIEW_EXTENSIONS[preview_format(config)]
+    return os.path.join(upload_folder, PREVIEWS_DIRECTORY, key[:2], f'{key}.{ext}')
+
+
+def can_preview(file_type: Optional[str]) -> bool:
+    if Image is None:
+        return False
+    return file_type == 'images' or (file_type == 'pdf' and pypdfium2 is not None)
+
+
+def render_preview(source, file_type: str, config):
+    """Уменьшенное изображение (PIL.Image) изображения или первой страницы PDF"""
+    size = tuple(config['IMAGE_THUMBNAIL_SIZE'])
+    if file_type == 'pdf':
+        pdf = pypdfium2.PdfDocument(source)
+        try:
+            page = pdf[0]
+            width, height = page.get_size()
+            image = page.render(scale=min(size[0] / width, size[1] / height, 1)).to_pil()
+        finally:
+            pdf.close()
+    else:
+        image = Image.open(source)
+        image.draft('RGB', size)  # JPEG декодируется сразу в уменьшенном масштабе
+        image = ImageOps.exif_transpose(image)
+    image.thumbnail(size)
+    if image.mode not in ('RGB', 'RGBA') or (image.mode == 'RGBA' and preview_format(config) == 'JPEG'):
+        image = image.convert('RGB')
+    return image
+
+
+def generate_preview(source, key: str, file_type: str, upload_folder, config) -> Optional[str]:
+    """
+    Создать превью, если его ещё нет
+
+    Returns:
+        Путь к превью или None (тип не поддерживается, нет Pillow, файл не читается)
+    """
+    path = preview_path(upload_folder, key, config)
+    if os.path.exists(path):
+        return path
+    failed_path = f'{path}{FAILED_SUFFIX}'
+    if not can_preview(file_type) or os.path.exists(failed_path):
+        return None
+    try:
+        image = render_preview(source, file_type, config)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        # Повреждённый файл, неподдерживаемый вариант формата, слишком большое изображение.
+        # Содержимое по ключу не меняется - отметка, чтобы не разбирать файл на каждый запрос
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(failed_path, 'wb').close()
+        return None
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Фоновый поток и запрос могут создавать одно превью одновременно - запись атомарная
+    temp_path = f'{path}.{threading.get_ident()}.tmp'
+    try:
+        image.save(temp_path, preview_format(config), quality=config['PREVIEW_QUALITY'])
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return path
+
+
+def remove_previews(upload_folder, key: str):
+    """Удалить превью всех форматов и отметки о неудаче (файл удалён)"""
+    for ext in PREVIEW_EXTENSIONS.values():
+        for suffix in ('', FAILED_SUFFIX):
+            try:
+                os.remove(os.path.join(upload_folder, PREVIEWS_DIRECTORY, key[:2], f'{key}.{ext}{suffix}'))
+            except FileNotFoundError:
+                pass
+
+
+class PreviewGenerator:
+    """Фоновое создание превью после загрузки (один поток на процесс)"""
+
+    def __init__(self, max_pending: int = 1000):
+        self._queue: queue.Queue = queue.Queue(maxsize=max_pending)
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, source, key: str, file_type: str):
+        """
+        Поставить превью в очередь. Без запущенного потока (тесты) или при переполненной
+        очереди превью создаётся при первом запросе
+        """
+        if self._thread is None or not can_preview(file_type):
+            return
+        try:
+            self._queue.put_nowait((source, key, file_type))
+        except queue.Full:
+            pass
+
+    def start(self, app):
+        """Запустить фоновый поток"""
+        if self._thread is not None:
+            return
+
+        def run():
+            while True:
+                source, key, file_type = self._queue.get()
+                try:
+                    generate_preview(source, key, file_type, app.config['UPLOAD_FOLDER'], app.config)
+                except Exception as e:
+                    app.logger.error(f'Preview generation failed for {key}: {e}', extra={'category': 'files'})
+
+        self._thread = threading.Thread(target=run, name='preview-generator', daemon=True)
+        self._thread.start()
+
+
+# Глобальный генератор превью процесса
+preview_generator = PreviewGenerator()
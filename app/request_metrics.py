@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Task-Chat - Время обработки запросов по endpoint
+На каждый запрос замеряются полное время, время в БД (события SQLAlchemy
+before/after_cursor_execute) и число SQL-запросов; значения пишутся в гистограммы
+в памяти процесса по endpoint. Запрос дольше SLOW_REQUEST_THRESHOLD секунд
+(без ожидания long-poll) пишется в лог (категория api).
+
+Гистограммы - логарифмически-линейные, как в HdrHistogram: значения до 32 точные,
+дальше 16 корзин на каждую степень двойки (погрешность квантилей не больше 6%).
+"""
+
+import threading
+import time
+from typing import Dict, List, Optional
+
+from sqlalchemy import event
+
+
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS        # 32 точных значения
+HALF_SUB_BUCKETS = SUB_BUCKETS // 2       # 16 корзин на степень двойки
+BUCKETS = SUB_BUCKETS + 40 * HALF_SUB_BUCKETS  # до 2**44 (~200 суток в мкс)
+
+SORT_KEYS = ('total_ms', 'requests', 'db_ms', 'wait_ms', 'errors', 'slow')
+
+
+def bucket_index(value: int) -> int:
+    if value < SUB_BUCKETS:
+        return max(value, 0)
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    index = SUB_BUCKETS + (shift - 1) * HALF_SUB_BUCKETS + (value >> shift) - HALF_SUB_BUCKETS
+    return min(index, BUCKETS - 1)
+
+
+def bucket_upper_bound(index: int) -> int:
+    """Наибольшее значение, попадающее в корзину"""
+    if index < SUB_BUCKETS:
+        return index
+    shift = (index - SUB_BUCKETS) // HALF_SUB_BUCKETS + 1
+    top = (index - SUB_BUCKETS) % HALF_SUB_BUCKETS + HALF_SUB_BUCKETS
+    return ((top + 1) << shift) - 1
+
+
+class Histogram:
+    """Гистограмма целых неотрицательных значений (микросекунды, число запросов)"""
+
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts: List[int] = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value: int):
+        self.counts[bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent: float) -> int:
+        """Значение, не меньше которого percent% наблюдений (верхняя граница корзины)"""
+        if not self.count:
+            return 0
+        rank = max(1, int(self.count * percent / 100 + 0.5))
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return min(bucket_upper_bound(index), self.max)
+        return self.max
+
+    def count_at_most(self, value: int) -> int:
+        """Число наблюдений не больше value (с точностью до корзины)"""
+        return sum(self.counts[:bucket_index(value) + 1])
+
+    def summary(self, scale: float = 1.0) -> Dict[str, float]:
+        """count, mean, p50/p90/p99, max; значения делятся на scale (мкс -> мс: 1000)"""
+        if not self.count:
+            return {'count': 0, 'mean': 0, 'p50': 0, 'p90': 0, 'p99': 0, 'max': 0}
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count / scale, 3),
+            'p50': round(self.percentile(50) / scale, 3),
+            'p90': round(self.percentile(90) / scale, 3),
+            'p99': round(self.percentile(99) / scale, 3),
+            'max': round(self.max / scale, 3),
+        }
+
+
+class EndpointTiming:
+    """Гистограммы одного endpoint: полное время, время в БД (мкс), SQL-запросов на запрос"""
+
+    __slots__ = ('wall', 'db', 'statements', 'wait_us', 'errors', 'slow')
+
+    def __init__(self):
+        self.wall = Histogram()
+        self.db = Histogram()
+        self.statements = Histogram()
+        self.wait_us = 0  # ожидание long-poll (поток занят, но не работает)
+        self.errors = 0   # ответы 5xx
+        self.slow = 0
+
+    def to_dict(self) -> Dict[str, object]:
+        return {
+            'requests': self.wall.count,
+            'errors': self.errors,
+            'slow': self.slow,
+            'total_ms': round(self.wall.total / 1000, 1),
+            'wait_ms': round(self.wait_us / 1000, 1),
+            'db_ms': round(self.db.total / 1000, 1),
+            'wall_ms': self.wall.summary(1000),
+            'db_time_ms': self.db.summary(1000),
+            'statements': self.statements.summary(),
+        }
+
+
+class _RequestState(threading.local):
+    """Замер текущего запроса потока (None - вне запроса, например фоновый поток)"""
+    started: Optional[float] = None
+    db_time = 0.0
+    statements = 0
+    wait = 0.0
+    cursor_started: Optional[float] = None
+
+
+class RequestMetrics:
+    """Гистограммы времени запросов по (метод, endpoint) в памяти процесса"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints: Dict[str, EndpointTiming] = {}
+        self._state = _RequestState()
+        self._engines = set()
+        self.started_at = time.time()
+
+    def instrument_engine(self, engine):
+        """Считать время и число SQL-запросов, выполненных в потоке запроса"""
+        if id(engine) in self._engines:
+            return
+        self._engines.add(id(engine))
+        state = self._state
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if state.started is not None:
+                state.cursor_started = time.perf_counter()
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if state.started is not None and state.cursor_started is not None:
+                state.db_time += time.perf_counter() - state.cursor_started
+                state.statements += 1
+                state.cursor_started = None
+
+    def start(self):
+        """Начало запроса (before_request)"""
+        state = self._state
+        state.started = time.perf_counter()
+        state.db_time = 0.0
+        state.statements = 0
+        state.wait = 0.0
+        state.cursor_started = None
+
+    def add_wait(self, seconds: float):
+        """Учесть ожидание без работы (long-poll), чтобы не считать его медленной обработкой"""
+        if self._state.started is not None:
+            self._state.wait += max(seconds, 0.0)
+
+    def finish(self, endpoint: str, status_code: int, slow_threshold: float) -> Optional[Dict[str, object]]:
+        """
+        Конец запроса (after_request): записать замер
+
+        Returns:
+            Замер {wall_ms, db_ms, wait_ms, statements}, если обработка (без ожидания) дольше
+            slow_threshold секунд, иначе None
+        """
+        state = self._state
+        if state.started is None:
+            return None
+        wall = time.perf_counter() - state.started
+        db_time, statements, wait = state.db_time, state.statements, state.wait
+        state.started = None
+
+        slow = slow_threshold > 0 and wall - wait >= slow_threshold
+        with self._lock:
+            timing = self._endpoints.get(endpoint)
+            if timing is None:
+                timing = self._endpoints[endpoint] = EndpointTiming()
+            timing.wall.record(int(wall * 1e6))
+            timing.db.record(int(db_time * 1e6))
+            timing.statements.record(statements)
+            timing.wait_us += int(wait * 1e6)
+            if status_code >= 500:
+                timing.errors += 1
+            if slow:
+                timing.slow += 1
+        if not slow:
+            return None
+        return {
+            'wall_ms': round(wall * 1000, 1),
+            'db_ms': round(db_time * 1000, 1),
+            'wait_ms': round(wait * 1000, 1),
+            'statements': statements,
+        }
+
+    def snapshot(self, sort_by: str = 'total_ms') -> Dict[str, object]:
+        """Сводка по endpoint, по убыванию sort_by (total_ms - суммарное время, requests, db_ms, ...)"""
+        if sort_by not in SORT_KEYS:
+            sort_by = 'total_ms'
+        with self._lock:
+            endpoints = {name: timing.to_dict() for name, timing in self._endpoints.items()}
+        ordered = sorted(endpoints.items(), key=lambda item: item[1][sort_by], reverse=True)
+        return {
+            'since': self.started_at,
+            'endpoints': [{'endpoint': name, **data} for name, data in ordered],
+        }
+
+    def histograms(self) -> Dict[str, EndpointTiming]:
+        """Копия гистограмм по endpoint (для экспорта метрик)"""
+        with self._lock:
+            result = {}
+            for name, timing in self._endpoints.items():
+                copy = EndpointTiming()
+                for field in ('wall', 'db', 'statements'):
+                    source, target = getattr(timing, field), getattr(copy, field)
+                    target.counts = list(source.counts)
+                    target.count, target.total, target.max = source.count, source.total, source.max
+                copy.wait_us, copy.errors, copy.slow = timing.wait_us, timing.errors, timing.slow
+                result[name] = copy
+            return result
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+            self.started_at = time.time()
+
+
+# Глобальные замеры процесса
+request_metrics = RequestMetrics()
@@ -74,7 +74,7 @@ if __name__ == '__main__':
     try:
         from waitress import serve
         print("Using Waitress WSGI server...")
-        serve(app, host=host, port=port, threads=4)
+        serve(app, host=host, port=port, threads=app.config['WSGI_THREADS'])
     except ImportError:
         print("Using Flask built-in server...")
         app.run(host=host, port=port, debug=False)
@@ -34,6 +34,6 @@ if __name__ == '__main__':
     
     try:
         from waitress import serve
-        serve(app, host=host, port=port, threads=4)
+        serve(app, host=host, port=port, threads=app.config['WSGI_THREADS'])
     except ImportError:
         app.run(host=host, port=port, debug=False)
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Task-Chat - Профиль SQLite для продакшена
+PRAGMA из SQLITE_PRAGMAS выставляются на каждое новое соединение пула:
+WAL (читатели не блокируют писателя), synchronous=NORMAL, busy_timeout
+вместо мгновенного "database is locked", mmap/кэш страниц, временные таблицы в памяти.
+"""
+
+from typing import Dict, Optional
+
+from sqlalchemy import event
+
+
+def configure_sqlite_engine(engine, pragmas: Optional[Dict[str, object]]) -> bool:
+    """
+    Подключить выставление PRAGMA к событию connect движка
+
+    Returns:
+        True - профиль применён, False - не SQLite или PRAGMA не заданы
+    """
+    if not pragmas or engine.dialect.name != 'sqlite':
+        return False
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f'PRAGMA {name}={value}')
+        finally:
+            cursor.close()
+
+    return True
+
+
+def read_pragmas(engine, names) -> Dict[str, object]:
+    """Текущие значения PRAGMA на соединении пула (для проверки профиля)"""
+    with engine.connect() as conn:
+        return {name: conn.exec_driver_sql(f'PRAGMA {name}').scalar() for name in names}
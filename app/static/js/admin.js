@@ -283,8 +283,11 @@ document.addEventListener('DOMContentLoaded', function() {
     updateUsersTable();
     updateTasksTable();
     
-    // Периодические обновления
-    setInterval(updateAdminStats, ADMIN_CONFIG.STATS_INTERVAL);
+    // Периодические обновления (статистика - по событиям сервера, опрос только без SSE-потока)
+    serverEvents.poll(updateAdminStats, ADMIN_CONFIG.STATS_INTERVAL);
+    const refreshStats = serverEvents.debounce(updateAdminStats, 1000);
+    serverEvents.on('task_updated', refreshStats);
+    serverEvents.on('message', refreshStats);
     setInterval(updateUsersTable, ADMIN_CONFIG.USERS_INTERVAL);
     setInterval(updateTasksTable, ADMIN_CONFIG.TASKS_INTERVAL);
 });
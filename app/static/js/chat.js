@@ -7,6 +7,8 @@
 let isTyping = false;
 let typingTimeout = null;
 let lastMessageId = typeof LAST_MESSAGE_ID !== 'undefined' ? LAST_MESSAGE_ID : 0;
+let hasOlderMessages = typeof HAS_MORE_MESSAGES !== 'undefined' ? HAS_MORE_MESSAGES : false;
+let isLoadingOlder = false;
 let shouldScrollToBottom = true;
 let isFirstLoad = true;
 let isPartnerTyping = false;
@@ -36,11 +38,22 @@ document.addEventListener('DOMContentLoaded', function() {
     // Запуск обновления сообщений
     startMessagePolling();
 
+    // Подгрузка ранней истории при прокрутке вверх
+    setupOlderMessagesLoading();
+
     // Настройка формы отправки
     setupMessageForm();
 
-    // Запуск проверки индикатора "печатает"
-    setInterval(checkPartnerTyping, 1000);
+    // Индикатор "печатает": события сервера, опрос раз в секунду - только без SSE-потока
+    serverEvents.poll(checkPartnerTyping, 1000);
+    serverEvents.on('typing', data => {
+        if (data.scope !== 'task' || data.task_id !== TASK_ID || data.user_id === CURRENT_USER_ID) return;
+        if (data.is_typing) {
+            showPartnerTyping(data.username || PARTNER_USERNAME);
+        } else {
+            hidePartnerTyping();
+        }
+    });
 
     // Запуск проверки статуса задачи (каждые 3 секунды)
     startTaskStatusPolling();
@@ -59,8 +72,11 @@ function startTaskStatusPolling() {
     // Первоначальная проверка
     checkTaskStatus();
 
-    // Проверка каждые 3 секунды
-    setInterval(checkTaskStatus, 3000);
+    // Обновляем по событиям сервера; опрос каждые 3 секунды - только пока нет SSE-потока
+    serverEvents.poll(checkTaskStatus, 3000);
+    serverEvents.on('task_updated', data => {
+        if (data.task_id === TASK_ID && !data.deleted) checkTaskStatus();
+    });
 }
 
 async function checkTaskStatus() {
@@ -493,12 +509,7 @@ async function sendMessage() {
 // ========================================
 // Добавление сообщения в чат
 // ========================================
-function addMessageToChat(content, isOutgoing = false, messageId = null, created_at_iso = null, senderUsername = null) {
-    const messagesList = document.getElementById('messagesList');
-    if (!messagesList) return;
-
-    const wasAtBottom = isAtBottom();
-
+function createMessageElement(content, isOutgoing = false, messageId = null, created_at_iso = null, senderUsername = null, isRead = false) {
     const messageDiv = document.createElement('div');
     messageDiv.className = `message ${isOutgoing ? 'message-outgoing' : 'message-incoming'}`;
     if (messageId) {
@@ -532,15 +543,25 @@ function addMessageToChat(content, isOutgoing = false, messageId = null, created
             <div class="message-text">${formattedContent}</div>
             <div class="message-time">
                 ${timeStr}
-                ${isOutgoing ? '<span class="message-status sent"><i class="fas fa-check"></i></span>' : ''}
+                ${isOutgoing ? (isRead
+                    ? '<span class="message-status read" title="Прочитано"><i class="fas fa-check-double"></i></span>'
+                    : '<span class="message-status sent" title="Отправлено"><i class="fas fa-check"></i></span>') : ''}
             </div>
         </div>
         <div class="message-sender">
             ${senderName}
         </div>
     `;
+    return messageDiv;
+}
+
+function addMessageToChat(content, isOutgoing = false, messageId = null, created_at_iso = null, senderUsername = null) {
+    const messagesList = document.getElementById('messagesList');
+    if (!messagesList) return;
 
-    messagesList.appendChild(messageDiv);
+    const wasAtBottom = isAtBottom();
+
+    messagesList.appendChild(createMessageElement(content, isOutgoing, messageId, created_at_iso, senderUsername));
 
     if (messageId && messageId > lastMessageId) {
         lastMessageId = messageId;
@@ -552,11 +573,13 @@ function addMessageToChat(content, isOutgoing = false, messageId = null, created
 }
 
 // ========================================
-// Загрузка новых сообщений (polling)
+// Загрузка новых сообщений (long-poll)
 // ========================================
-async function loadNewMessages() {
+const LONG_POLL_WAIT = 25;  // секунд, сервер держит запрос до нового сообщения
+
+async function loadNewMessages(wait = 0) {
     try {
-        const response = await fetch(`/task/${TASK_ID}/get_messages?last_id=${lastMessageId}`);
+        const response = await fetch(`/task/${TASK_ID}/get_messages?after_id=${lastMessageId}&wait=${wait}`);
         const data = await response.json();
 
         if (data && data.length > 0) {
@@ -587,15 +610,18 @@ async function loadNewMessages() {
 
         // Обновляем статусы прочтения для всех сообщений
         updateMessageReadStatuses();
+        // Сервер не стал держать запрос (лимит ожидающих) - повтор через Retry-After
+        return Number(response.headers.get('Retry-After') || 0) * 1000;
 
     } catch (error) {
         console.error('Error loading messages:', error);
+        return 2000;
     }
 }
 
-// Обновление статусов прочтения сообщений
+// Обновление статусов прочтения сообщений (последняя страница - меняются только свежие)
 function updateMessageReadStatuses() {
-    fetch(`/task/${TASK_ID}/get_messages?last_id=0`)
+    fetch(`/task/${TASK_ID}/get_messages`)
         .then(r => r.json())
         .then(messages => {
             messages.forEach(msg => {
@@ -619,12 +645,81 @@ function updateMessageReadStatuses() {
         .catch(error => console.error('Error updating read statuses:', error));
 }
 
+// ========================================
+// Подгрузка ранней истории (keyset по before_id)
+// ========================================
+function setupOlderMessagesLoading() {
+    const container = document.getElementById('messagesContainer');
+    if (!container) return;
+
+    container.addEventListener('scroll', () => {
+        if (container.scrollTop < 100) {
+            loadOlderMessages();
+        }
+    });
+
+    // Ссылка "Показать более ранние" работает и без прокрутки
+    const link = document.querySelector('.messages-load-earlier a');
+    if (link) {
+        link.addEventListener('click', event => {
+            event.preventDefault();
+            loadOlderMessages();
+        });
+    }
+}
+
+async function loadOlderMessages() {
+    if (!hasOlderMessages || isLoadingOlder) return;
+
+    const messagesList = document.getElementById('messagesList');
+    const container = document.getElementById('messagesContainer');
+    const firstMessage = messagesList ? messagesList.querySelector('.message[data-message-id]') : null;
+    if (!firstMessage) return;
+
+    isLoadingOlder = true;
+    try {
+        const response = await fetch(`/task/${TASK_ID}/get_messages?before_id=${firstMessage.dataset.messageId}&limit=${MESSAGES_PER_PAGE}`);
+        const messages = await response.json();
+
+        // Сохраняем позицию прокрутки относительно уже показанных сообщений
+        const previousHeight = container.scrollHeight;
+        const fragment = document.createDocumentFragment();
+        for (const message of messages) {
+            if (!document.querySelector(`[data-message-id="${message.id}"]`)) {
+                fragment.appendChild(createMessageElement(
+                    message.content,
+                    message.sender_id === CURRENT_USER_ID,
+                    message.id,
+                    message.created_at_iso,
+                    message.sender_name,
+                    message.is_read
+                ));
+            }
+        }
+        messagesList.insertBefore(fragment, firstMessage);
+        container.scrollTop += container.scrollHeight - previousHeight;
+
+        hasOlderMessages = messages.length >= MESSAGES_PER_PAGE;
+        if (!hasOlderMessages) {
+            const link = document.querySelector('.messages-load-earlier');
+            if (link) link.remove();
+        }
+    } catch (error) {
+        console.error('Error loading older messages:', error);
+    } finally {
+        isLoadingOlder = false;
+    }
+}
+
 function startMessagePolling() {
-    // Проверяем каждые 2 секунды
-    setInterval(loadNewMessages, 2000);
-    
-    // Первоначальная загрузка
-    setTimeout(loadNewMessages, 500);
+    // Первоначальная загрузка, дальше - непрерывный long-poll
+    setTimeout(pollMessagesLoop, 500);
+}
+
+async function pollMessagesLoop() {
+    // Пауза перед повтором: при ошибке сети или если сервер не стал ждать
+    const delay = await loadNewMessages(LONG_POLL_WAIT);
+    setTimeout(pollMessagesLoop, delay);
 }
 
 // ========================================
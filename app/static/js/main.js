@@ -6,6 +6,68 @@
 // Глобальные переменные
 window.unreadData = null;
 
+// ========================================
+// Поток событий сервера (SSE /api/events)
+// ========================================
+// Один EventSource на вкладку вместо набора setInterval-опросов.
+// События: unread, typing, task_updated, message, presence.
+const serverEvents = {
+    source: null,
+    connected: false,
+
+    // Подписка на событие: handler(data)
+    on(type, handler) {
+        window.addEventListener(`taskchat:${type}`, e => handler(e.detail));
+    },
+
+    // Опрос-подстраховка: часто - пока поток не подключен, редко (connectedInterval) - при живом потоке
+    poll(fn, interval, connectedInterval = 60000) {
+        let lastRun = Date.now();
+        return setInterval(() => {
+            const now = Date.now();
+            if (!this.connected || now - lastRun >= connectedInterval) {
+                lastRun = now;
+                fn();
+            }
+        }, interval);
+    },
+
+    // Склеивает пачку событий в один вызов fn
+    debounce(fn, delay = 300) {
+        let timer = null;
+        return (...args) => {
+            clearTimeout(timer);
+            timer = setTimeout(() => fn(...args), delay);
+        };
+    }
+};
+window.serverEvents = serverEvents;
+
+const SERVER_EVENTS_RETRY = 60000;  // мс до новой попытки после отказа сервера
+
+function connectServerEvents() {
+    if (!window.currentUserId || typeof EventSource === 'undefined') return;
+
+    const source = new EventSource('/api/events');
+    ['unread', 'typing', 'task_updated', 'message', 'presence'].forEach(type => {
+        source.addEventListener(type, e => {
+            window.dispatchEvent(new CustomEvent(`taskchat:${type}`, { detail: JSON.parse(e.data) }));
+        });
+    });
+    source.onopen = () => { serverEvents.connected = true; };
+    // EventSource переподключается сам; до этого работают опросы-подстраховки
+    source.onerror = () => {
+        serverEvents.connected = false;
+        if (source.readyState === EventSource.CLOSED) {
+            // Сервер отказал (503 - лимит потоков): работаем на опросах, поток пробуем позже
+            setTimeout(connectServerEvents, SERVER_EVENTS_RETRY);
+        }
+    };
+    serverEvents.source = source;
+}
+
+connectServerEvents();
+
 // ========================================
 // Tooltip для мобильных (полное ФИО по клику)
 // ========================================
@@ -190,8 +252,12 @@ document.addEventListener('DOMContentLoaded', function() {
 
     // Запуск проверки непрочитанных сообщений
     if (window.currentUserId) {
-        setInterval(checkUnreadMessages, 10000);
+        serverEvents.poll(checkUnreadMessages, 10000);
         checkUnreadMessages(); // Первая проверка сразу
+
+        const refreshUnread = serverEvents.debounce(checkUnreadMessages);
+        serverEvents.on('unread', data => { if (data.scope === 'task') refreshUnread(); });
+        serverEvents.on('message', data => { if (data.scope === 'task') refreshUnread(); });
     }
     
     // Адаптация для мобильных
@@ -287,9 +353,14 @@ function showFilesList(content, data, taskId) {
             <div class="file-card" data-file-id="${file.id}">
                 <div class="file-preview">
                     ${file.is_image ?
-                        `<img src="${file.view_url || file.download_url}"
-                              alt="${file.original_filename}"
+                        `<img src="${file.thumb_url || file.view_url || file.download_url}"
+                              alt="${file.original_filename}" loading="lazy"
                               onclick="openFileFullscreen('${file.view_url || file.download_url}', '${file.original_filename.replace(/'/g, "\\'")}')">` :
+                      file.is_pdf && file.thumb_url ?
+                        `<img src="${file.thumb_url}"
+                              alt="${file.original_filename}" loading="lazy"
+                              onclick="window.open('${file.view_url}', '_blank')"
+                              onerror="showFileIcon(this, '${file.icon_class}')">` :
                         `<div class="file-icon">
                             <i class="fas ${file.icon_class}"></i>
                         </div>`
@@ -332,6 +403,14 @@ function showFilesList(content, data, taskId) {
     content.innerHTML = filesHtml;
 }
 
+// Превью не загрузилось (PDF не разбирается) - иконка файла вместо битой картинки
+function showFileIcon(img, iconClass) {
+    const icon = document.createElement('div');
+    icon.className = 'file-icon';
+    icon.innerHTML = `<i class="fas ${iconClass}"></i>`;
+    img.replaceWith(icon);
+}
+
 function showFilesError(content, errorMessage) {
     content.innerHTML = `
         <div class="error" style="text-align: center; padding: 40px;">
@@ -490,6 +569,80 @@ if (!document.getElementById('fullscreen-styles')) {
     document.head.appendChild(style);
 }
 
+// Файлы больше порога загружаются частями с возобновлением (/task/<id>/uploads)
+const RESUMABLE_UPLOAD_THRESHOLD = 32 * 1024 * 1024;
+const RESUMABLE_UPLOAD_RETRIES = 5;
+
+function resumableUploadKey(taskId, file) {
+    return `upload:${taskId}:${file.name}:${file.size}:${file.lastModified}`;
+}
+
+async function uploadFileResumable(taskId, file, onProgress) {
+    // Незавершённая загрузка того же файла (обрыв, перезагрузка страницы) продолжается с принятого смещения
+    const key = resumableUploadKey(taskId, file);
+    let upload = null;
+    const savedId = localStorage.getItem(key);
+    if (savedId) {
+        const response = await fetch(`/uploads/${savedId}`);
+        if (response.ok) upload = await response.json();
+    }
+    if (!upload) {
+        const response = await fetch(`/task/${taskId}/uploads`, {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({filename: file.name, size: file.size})
+        });
+        upload = await response.json();
+        if (!upload.success) throw new Error(upload.error || 'Ошибка загрузки');
+        localStorage.setItem(key, upload.upload_id);
+    }
+
+    const chunkSize = upload.chunk_size || 8 * 1024 * 1024;
+    let offset = upload.offset;
+    let retries = 0;
+    while (offset < file.size) {
+        let data;
+        try {
+            const response = await fetch(`/uploads/${upload.upload_id}?offset=${offset}`, {
+                method: 'PUT',
+                headers: {'Content-Type': 'application/octet-stream'},
+                body: file.slice(offset, offset + chunkSize)
+            });
+            data = await response.json();
+            if (!response.ok && response.status !== 409 && response.status !== 400) {
+                throw new Error(data.error || 'Ошибка загрузки');
+            }
+        } catch (error) {
+            if (error instanceof TypeError && retries < RESUMABLE_UPLOAD_RETRIES) {
+                // Сеть недоступна - ждём и узнаём, сколько сервер успел принять
+                retries++;
+                await new Promise(resolve => setTimeout(resolve, 1000 * retries));
+                const status = await fetch(`/uploads/${upload.upload_id}`).then(r => r.json()).catch(() => null);
+                if (status && status.success) offset = status.offset;
+                continue;
+            }
+            throw error;
+        }
+        if (data.success) {
+            retries = 0;
+        } else {
+            // Смещение разошлось или часть ещё принимается - продолжаем с позиции сервера,
+            // но не бесконечно: такие ответы считаются попытками наравне с обрывами сети
+            if (retries >= RESUMABLE_UPLOAD_RETRIES) throw new Error(data.error || 'Ошибка загрузки');
+            retries++;
+            await new Promise(resolve => setTimeout(resolve, 500 * retries));
+        }
+        offset = data.offset;
+        if (onProgress) onProgress(offset / file.size);
+    }
+
+    const response = await fetch(`/uploads/${upload.upload_id}/finalize`, {method: 'POST'});
+    const data = await response.json();
+    if (!data.success) throw new Error(data.error || 'Ошибка загрузки');
+    localStorage.removeItem(key);
+    return data.file;
+}
+
 async function addFilesToTask(taskId) {
     const input = document.createElement('input');
     input.type = 'file';
@@ -497,24 +650,45 @@ async function addFilesToTask(taskId) {
     input.accept = '.jpg,.jpeg,.png,.gif,.bmp,.webp,.pdf,.dcm,.zip,.rar,.doc,.docx,.xls,.xlsx';
 
     input.onchange = async function(e) {
-        const files = e.target.files;
+        const files = Array.from(e.target.files);
         if (files.length === 0) return;
 
-        const formData = new FormData();
-        for (let i = 0; i < files.length; i++) {
-            formData.append('files', files[i]);
-        }
+        const large = files.filter(file => file.size > RESUMABLE_UPLOAD_THRESHOLD);
+        const small = files.filter(file => file.size <= RESUMABLE_UPLOAD_THRESHOLD);
 
         try {
-            const response = await fetch(`/task/${taskId}/add_files`, {
-                method: 'POST',
-                body: formData
-            });
+            let uploadedCount = 0;
+            const errors = [];
+
+            if (small.length > 0) {
+                const formData = new FormData();
+                for (const file of small) {
+                    formData.append('files', file);
+                }
+
+                const response = await fetch(`/task/${taskId}/add_files`, {
+                    method: 'POST',
+                    body: formData
+                });
+
+                const data = await response.json();
+                uploadedCount += (data.uploaded_files || []).length;
+                if (!data.success) {
+                    errors.push(...(data.errors || [data.error || 'Ошибка загрузки файлов']));
+                }
+            }
 
-            const data = await response.json();
+            for (const file of large) {
+                try {
+                    await uploadFileResumable(taskId, file);
+                    uploadedCount++;
+                } catch (error) {
+                    errors.push(`${file.name}: ${error.message}`);
+                }
+            }
 
-            if (data.success) {
-                showNotification(`Успешно загружено ${data.uploaded_files.length} файлов`, 'success');
+            if (errors.length === 0) {
+                showNotification(`Успешно загружено ${uploadedCount} файлов`, 'success');
                 if (typeof showTaskFiles === 'function') {
                     await showTaskFiles(taskId);
                 }
@@ -523,7 +697,7 @@ async function addFilesToTask(taskId) {
                     location.reload();
                 }
             } else {
-                throw new Error(data.errors ? data.errors.join(', ') : 'Ошибка загрузки файлов');
+                throw new Error(errors.join(', '));
             }
         } catch (error) {
             console.error('Error uploading files:', error);
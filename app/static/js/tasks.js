@@ -5,6 +5,7 @@
 
 let lastTasksHash = null;
 let refreshInterval = null;
+let tasksCursor = null;  // Курсор дельта-синхронизации /api/tasks?since=
 
 // ========================================
 // Инициализация
@@ -126,10 +127,13 @@ function startTasksPolling() {
     // Первоначальная загрузка хэша
     updateTasksHash();
 
-    // Проверка каждые 3 секунды
-    refreshInterval = setInterval(() => {
-        checkForUpdates();
-    }, 3000);
+    // Обновляем по событиям сервера; опрос каждые 3 секунды - только пока нет SSE-потока
+    refreshInterval = serverEvents.poll(checkForUpdates, 3000);
+
+    const refreshTasks = serverEvents.debounce(checkForUpdates);
+    serverEvents.on('task_updated', refreshTasks);
+    serverEvents.on('message', data => { if (data.scope === 'task') refreshTasks(); });
+    serverEvents.on('unread', data => { if (data.scope === 'task') refreshTasks(); });
 }
 
 function stopTasksPolling() {
@@ -141,7 +145,8 @@ function stopTasksPolling() {
 
 async function checkForUpdates() {
     try {
-        const response = await fetch('/api/tasks');
+        const url = tasksCursor ? `/api/tasks?since=${encodeURIComponent(tasksCursor)}` : '/api/tasks';
+        const response = await fetch(url);
         const data = await response.json();
 
         // API возвращает {tasks: [...], stats: {...}}, извлекаем массив
@@ -153,6 +158,16 @@ async function checkForUpdates() {
             return;
         }
 
+        if (data.cursor) {
+            tasksCursor = data.cursor;
+        }
+
+        // Дельта: патчим только изменённые и удалённые карточки
+        if (data.full === false) {
+            await applyTasksDelta(tasks, data.deleted || [], data.unread || {}, stats);
+            return;
+        }
+
         // Получаем текущие ID задач на странице
         const existingIds = new Set(
             Array.from(document.querySelectorAll('.task-card'))
@@ -181,6 +196,39 @@ async function checkForUpdates() {
     }
 }
 
+async function applyTasksDelta(tasks, deletedIds, unread, stats) {
+    const scrollTop = window.scrollY;
+
+    // Удалённые задачи
+    for (const id of deletedIds) {
+        const card = document.querySelector(`.task-card[data-task-id="${id}"]`);
+        if (card) {
+            card.remove();
+        }
+    }
+
+    // Новые задачи
+    const existingIds = new Set(
+        Array.from(document.querySelectorAll('.task-card'))
+            .map(card => parseInt(card.dataset.taskId))
+    );
+    if (tasks.some(t => !existingIds.has(t.id))) {
+        await addNewTasks(tasks, existingIds);
+    }
+
+    // Изменённые задачи
+    await updateChangedCards(tasks);
+
+    // Непрочитанные приходят по всем задачам: отсутствие в словаре = 0
+    document.querySelectorAll('.task-card').forEach(card => {
+        const taskId = parseInt(card.dataset.taskId);
+        updateChatBadge(card, taskId, unread[taskId] || 0);
+    });
+
+    updateStats(stats);
+    window.scrollTo(0, scrollTop);
+}
+
 function updateAllBadges(tasks) {
     for (const task of tasks) {
         const card = document.querySelector(`.task-card[data-task-id="${task.id}"]`);
@@ -681,6 +729,9 @@ async function refreshTasks() {
         const tasks = data.tasks || data;
         const stats = data.stats;
 
+        if (data.cursor) {
+            tasksCursor = data.cursor;
+        }
         await updateTasksList(tasks, stats);
         updateTasksHash();
     } catch (error) {
@@ -699,6 +750,9 @@ function updateTasksHash() {
         .then(data => {
             const tasks = data.tasks || data;
             const stats = data.stats;
+            if (data.cursor) {
+                tasksCursor = data.cursor;
+            }
             if (Array.isArray(tasks)) {
                 lastTasksHash = createTasksHash(tasks);
                 // Обновляем бейджи при первой загрузке
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Task-Chat - Материализованная статистика системы
+Счётчики для /api/stats, /admin и /admin/api/stats пересчитываются несколькими
+агрегатными запросами в фоновом потоке раз в STATS_REFRESH_INTERVAL секунд;
+endpoint'ы читают готовый снимок из памяти. Если снимок старше STATS_MAX_AGE
+(фоновый поток не запущен или отстал), он пересчитывается при чтении.
+"""
+
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+try:
+    from .models import User, Task, ChatMessage, PersonalChat, PersonalMessage, StorageUsage
+    from .presence import presence_tracker
+except ImportError:
+    from models import User, Task, ChatMessage, PersonalChat, PersonalMessage, StorageUsage
+    from presence import presence_tracker
+
+
+# Окно "активных" чатов для админки
+ACTIVE_CHATS_WINDOW = timedelta(days=7)
+
+
+def compute_stats(db) -> dict:
+    """Пересчитать статистику агрегатными запросами (по одному на таблицу)"""
+    now = datetime.utcnow()
+    today_start = datetime(now.year, now.month, now.day)
+    active_since = now - ACTIVE_CHATS_WINDOW
+    online_cutoff = now - presence_tracker.online_window
+
+    # Пользователи: по ролям и онлайн (отметки процесса + last_seen из БД)
+    is_online = db.or_(User.id.in_(list(presence_tracker.online_user_ids())), User.last_seen >= online_cutoff)
+    users_by_role = {}
+    users_online = 0
+    for role, count, online in db.session.query(
+        User.role, db.func.count(User.id), db.func.sum(db.case((is_online, 1), else_=0))
+    ).group_by(User.role):
+        users_by_role[role] = count
+        users_online += online or 0
+
+    tasks_by_status = dict(db.session.query(Task.status, db.func.count(Task.id)).group_by(Task.status).all())
+
+    messages_total, messages_today, active_chats = db.session.query(
+        db.func.count(ChatMessage.id),
+        db.func.sum(db.case((ChatMessage.created_at >= today_start, 1), else_=0)),
+        db.func.count(db.distinct(db.case((ChatMessage.created_at >= active_since, ChatMessage.task_id))))
+    ).one()
+
+    total_personal_chats = db.session.query(db.func.count(PersonalChat.id)).scalar()
+    total_personal_messages, active_personal_chats = db.session.query(
+        db.func.count(PersonalMessage.id),
+        db.func.count(db.distinct(db.case((PersonalMessage.created_at >= active_since, PersonalMessage.chat_id))))
+    ).one()
+
+    # Файлы - из учёта места storage_usage (storage.py), без обхода папки и таблиц файлов
+    storage_by_directory = {}
+    storage_by_type = {}
+    for usage in StorageUsage.query.order_by(StorageUsage.directory, StorageUsage.file_type):
+        if not usage.files and not usage.bytes:
+            continue
+        for breakdown, key in ((storage_by_directory, usage.directory), (storage_by_type, usage.file_type)):
+            counter = breakdown.setdefault(key, {'files': 0, 'bytes': 0})
+            counter['files'] += usage.files
+            counter['bytes'] += usage.bytes
+    # Файлы задач и личных чатов лежат в общем хранилище блобов - в админке вся папка загрузок по типам
+    files_by_type = [{'type': file_type, 'count': counter['files'], 'size_mb': round(counter['bytes'] / (1024 * 1024), 2)}
+                     for file_type, counter in storage_by_type.items()]
+    uploads_files = sum(counter['files'] for counter in storage_by_directory.values())
+    uploads_size = sum(counter['bytes'] for counter in storage_by_directory.values())
+
+    return {
+        'total_users': sum(users_by_role.values()),
+        'users_online': users_online,
+        'users_by_role': users_by_role,
+        'total_tasks': sum(tasks_by_status.values()),
+        'tasks_by_status': tasks_by_status,
+        'total_messages': messages_total,
+        'messages_today': messages_today or 0,
+        'active_chats': active_chats,
+        'total_personal_chats': total_personal_chats,
+        'active_personal_chats': active_personal_chats,
+        'total_personal_messages': total_personal_messages,
+        'total_files': uploads_files,
+        'total_file_size': uploads_size,
+        'files_by_type': files_by_type,
+        # Вся папка загрузок: итого и разбивки по каталогам и типам
+        'uploads_files': uploads_files,
+        'uploads_size': uploads_size,
+        'storage_by_directory': storage_by_directory,
+        'storage_by_type': storage_by_type,
+        'updated_at': now,
+    }
+
+
+class StatsService:
+    """Снимок статистики в памяти процесса с фоновым пересчётом"""
+
+    def __init__(self, max_age: float = 60):
+        self.max_age = max_age
+        self._snapshot: Optional[dict] = None
+        self._computed_at = float('-inf')  # time.monotonic() последнего пересчёта
+        self._refresh_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def refresh(self, db) -> dict:
+        """Пересчитать снимок (вызывается в контексте приложения)"""
+        with self._refresh_lock:
+            snapshot = compute_stats(db)
+            self._snapshot = snapshot
+            self._computed_at = time.monotonic()
+        return snapshot
+
+    def get(self, db) -> dict:
+        """
+        Текущий снимок. Пересчёт при чтении - только если снимок старше max_age;
+        пока другой поток пересчитывает, отдаётся предыдущий снимок
+        """
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() - self._computed_at <= self.max_age:
+            return snapshot
+        if snapshot is not None and self._refresh_lock.locked():
+            return snapshot
+        return self.refresh(db)
+
+    def start(self, app, db, interval: float):
+        """Запустить фоновый пересчёт (один поток на процесс)"""
+        if self._thread is not None:
+            return
+
+        def run():
+            while not self._stop.wait(interval):
+                with app.app_context():
+                    try:
+                        self.refresh(db)
+                    except Exception as e:
+                        app.logger.error(f'Stats refresh failed: {e}', extra={'category': 'database'})
+                    finally:
+                        db.session.remove()
+
+        self._thread = threading.Thread(target=run, name='stats-refresh', daemon=True)
+        self._thread.start()
+
+
+# Глобальный сервис статистики процесса
+stats_service = StatsService()
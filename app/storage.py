@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Task-Chat - Учёт места в папке загрузок
+Таблица storage_usage (каталог, тип файла) -> (файлов, байт) обновляется при
+загрузке и удалении файлов; фоновая сверка раз в STORAGE_RECONCILE_INTERVAL
+секунд обходит папку загрузок и исправляет накопившееся расхождение.
+
+Каталоги: uploads/blobs/ (хранилище по содержимому, blobstore.py) учитывается как
+'blobs', файлы старого формата в uploads/<task_id>/ - как 'tasks', uploads/personal_chats/ -
+как 'personal_chats', прочие подкаталоги - под своим именем. Тип файла - по
+сигнатуре (uploads.detect_file_type), как при загрузке.
+"""
+
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+try:
+    from .models import StorageUsage, TaskTombstone
+    from .uploads import read_file_type, expire_uploads, INCOMING_DIRECTORY
+    from .previews import PREVIEWS_DIRECTORY
+    from .blobstore import collect_blobs, collect_orphan_blobs
+except ImportError:
+    from models import StorageUsage, TaskTombstone
+    from uploads import read_file_type, expire_uploads, INCOMING_DIRECTORY
+    from previews import PREVIEWS_DIRECTORY
+    from blobstore import collect_blobs, collect_orphan_blobs
+
+
+TASKS_DIRECTORY = 'tasks'
+PERSONAL_CHATS_DIRECTORY = 'personal_chats'
+ROOT_DIRECTORY = 'root'  # файлы прямо в папке загрузок
+
+Usage = Dict[Tuple[str, str], List[int]]  # (каталог, тип) -> [файлов, байт]
+
+
+def directory_key(name: str) -> str:
+    """Каталог учёта по имени подкаталога папки загрузок"""
+    return TASKS_DIRECTORY if name.isdigit() else name
+
+
+def count_file(usage: Usage, directory: str, entry: os.DirEntry, config):
+    """Добавить файл к подсчёту (файл, удалённый во время обхода, пропускается)"""
+    try:
+        file_type = read_file_type(entry.path, entry.name, config)
+        size = entry.stat(follow_symlinks=False).st_size
+    except FileNotFoundError:
+        return
+    counter = usage.setdefault((directory, file_type), [0, 0])
+    counter[0] += 1
+    counter[1] += size
+
+
+def scan_directory(path, directory: str, config, usage: Optional[Usage] = None) -> Usage:
+    """Рекурсивно посчитать файлы каталога на диске"""
+    usage = {} if usage is None else usage
+    try:
+        entries = list(os.scandir(path))
+    except FileNotFoundError:
+        return usage
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            scan_directory(entry.path, directory, config, usage)
+        elif entry.is_file(follow_symlinks=False):
+            count_file(usage, directory, entry, config)
+    return usage
+
+
+def scan_uploads(upload_folder, config) -> Usage:
+    """Посчитать всю папку загрузок по (каталог, тип)"""
+    usage = {}
+    try:
+        entries = list(os.scandir(upload_folder))
+    except FileNotFoundError:
+        return usage
+    for entry in entries:
+        if entry.name in (INCOMING_DIRECTORY, PREVIEWS_DIRECTORY):
+            continue  # незавершённые загрузки и кэш превью
+        if entry.is_dir(follow_symlinks=False):
+            scan_directory(entry.path, directory_key(entry.name), config, usage)
+        elif entry.is_file(follow_symlinks=False):
+            count_file(usage, ROOT_DIRECTORY, entry, config)
+    return usage
+
+
+def subtract_directory(path, directory: str, config) -> Usage:
+    """Вычесть из учёта всё содержимое каталога перед его удалением (без commit)"""
+    usage = scan_directory(path, directory, config)
+    for (directory_name, file_type), (files, size) in usage.items():
+        StorageUsage.subtract(directory_name, file_type, size, files)
+    return usage
+
+
+def reconcile_storage(db, upload_folder, config) -> List[str]:
+    """
+    Сверить storage_usage с диском и заменить счётчики фактическими значениями
+
+    Returns:
+        Описание расхождений ['tasks/dicom: files +3, bytes +1048576', ...]
+    """
+    actual = scan_uploads(upload_folder, config)
+    recorded = {
+        (row.directory, row.file_type): [row.files, row.bytes]
+        for row in StorageUsage.query.all()
+    }
+
+    drift = []
+    for key in sorted(set(actual) | set(recorded)):
+        files, size = actual.get(key, [0, 0])
+        recorded_files, recorded_size = recorded.get(key, [0, 0])
+        if (files, size) != (recorded_files, recorded_size):
+            drift.append(f'{key[0]}/{key[1]}: files {files - recorded_files:+d}, bytes {size - recorded_size:+d}')
+
+    if drift:
+        # Загрузка, завершившаяся во время обхода, может попасть в счётчики дважды -
+        # это исправит следующая сверка
+        db.session.execute(db.delete(StorageUsage))
+        db.session.add_all([
+            StorageUsage(directory=directory, file_type=file_type, files=files, bytes=size)
+            for (directory, file_type), (files, size) in actual.items()
+        ])
+    db.session.commit()
+    return drift
+
+
+class StorageReconciler:
+    """
+    Фоновое обслуживание папки загрузок (один поток на процесс): брошенные загрузки,
+    сборка блобов без ссылок, сверка учёта места с диском и удаление старых tombstone задач
+    """
+
+    def __init__(self):
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    def run_once(self, app, db) -> List[str]:
+        """Обслуживание в контексте приложения с записью расхождений в лог"""
+        with app.app_context():
+            try:
+                expired = expire_uploads(db, app.config)
+                if expired:
+                    app.logger.info(f'Removed {expired} abandoned upload files', extra={'category': 'files'})
+                upload_folder, grace = app.config['UPLOAD_FOLDER'], app.config['BLOB_GC_GRACE']
+                collected = collect_blobs(db, upload_folder, grace) + collect_orphan_blobs(db, upload_folder, grace)
+                if collected:
+                    app.logger.info(f'Collected {len(collected)} unreferenced blobs', extra={'category': 'files'})
+                pruned = TaskTombstone.prune(app.config['TASKS_TOMBSTONE_RETENTION'])
+                db.session.commit()
+                if pruned:
+                    app.logger.info(f'Pruned {pruned} task tombstones', extra={'category': 'database'})
+                drift = reconcile_storage(db, app.config['UPLOAD_FOLDER'], app.config)
+                if drift:
+                    app.logger.warning(f'Storage usage drift corrected: {"; ".join(drift)}',
+                                       extra={'category': 'files'})
+                return drift
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f'Storage reconciliation failed: {e}', extra={'category': 'files'})
+                return []
+            finally:
+                db.session.remove()
+
+    def start(self, app, db, interval: float):
+        """Запустить периодическую сверку"""
+        if self._thread is not None:
+            return
+
+        def run():
+            while not self._stop.wait(interval):
+                self.run_once(app, db)
+
+        self._thread = threading.Thread(target=run, name='storage-reconcile', daemon=True)
+        self._thread.start()
+
+
+# Глобальная сверка процесса
+storage_reconciler = StorageReconciler()
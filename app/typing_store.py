@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Task-Chat - Хранилище статуса "печатает"
+Статус живёт в памяти процесса с TTL (TYPING_STATUS_TIMEOUT), без записи в БД.
+Для нескольких воркеров - общий backend в Redis (TYPING_STORE_URL).
+
+Ключ чата: ('task', task_id) или ('chat', chat_id); внутри - user_id.
+Истечение проверяется при чтении.
+"""
+
+import json
+import math
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+class TypingStore:
+    """Статус "печатает" в памяти процесса"""
+
+    SWEEP_INTERVAL = 60  # секунды между полными чистками истёкших записей
+
+    def __init__(self, timeout: float = 5):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        # ключ чата -> {user_id: (username, monotonic-время отметки)}
+        self._entries: Dict[Tuple[str, int], Dict[int, Tuple[str, float]]] = {}
+        self._last_sweep = time.monotonic()
+
+    def set(self, key: Tuple[str, int], user_id: int, username: str, is_typing: bool = True):
+        """Отметить, что пользователь печатает (или перестал)"""
+        now = time.monotonic()
+        with self._lock:
+            if is_typing:
+                self._entries.setdefault(key, {})[user_id] = (username, now)
+            else:
+                entries = self._entries.get(key)
+                if entries:
+                    entries.pop(user_id, None)
+                    if not entries:
+                        del self._entries[key]
+
+            if now - self._last_sweep >= self.SWEEP_INTERVAL:
+                self._sweep(now)
+
+    def get_typing(self, key: Tuple[str, int], exclude_user_id: Optional[int] = None) -> List[Tuple[int, str]]:
+        """Список (user_id, username) печатающих в чате, кроме exclude_user_id"""
+        now = time.monotonic()
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                return []
+            return [
+                (user_id, username)
+                for user_id, (username, marked_at) in entries.items()
+                if user_id != exclude_user_id and now - marked_at < self.timeout
+            ]
+
+    def _sweep(self, now: float):
+        """Удалить истёкшие записи (вызывается под блокировкой)"""
+        for key in list(self._entries):
+            entries = self._entries[key]
+            for user_id in [u for u, (_, marked_at) in entries.items() if now - marked_at >= self.timeout]:
+                del entries[user_id]
+            if not entries:
+                del self._entries[key]
+        self._last_sweep = now
+
+
+class RedisTypingStore:
+    """Статус "печатает" в Redis - общий для всех воркеров"""
+
+    PREFIX = 'taskchat:typing'
+
+    def __init__(self, url: str, timeout: float = 5):
+        import redis  # опциональная зависимость, только для TYPING_STORE_URL
+
+        self.timeout = timeout
+        self.redis = redis.Redis.from_url(url)
+
+    def _key(self, key: Tuple[str, int]) -> str:
+        return f'{self.PREFIX}:{key[0]}:{key[1]}'
+
+    def set(self, key: Tuple[str, int], user_id: int, username: str, is_typing: bool = True):
+        redis_key = self._key(key)
+        if is_typing:
+            pipe = self.redis.pipeline()
+            pipe.hset(redis_key, user_id, json.dumps([username, time.time()]))
+            pipe.expire(redis_key, math.ceil(self.timeout) + 1)
+            pipe.execute()
+        else:
+            self.redis.hdel(redis_key, user_id)
+
+    def get_typing(self, key: Tuple[str, int], exclude_user_id: Optional[int] = None) -> List[Tuple[int, str]]:
+        now = time.time()
+        result = []
+        for raw_user_id, raw_value in self.redis.hgetall(self._key(key)).items():
+            user_id = int(raw_user_id)
+            username, marked_at = json.loads(raw_value)
+            if user_id != exclude_user_id and now - marked_at < self.timeout:
+                result.append((user_id, username))
+        return result
+
+
+def create_typing_store(config, logger=None):
+    """
+    Создание хранилища по конфигурации
+
+    Args:
+        config: конфигурация Flask (TYPING_STATUS_TIMEOUT, TYPING_STORE_URL)
+        logger: логгер для предупреждения о недоступном Redis
+    """
+    timeout = config.get('TYPING_STATUS_TIMEOUT', 5)
+    url = config.get('TYPING_STORE_URL')
+    if url:
+        try:
+            return RedisTypingStore(url, timeout=timeout)
+        except ImportError:
+            if logger:
+                logger.warning('TYPING_STORE_URL задан, но пакет redis не установлен - статус "печатает" хранится в памяти процесса')
+    return TypingStore(timeout=timeout)
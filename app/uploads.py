@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Task-Chat - Приём загружаемых файлов
+Файловые части multipart-запроса пишутся сразу во временный файл
+UPLOAD_FOLDER/.incoming блоками парсера werkzeug; SHA-256, размер и начало файла
+считаются во время записи. При превышении лимита на файл запрос прерывается (413),
+не дожидаясь конца передачи. Сохранение - переименование временного файла в
+хранилище (blobstore.py), без повторного чтения данных. Тип определяется по сигнатуре (magic bytes), а не по расширению.
+
+Большие файлы (серии DICOM, архивы) загружаются частями с возобновлением: сессия
+UploadSession, части пишутся в UPLOAD_FOLDER/.incoming/<id>.upload по смещению, запись
+о файле создаётся только при завершении.
+"""
+
+import hashlib
+import os
+import secrets
+import tempfile
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from flask import Request, current_app
+from werkzeug.exceptions import RequestEntityTooLarge
+
+try:
+    from .models import UploadSession
+except ImportError:
+    from models import UploadSession
+
+
+INCOMING_DIRECTORY = '.incoming'  # в UPLOAD_FOLDER - та же ФС, перенос файла без копирования
+HEAD_SIZE = 132  # DICOM: 128 байт преамбулы + 'DICM'
+RESUMABLE_SUFFIX = '.upload'  # временный файл загрузки частями
+
+# (тип, MIME, смещение, сигнатура)
+SIGNATURES = (
+    ('images', 'image/png', 0, b'\x89PNG\r\n\x1a\n'),
+    ('images', 'image/jpeg', 0, b'\xff\xd8\xff'),
+    ('images', 'image/gif', 0, b'GIF87a'),
+    ('images', 'image/gif', 0, b'GIF89a'),
+    ('images', 'image/bmp', 0, b'BM'),
+    ('pdf', 'application/pdf', 0, b'%PDF-'),
+    ('dicom', 'application/dicom', 128, b'DICM'),
+    ('archives', 'application/zip', 0, b'PK\x03\x04'),
+    ('archives', 'application/zip', 0, b'PK\x05\x06'),
+    ('archives', 'application/vnd.rar', 0, b'Rar!\x1a\x07'),
+    ('archives', 'application/x-7z-compressed', 0, b"7z\xbc\xaf'\x1c"),
+)
+
+
+def file_extension(filename: Optional[str]) -> str:
+    return filename.rsplit('.', 1)[1].lower() if filename and '.' in filename else ''
+
+
+def detect_file_type(head: bytes, filename: Optional[str], config) -> Tuple[str, Optional[str]]:
+    """
+    Тип файла по первым HEAD_SIZE байтам: (images / pdf / dicom / archives / other, MIME)
+    """
+    ext = file_extension(filename)
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'images', 'image/webp'
+    for file_type, mime_type, offset, signature in SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            # docx/xlsx - тоже ZIP-контейнеры, но это документы
+            if file_type == 'archives' and ext in config['ALLOWED_DOCUMENT_EXTENSIONS']:
+                return 'other', None
+            return file_type, mime_type
+    # DICOM без преамбулы (ACR-NEMA) сигнатуры не имеет - здесь доверяем расширению
+    if ext in config['ALLOWED_DICOM_EXTENSIONS']:
+        return 'dicom', 'application/dicom'
+    return 'other', None
+
+
+def read_file_type(path, filename: Optional[str], config) -> str:
+    """Тип уже сохранённого файла (сверка учёта места, удаление)"""
+    with open(path, 'rb') as f:
+        return detect_file_type(f.read(HEAD_SIZE), filename, config)[0]
+
+
+def max_file_size(file_type: Optional[str], config) -> int:
+    """Лимит на один файл: по типу (UPLOAD_MAX_FILE_SIZE_BY_TYPE) или общий"""
+    return config['UPLOAD_MAX_FILE_SIZE_BY_TYPE'].get(file_type, config['UPLOAD_MAX_FILE_SIZE'])
+
+
+class IngestedFile:
+    """Сохранённый файл загрузки"""
+
+    def __init__(self, path, size: int, sha256: str, file_type: str, mime_type: Optional[str]):
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+        self.file_type = file_type
+        self.mime_type = mime_type
+
+    @property
+    def is_image(self):
+        return self.file_type == 'images'
+
+    @property
+    def is_pdf(self):
+        return self.file_type == 'pdf'
+
+    @property
+    def is_dicom(self):
+        return self.file_type == 'dicom'
+
+    @property
+    def is_archive(self):
+        return self.file_type == 'archives'
+
+
+class UploadCounters:
+    """Принятые загрузки процесса для /metrics: файлов и байт (включая части загрузок с возобновлением)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.files = 0
+        self.bytes = 0
+
+    def add(self, size: int, files: int = 0):
+        with self._lock:
+            self.bytes += size
+            self.files += files
+
+    def snapshot(self) -> Tuple[int, int]:
+        with self._lock:
+            return self.files, self.bytes
+
+
+upload_counters = UploadCounters()
+
+
+class UploadStream:
+    """
+    Временный файл загрузки: SHA-256, размер и начало файла считаются при записи.
+    Не перенесённый на место файл удаляется при закрытии (конец запроса).
+    """
+
+    def __init__(self, directory, filename: Optional[str], config):
+        os.makedirs(directory, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(dir=directory, suffix='.part')
+        self._file = os.fdopen(fd, 'w+b')
+        self._config = config
+        self.filename = filename
+        self.size = 0
+        self.head = b''
+        self.sha256 = hashlib.sha256()
+        self.file_type = None
+        self.mime_type = None
+
+    def _detect(self):
+        self.file_type, self.mime_type = detect_file_type(self.head, self.filename, self._config)
+
+    def _check_size(self):
+        limit = max_file_size(self.file_type, self._config)
+        if self.size > limit:
+            self.close()
+            raise RequestEntityTooLarge(
+                f'Файл {self.filename} больше допустимого ({limit // (1024 * 1024)} МБ)'
+            )
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        if self.file_type is None and len(self.head) < HEAD_SIZE:
+            self.head += data[:HEAD_SIZE - len(self.head)]
+            if len(self.head) == HEAD_SIZE:
+                self._detect()
+        self._check_size()
+        self.sha256.update(data)
+        return self._file.write(data)
+
+    def finish(self) -> IngestedFile:
+        """
+        Завершить запись. Файл остаётся во временном пути - его переносит хранилище
+        (blobstore.store_blob); если этого не случилось, он удаляется при закрытии
+        """
+        if self.file_type is None:
+            self._detect()
+            self._check_size()
+        self._file.close()
+        upload_counters.add(self.size, files=1)
+        return IngestedFile(self.path, self.size, self.sha256.hexdigest(), self.file_type, self.mime_type)
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __getattr__(self, name):
+        # read/seek/tell/readline для FileStorage и парсера werkzeug
+        return getattr(self._file, name)
+
+
+def incoming_directory(config):
+    return os.path.join(config['UPLOAD_FOLDER'], INCOMING_DIRECTORY)
+
+
+class UploadRequest(Request):
+    """Запрос, у которого файловые части multipart сразу пишутся в UploadStream"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return UploadStream(incoming_directory(current_app.config), filename, current_app.config)
+
+
+def ingest_upload(file_storage, config) -> IngestedFile:
+    """
+    Принять загруженный файл: размер, SHA-256 и тип уже посчитаны при записи
+
+    Raises:
+        RequestEntityTooLarge: файл больше лимита для своего типа
+    """
+    if isinstance(file_storage.stream, UploadStream):
+        return file_storage.stream.finish()
+
+    # Поток не от UploadRequest - копируем блоками с теми же подсчётами
+    upload = UploadStream(incoming_directory(config), file_storage.filename, config)
+    try:
+        for chunk in iter(lambda: file_storage.stream.read(config['UPLOAD_CHUNK_SIZE']), b''):
+            upload.write(chunk)
+        ingested = upload.finish()
+    except Exception:
+        upload.close()
+        raise
+    # Временный файл удалится вместе с остальными файлами запроса, если его не перенесут
+    file_storage.stream = upload
+    return ingested
+
+
+# ==================== ЗАГРУЗКА ЧАСТЯМИ ====================
+
+class UploadBusy(Exception):
+    """Часть этой загрузки уже принимается другим запросом"""
+
+
+class ResumableHashes:
+    """
+    SHA-256 загрузок частями, посчитанный по мере приёма (память процесса) - при
+    завершении файл не перечитывается. Если части принимал другой процесс или сервер
+    перезапускался, хэш считается заново при завершении.
+    """
+
+    def __init__(self):
+        self._states: Dict[str, Tuple[object, int]] = {}  # id -> (hashlib-объект, байт учтено)
+        self._busy = set()
+        self._lock = threading.Lock()
+
+    def begin(self, upload_id: str, offset: int):
+        """Занять загрузку на время приёма части; хэш до offset или None"""
+        with self._lock:
+            if upload_id in self._busy:
+                raise UploadBusy(upload_id)
+            self._busy.add(upload_id)
+            hasher, hashed = self._states.pop(upload_id, (None, 0))
+        if offset == 0:
+            return hashlib.sha256()
+        return hasher if hashed == offset else None
+
+    def end(self, upload_id: str, hasher, hashed: int):
+        with self._lock:
+            self._busy.discard(upload_id)
+            if hasher is not None:
+                self._states[upload_id] = (hasher, hashed)
+
+    def take(self, upload_id: str, size: int):
+        """Забрать хэш завершённой загрузки (None - не все части прошли через этот процесс)"""
+        with self._lock:
+            hasher, hashed = self._states.pop(upload_id, (None, 0))
+        return hasher if hashed == size else None
+
+    def discard(self, upload_id: str):
+        with self._lock:
+            self._states.pop(upload_id, None)
+
+
+# Хэши загрузок частями в этом процессе
+resumable_hashes = ResumableHashes()
+
+
+def resumable_path(config, upload_id: str) -> str:
+    return os.path.join(incoming_directory(config), upload_id + RESUMABLE_SUFFIX)
+
+
+def create_resumable_file(config) -> str:
+    """Создать пустой временный файл загрузки частями; возвращает id загрузки"""
+    os.makedirs(incoming_directory(config), exist_ok=True)
+    upload_id = secrets.token_hex(16)
+    open(resumable_path(config, upload_id), 'xb').close()
+    return upload_id
+
+
+def write_chunk(upload_id: str, offset: int, stream, limit: int, config):
+    """
+    Записать часть из потока запроса с позиции offset блоками UPLOAD_CHUNK_SIZE.
+    Файл обрезается до offset, поэтому после обрыва его размер - точная позиция
+    для продолжения, даже если часть принята не целиком.
+
+    Args:
+        limit: сколько байт ещё можно принять (до объявленного размера файла)
+
+    Raises:
+        UploadBusy: часть этой загрузки уже принимается
+        RequestEntityTooLarge: данных больше объявленного размера
+    """
+    hasher = resumable_hashes.begin(upload_id, offset)
+    written = 0
+    try:
+        with open(resumable_path(config, upload_id), 'r+b') as f:
+            f.truncate(offset)
+            f.seek(offset)
+            for data in iter(lambda: stream.read(config['UPLOAD_CHUNK_SIZE']), b''):
+                if written + len(data) > limit:
+                    raise RequestEntityTooLarge('Данных больше объявленного размера файла')
+                f.write(data)
+                written += len(data)
+                if hasher is not None:
+                    hasher.update(data)
+    finally:
+        resumable_hashes.end(upload_id, hasher, offset + written)
+        upload_counters.add(written)
+
+
+def finish_resumable(upload_id: str, filename: str, size: int, config) -> IngestedFile:
+    """Принятый целиком файл загрузки частями: SHA-256 и тип по сигнатуре"""
+    path = resumable_path(config, upload_id)
+    hasher = resumable_hashes.take(upload_id, size)
+    with open(path, 'rb') as f:
+        head = f.read(HEAD_SIZE)
+        if hasher is None:
+            hasher = hashlib.sha256(head)
+            for block in iter(lambda: f.read(config['UPLOAD_CHUNK_SIZE']), b''):
+                hasher.update(block)
+    file_type, mime_type = detect_file_type(head, filename, config)
+    upload_counters.add(0, files=1)  # байты учтены при приёме частей
+    return IngestedFile(path, size, hasher.hexdigest(), file_type, mime_type)
+
+
+def discard_resumable(upload_id: str, config):
+    resumable_hashes.discard(upload_id)
+    try:
+        os.remove(resumable_path(config, upload_id))
+    except FileNotFoundError:
+        pass
+
+
+def expire_uploads(db, config) -> int:
+    """
+    Удалить брошенные загрузки: сессии без новых частей дольше UPLOAD_SESSION_TTL и
+    временные файлы .incoming старше него без сессии (оборванные запросы)
+
+    Returns:
+        Число удалённых временных файлов
+    """
+    ttl = config['UPLOAD_SESSION_TTL']
+    expired = [upload_id for (upload_id,) in db.session.query(UploadSession.id)
+               .filter(UploadSession.updated_at < datetime.utcnow() - ttl)]
+    if expired:
+        UploadSession.query.filter(UploadSession.id.in_(expired)).delete(synchronize_session=False)
+        db.session.commit()
+        for upload_id in expired:
+            discard_resumable(upload_id, config)
+    active = {upload_id for (upload_id,) in db.session.query(UploadSession.id)}
+
+    cutoff = time.time() - ttl.total_seconds()
+    removed = len(expired)
+    try:
+        entries = list(os.scandir(incoming_directory(config)))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        if entry.name.endswith(RESUMABLE_SUFFIX) and entry.name[:-len(RESUMABLE_SUFFIX)] in active:
+            continue
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            continue
+    return removed
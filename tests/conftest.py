@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# app.py импортирует logging_config без пакета - как при прямом запуске
+sys.path.insert(0, os.path.join(ROOT, 'app'))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('FLASK_TEMPLATES_FOLDER', os.path.join(ROOT, 'app', 'templates'))
+os.environ.setdefault('FLASK_STATIC_FOLDER', os.path.join(ROOT, 'app', 'static'))
+
+from app.app import create_app  # noqa: E402
+from app.models import db  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path):
+    application = create_app('testing')
+    application.config['UPLOAD_FOLDER'] = str(tmp_path)
+    yield application
+    with application.app_context():
+        db.session.remove()
+        db.drop_all()
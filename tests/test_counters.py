@@ -0,0 +1,47 @@
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from app import models
+from app.models import db, User, Task, TaskUnread, StorageUsage, FileBlob
+
+
+@pytest.fixture(params=['on_conflict', 'update_then_insert'])
+def upsert_mode(request, monkeypatch):
+    if request.param == 'update_then_insert':
+        # СУБД без INSERT ... ON CONFLICT (MySQL, MSSQL и т.п.)
+        monkeypatch.setattr(models, 'ON_CONFLICT_INSERTS', {})
+    return request.param
+
+
+def test_counters_upsert(app, upsert_mode):
+    with app.app_context():
+        user = User(username='doc', role='doctor', first_name='Doc', last_name='L', department='RO1')
+        user.set_password('pwd1')
+        db.session.add(user)
+        db.session.flush()
+        task = Task(title='t', treatment='', ct_diagnostic='', doctor_id=user.id, physicist_id=user.id)
+        db.session.add(task)
+        db.session.commit()
+
+        TaskUnread.increment(user.id, task.id)
+        TaskUnread.increment(user.id, task.id, by=2)
+        TaskUnread.decrement(user.id, task.id, by=5)
+        TaskUnread.increment(user.id, task.id)
+        StorageUsage.add('blobs', 'pdf', 100)
+        StorageUsage.add('blobs', 'pdf', 50)
+        StorageUsage.subtract('blobs', 'pdf', 500, files=3)
+        FileBlob.acquire('ab' * 32, 10, 'pdf')
+        FileBlob.acquire('ab' * 32, 10, 'pdf')
+        db.session.commit()
+
+        assert TaskUnread.get_count(user.id, task.id) == 1
+        usage = db.session.get(StorageUsage, ('blobs', 'pdf'))
+        assert (usage.files, usage.bytes) == (0, 0)
+        assert db.session.get(FileBlob, 'ab' * 32).refcount == 2
+
+
+def test_postgresql_upsert_compiles():
+    stmt = models.postgresql_insert(TaskUnread).values(user_id=1, task_id=2, count=1).on_conflict_do_update(
+        index_elements=['user_id', 'task_id'], set_={'count': TaskUnread.count + 1})
+    sql = str(stmt.compile(dialect=postgresql.dialect()))
+    assert 'ON CONFLICT (user_id, task_id) DO UPDATE' in sql
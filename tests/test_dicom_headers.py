@@ -0,0 +1,95 @@
+import struct
+import zipfile
+from datetime import datetime, timedelta
+
+from app.dicom_headers import index_pending_files, claim_task_file, read_file_headers
+from app.models import db, User, Task, TaskFile, DicomInstance
+
+
+def implicit_element(group, element, value: bytes) -> bytes:
+    if len(value) % 2:
+        value += b'\0'
+    return struct.pack('<HHI', group, element, len(value)) + value
+
+
+def make_task_file(tmp_path):
+    """Задача с .dcm, загруженным до индекса DICOM (dicom_indexed NULL)"""
+    user = User(username='doc', role='doctor', first_name='Doc', last_name='L', department='RO1')
+    user.set_password('pwd1')
+    db.session.add(user)
+    db.session.flush()
+    task = Task(title='t', treatment='', ct_diagnostic='', doctor_id=user.id, physicist_id=user.id)
+    db.session.add(task)
+    db.session.flush()
+
+    directory = tmp_path / str(task.id)
+    directory.mkdir()
+    # Набор данных без преамбулы, Implicit VR Little Endian
+    (directory / 'x_a.dcm').write_bytes(
+        implicit_element(0x0008, 0x0018, b'1.2.3.4') + implicit_element(0x0008, 0x0060, b'CT')
+        + implicit_element(0x0020, 0x000E, b'1.2.3')
+    )
+    task_file = TaskFile(task_id=task.id, uploader_id=user.id, original_filename='a.dcm',
+                         stored_filename='x_a.dcm', file_size=10, is_dicom=True)
+    db.session.add(task_file)
+    db.session.commit()
+    return task_file
+
+
+def test_pending_file_is_indexed_once(app, tmp_path):
+    with app.app_context():
+        task_file = make_task_file(tmp_path)
+
+        assert index_pending_files(db, str(tmp_path), app.config) == 1
+        assert index_pending_files(db, str(tmp_path), app.config) == 0
+        instances = DicomInstance.query.all()
+        assert [(i.member, i.modality, i.series_instance_uid) for i in instances] == [('', 'CT', '1.2.3')]
+        assert db.session.get(TaskFile, task_file.id).dicom_indexed is True
+
+
+def test_claimed_file_is_not_indexed_again(app, tmp_path):
+    with app.app_context():
+        task_file = make_task_file(tmp_path)
+
+        # Другой процесс уже занял файл: второй UPDATE строку не меняет
+        timeout = app.config['DICOM_INDEX_CLAIM_TIMEOUT']
+        assert claim_task_file(db, task_file.id, timeout)
+        assert not claim_task_file(db, task_file.id, timeout)
+        assert index_pending_files(db, str(tmp_path), app.config) == 0
+        assert DicomInstance.query.count() == 0
+
+
+def test_stale_claim_is_taken_again(app, tmp_path):
+    with app.app_context():
+        task_file = make_task_file(tmp_path)
+        # Воркер занял файл и упал
+        task_file.dicom_indexed = False
+        task_file.dicom_claimed_at = datetime.utcnow() - app.config['DICOM_INDEX_CLAIM_TIMEOUT'] - timedelta(minutes=1)
+        db.session.commit()
+
+        assert index_pending_files(db, str(tmp_path), app.config) == 1
+        assert DicomInstance.query.count() == 1
+
+
+def test_duplicate_archive_members_keep_last(app, tmp_path):
+    path = tmp_path / 'series.zip'
+    long_name = 'series/' + 'x' * 300
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr('series/IM0', implicit_element(0x0008, 0x0018, b'1.1') + implicit_element(0x0020, 0x000E, b'1'))
+        archive.writestr('series/IM0', implicit_element(0x0008, 0x0018, b'1.2') + implicit_element(0x0020, 0x000E, b'1'))
+        # Имена, совпадающие после обрезки до 255 символов
+        archive.writestr(long_name + 'a', implicit_element(0x0008, 0x0018, b'2.1') + implicit_element(0x0020, 0x000E, b'2'))
+        archive.writestr(long_name + 'b', implicit_element(0x0008, 0x0018, b'2.2') + implicit_element(0x0020, 0x000E, b'2'))
+
+    headers = read_file_headers(str(path), 'archives', app.config)
+    assert [(h['member'], h['sop_instance_uid']) for h in headers] == [('series/IM0', '1.2'), (long_name[:255], '2.2')]
+
+    with app.app_context():
+        task_file = make_task_file(tmp_path)
+        task_file.is_dicom, task_file.is_archive = False, True
+        task_file.stored_filename = 'x_series.zip'
+        (tmp_path / str(task_file.task_id) / 'x_series.zip').write_bytes(path.read_bytes())
+        db.session.commit()
+
+        assert index_pending_files(db, str(tmp_path), app.config) == 1
+        assert DicomInstance.query.count() == 2
@@ -0,0 +1,36 @@
+from sqlalchemy import inspect
+
+from app.migrations import (POLLING_ENDPOINTS, EXPECTED_SCANS, explain_polling_endpoints, find_table_scans,
+                            drop_obsolete_indexes)
+from app.models import db
+
+
+def test_polling_endpoints_use_indexes(app):
+    plans = explain_polling_endpoints(app, db)
+
+    # Выполнены все endpoint'ы, ни один не пропущен
+    assert len(plans) == len(POLLING_ENDPOINTS)
+    assert all(plans.values())
+    assert find_table_scans(plans, set(db.metadata.tables)) == []
+
+
+def test_unread_counters_are_never_scanned(app):
+    plans = explain_polling_endpoints(app, db)
+
+    unread_lines = [line for statements in plans.values() for _, plan in statements for line in plan
+                    if '_unread' in line]
+    assert unread_lines
+    assert not [line for line in unread_lines if line.startswith('SCAN')]
+    assert not [key for key in EXPECTED_SCANS if key[1].endswith('_unread')]
+
+
+def test_obsolete_indexes_are_dropped(app):
+    with app.app_context():
+        db.session.execute(db.text('CREATE INDEX ix_chat_message_task_created ON chat_message (task_id, created_at)'))
+        db.session.commit()
+
+        assert drop_obsolete_indexes(db) == ['ix_chat_message_task_created']
+        assert drop_obsolete_indexes(db) == []
+        names = {index['name'] for index in inspect(db.engine).get_indexes('chat_message')}
+        assert 'ix_chat_message_task_created' not in names
+        assert 'ix_chat_message_task_id' in names
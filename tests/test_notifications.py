@@ -0,0 +1,38 @@
+from app.models import db, User, Task
+from app.notifications import EventBus, message_hub
+
+
+def test_event_bus_limits_streams():
+    bus = EventBus()
+    first = bus.subscribe(1, 'doctor', max_total=3, max_per_user=2)
+    assert bus.subscribe(1, 'doctor', max_total=3, max_per_user=2) is not None
+    assert bus.subscribe(1, 'doctor', max_total=3, max_per_user=2) is None
+    assert bus.subscribe(2, 'physicist', max_total=3, max_per_user=2) is not None
+    assert bus.subscribe(3, 'physicist', max_total=3, max_per_user=2) is None
+
+    bus.unsubscribe(first)
+    assert bus.subscribe(3, 'physicist', max_total=3, max_per_user=2) is not None
+
+
+def test_long_poll_over_limit_answers_at_once(app, monkeypatch):
+    with app.app_context():
+        user = User(username='doc', role='doctor', first_name='Doc', last_name='L', department='RO1')
+        user.set_password('pwd1')
+        db.session.add(user)
+        db.session.flush()
+        task = Task(title='t', treatment='', ct_diagnostic='', doctor_id=user.id, physicist_id=user.id)
+        db.session.add(task)
+        db.session.commit()
+        task_id = task.id
+
+    client = app.test_client()
+    client.post('/login', data={'username': 'doc', 'password': 'pwd1'})
+    app.config['LONG_POLL_MAX_WAITING'] = 0
+
+    def wait(*args):
+        raise AssertionError('long-poll waited over the limit')
+    monkeypatch.setattr(message_hub, 'wait', wait)
+    response = client.get(f'/task/{task_id}/get_messages?after_id=0&wait=25')
+    assert response.status_code == 200
+    assert response.get_json() == []
+    assert response.headers['Retry-After'] == str(app.config['LONG_POLL_RETRY_AFTER'])
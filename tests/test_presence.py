@@ -0,0 +1,27 @@
+from datetime import datetime, timedelta
+
+from app.models import db, User
+from app.presence import PresenceTracker
+
+
+def test_flush_skips_deleted_users(app):
+    with app.app_context():
+        user = User(username='doc', role='doctor', first_name='Doc', last_name='L', department='RO1')
+        user.set_password('pwd1')
+        db.session.add(user)
+        db.session.commit()
+
+        tracker = PresenceTracker()
+        seen = datetime.utcnow() - timedelta(minutes=1)
+        tracker.touch(user.id, seen)
+        tracker.touch(999, seen)  # пользователь удалён (другой воркер, удаление во время сброса)
+
+        assert tracker.flush(db, User) == 2
+        assert db.session.get(User, user.id).last_seen == seen
+
+        # Следующие сбросы не застревают на удалённом ID
+        later = seen + timedelta(seconds=30)
+        tracker.touch(user.id, later)
+        assert tracker.flush(db, User) == 1
+        db.session.expire_all()
+        assert db.session.get(User, user.id).last_seen == later
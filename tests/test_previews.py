@@ -0,0 +1,31 @@
+import os
+
+import pytest
+
+from app import previews
+from app.models import TaskFile
+
+
+def test_pdf_thumb_url_requires_renderer(monkeypatch):
+    task_file = TaskFile(id=5, task_id=1, is_pdf=True, is_image=False)
+    monkeypatch.setattr(previews, 'pypdfium2', None)
+    assert task_file.thumb_url is None
+
+
+@pytest.mark.skipif(not previews.can_preview('pdf'), reason='Pillow и pypdfium2 не установлены')
+def test_broken_pdf_is_not_rendered_again(app, tmp_path, monkeypatch):
+    source = tmp_path / 'broken.pdf'
+    source.write_bytes(b'%PDF-1.4 not really a pdf')
+    key = 'ab' * 32
+
+    assert previews.generate_preview(str(source), key, 'pdf', str(tmp_path), app.config) is None
+    failed_path = previews.preview_path(str(tmp_path), key, app.config) + previews.FAILED_SUFFIX
+    assert os.path.exists(failed_path)
+
+    def render(*args):
+        raise AssertionError('broken file rendered again')
+    monkeypatch.setattr(previews, 'render_preview', render)
+    assert previews.generate_preview(str(source), key, 'pdf', str(tmp_path), app.config) is None
+
+    previews.remove_previews(str(tmp_path), key)
+    assert not os.path.exists(failed_path)
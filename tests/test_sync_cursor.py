@@ -0,0 +1,34 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.models import db, User, TaskTombstone
+from app.storage import storage_reconciler
+
+
+@pytest.mark.parametrize('since', ['2026-10-18T00:00:00+03:00', '2026-10-18T00:00:00Z', '2026-10-18T00:00:00'])
+def test_offset_aware_cursor_is_accepted(app, since):
+    with app.app_context():
+        user = User(username='phys', role='physicist', first_name='Phys', last_name='L', department='RO1')
+        user.set_password('pwd1')
+        db.session.add(user)
+        db.session.commit()
+
+    client = app.test_client()
+    client.post('/login', data={'username': 'phys', 'password': 'pwd1'})
+    for url in ('/api/tasks', '/api/chats/list'):
+        response = client.get(url, query_string={'since': since})
+        assert response.status_code == 200
+        assert response.get_json()['full'] is False
+
+
+def test_old_tombstones_are_pruned_in_background(app):
+    with app.app_context():
+        retention = app.config['TASKS_TOMBSTONE_RETENTION']
+        db.session.add(TaskTombstone(task_id=1, deleted_at=datetime.utcnow() - retention - timedelta(hours=1)))
+        db.session.add(TaskTombstone(task_id=2))
+        db.session.commit()
+
+    storage_reconciler.run_once(app, db)
+    with app.app_context():
+        assert [tombstone.task_id for tombstone in TaskTombstone.query] == [2]
@@ -0,0 +1,103 @@
+import importlib
+import io
+import os
+
+from app.blobstore import stored_file_path
+from app.models import db, User, Task, TaskFile, UploadSession, FileBlob
+from app.uploads import resumable_path
+
+
+def login_with_task(app):
+    with app.app_context():
+        user = User(username='doc', role='doctor', first_name='Doc', last_name='L', department='RO1')
+        user.set_password('pwd1')
+        db.session.add(user)
+        db.session.flush()
+        task = Task(title='t', treatment='', ct_diagnostic='', doctor_id=user.id, physicist_id=user.id)
+        db.session.add(task)
+        db.session.commit()
+        task_id = task.id
+    client = app.test_client()
+    client.post('/login', data={'username': 'doc', 'password': 'pwd1'})
+    return client, task_id
+
+
+def test_boolean_size_is_rejected(app):
+    client, task_id = login_with_task(app)
+    response = client.post(f'/task/{task_id}/uploads', json={'filename': 'a.bin', 'size': True})
+    assert response.status_code == 400
+
+
+def test_repeated_finalize_does_not_fail(app):
+    client, task_id = login_with_task(app)
+    body = b'resumable upload'
+    upload = client.post(f'/task/{task_id}/uploads', json={'filename': 'a.bin', 'size': len(body)}).get_json()
+    upload_id = upload['upload_id']
+    assert client.put(f'/uploads/{upload_id}?offset=0', data=body).get_json()['success']
+
+    assert client.post(f'/uploads/{upload_id}/finalize').get_json()['success']
+    assert client.post(f'/uploads/{upload_id}/finalize').status_code == 404
+    with app.app_context():
+        assert TaskFile.query.count() == 1
+        assert UploadSession.query.count() == 0
+
+
+def test_failed_finalize_can_be_retried(app, monkeypatch):
+    app_module = importlib.import_module('app.app')
+    client, task_id = login_with_task(app)
+    body = b'resumable upload'
+    upload_id = client.post(f'/task/{task_id}/uploads', json={'filename': 'a.bin', 'size': len(body)}).get_json()['upload_id']
+    client.put(f'/uploads/{upload_id}?offset=0', data=body)
+
+    store_blob = app_module.store_blob
+
+    def failing_store_blob(*args, **kwargs):
+        store_blob(*args, **kwargs)
+        raise OSError('disk full')
+    monkeypatch.setattr(app_module, 'store_blob', failing_store_blob)
+    assert client.post(f'/uploads/{upload_id}/finalize').status_code == 500
+    with app.app_context():
+        assert TaskFile.query.count() == 0
+        assert db.session.get(UploadSession, upload_id).status == 'uploading'
+
+    monkeypatch.setattr(app_module, 'store_blob', store_blob)
+    response = client.post(f'/uploads/{upload_id}/finalize').get_json()
+    assert response['success']
+    with app.app_context():
+        task_file = db.session.get(TaskFile, response['file']['id'])
+        assert db.session.get(FileBlob, task_file.sha256).refcount == 1
+        with open(stored_file_path(app.config['UPLOAD_FOLDER'], str(task_id), task_file.stored_filename), 'rb') as f:
+            assert f.read() == body
+        assert not os.path.exists(resumable_path(app.config, upload_id))
+
+
+def test_deleted_task_drops_uploads(app):
+    client, task_id = login_with_task(app)
+    upload_id = client.post(f'/task/{task_id}/uploads', json={'filename': 'a.bin', 'size': 8}).get_json()['upload_id']
+    client.put(f'/uploads/{upload_id}?offset=0', data=b'half')
+
+    admin = app.test_client()
+    admin.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    admin.post(f'/admin/tasks/{task_id}/delete')
+    with app.app_context():
+        assert Task.query.count() == 0
+        assert UploadSession.query.count() == 0
+    assert not os.path.exists(resumable_path(app.config, upload_id))
+
+
+def test_create_task_reports_failed_files(app, monkeypatch):
+    app_module = importlib.import_module('app.app')
+    client, _ = login_with_task(app)
+
+    def failing_store_blob(*args, **kwargs):
+        raise OSError('disk full')
+    monkeypatch.setattr(app_module, 'store_blob', failing_store_blob)
+    client.post('/create_task', data={'patient_card': '1', 'study_type': 'ct',
+                                      'files': (io.BytesIO(b'scan'), 'scan.bin')},
+                content_type='multipart/form-data')
+    with client.session_transaction() as session:
+        messages = session['_flashes']
+    assert ('danger', 'Не удалось загрузить файлы: scan.bin') in messages
+    with app.app_context():
+        assert Task.query.count() == 2
+        assert TaskFile.query.count() == 0